@@ -0,0 +1,231 @@
+'''
+Asyncio transport - one event loop, on one background thread, drives the
+commit and poll traffic of every session.
+
+The default transport gives each session a ChangesConsumer thread, blocking
+on the network. Here each session gets a coroutine consuming its message queue
+instead, sharing non-blocking keep-alive HTTP connections with the others, so
+the number of threads does not grow with the number of sessions (update checks
+are already shared, see UpdateScheduler). Responses are handled by the same
+ChangesConsumer code, on a small fixed pool of handler threads, since it may
+wait for the main thread.
+
+Needs Python 3.5+ (import it guarded against ImportError and SyntaxError).
+'''
+
+import asyncio
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ServerClosed(EOFError):
+    '''The server closed the connection before sending any response'''
+
+
+class AsyncConnection(object):
+    '''
+    Pool of non-blocking keep-alive HTTP/1.1 connections to the server of a
+    restful_lib.Connection, which prepares the requests and reads the
+    responses (content encoding included), so that both behave the same.
+    Must be used from the event loop.
+    '''
+
+    def __init__(self, conn, pool_size=4):
+        self.conn = conn
+        host, _, port = conn.host.partition(':')
+        self.host = host
+        self.port = int(port or 80)
+        self.pool_size = pool_size
+        self._idle = []  # (reader, writer) ready to be reused
+        self._slots = None  # Semaphore, created on the loop
+
+    async def request(self, resource, method='get', args=None, body=None,
+                      headers=None):
+        '''Coroutine version of Connection.request'''
+        conn = self.conn
+        method, url, body, headers = conn.prepare_request(
+            resource, method, args, body, headers)
+        headers['Host'] = conn.host
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.pool_size)
+
+        attempt = 0
+        while True:
+            send_headers = dict(headers)
+            send_body = body and conn.encode_body(body, send_headers)
+            connected = stale = False
+            state = {'sent': False}
+            async with self._slots:
+                # Only once holding a slot: other requests may take the idle
+                # connections while waiting for one
+                reused = bool(self._idle)
+                try:
+                    if reused:
+                        reader, writer = self._idle.pop()
+                    else:
+                        reader, writer = await asyncio.wait_for(
+                            asyncio.open_connection(self.host, self.port),
+                            conn.timeout)
+                    connected = True
+                    status, header_items, data, keep_alive = \
+                        await asyncio.wait_for(
+                            self._roundtrip(reader, writer, method, url,
+                                            send_body, send_headers, state),
+                            conn.timeout)
+                except (OSError, EOFError, ValueError,
+                        asyncio.TimeoutError, asyncio.IncompleteReadError) \
+                        as e:
+                    if connected:
+                        writer.close()
+                    # Same rules as Connection.request
+                    sent = state['sent']
+                    stale = reused and (not sent or
+                                        isinstance(e, ServerClosed))
+                    retry = stale or not sent or \
+                        method in conn.IDEMPOTENT_METHODS
+                    if not retry or attempt >= conn.retries:
+                        raise
+                else:
+                    if keep_alive:
+                        self._idle.append((reader, writer))
+                    else:
+                        writer.close()
+                    if status == 415 and 'Content-Encoding' in send_headers:
+                        conn._server_gzip = False
+                        continue
+                    return conn.read_response(header_items, data)
+            if stale:
+                continue
+            await asyncio.sleep(conn.backoff * (2 ** attempt))
+            attempt += 1
+
+    async def _roundtrip(self, reader, writer, method, url, body, headers,
+                         state):
+        '''
+        Writes a request and reads its response. Sets state['sent'] once the
+        request is written.
+        '''
+        head = [method + ' ' + url + ' HTTP/1.1']
+        head += [name + ': ' + str(value) for name, value in headers.items()]
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+        if body:
+            writer.write(body)
+        await writer.drain()
+        state['sent'] = True
+
+        status_line = (await reader.readline()).decode('latin-1')
+        if not status_line:
+            raise ServerClosed('Connection closed by the server')
+        version, status = status_line.split(None, 2)[:2]
+        header_items = []
+        fields = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').rstrip('\r\n')
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            header_items.append((name.strip(), value.strip()))
+            fields[name.strip().lower()] = value.strip()
+
+        if fields.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if not size:
+                    await reader.readline()
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            data = b''.join(chunks)
+            keep_alive = True
+        elif 'content-length' in fields:
+            data = await reader.readexactly(int(fields['content-length']))
+            keep_alive = True
+        else:
+            data = await reader.read()
+            keep_alive = False
+        connection = fields.get('connection', '').lower()
+        if connection == 'close' or \
+                (version == 'HTTP/1.0' and connection != 'keep-alive'):
+            keep_alive = False
+        return int(status), header_items, data, keep_alive
+
+
+class AsyncTransport(object):
+    '''
+    The event loop thread and the coroutines of the sessions.
+
+    @conn:
+        restful_lib.Connection to the server
+    @pool_size:
+        Maximum number of simultaneous connections
+    @handlers:
+        Number of threads handling responses
+    '''
+
+    def __init__(self, conn, pool_size=4, handlers=2):
+        self.aconn = AsyncConnection(conn, pool_size)
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=handlers)
+        self.thread = threading.Thread(target=self._run,
+                                       name='AsyncTransport')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def add_session(self, session):
+        '''Starts sending the messages of a session'''
+        asyncio.run_coroutine_threadsafe(self._start(session), self.loop)
+
+    async def _start(self, session):
+        wakeup = asyncio.Event()
+        loop = self.loop
+        session.msgmonitor.listener = \
+            lambda: loop.call_soon_threadsafe(wakeup.set)
+        loop.create_task(self._consume(session, wakeup))
+
+    async def _next_item(self, monitor, wakeup):
+        '''Waits for the next item of the message queue'''
+        while True:
+            wakeup.clear()
+            item, wait = monitor.remove_nowait()
+            if item is not None:
+                return item
+            try:
+                await asyncio.wait_for(wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _consume(self, session, wakeup):
+        '''Coroutine counterpart of ChangesConsumer.run'''
+        consumer = session.cr_consumer
+        attempt = 0
+        while True:
+            item = await self._next_item(session.msgmonitor, wakeup)
+            conv, data, headers, batch = consumer.prepare(item)
+            if conv is None:
+                continue
+            started = time.time()
+            try:
+                resp = conv.response_for(data)
+                if resp is None:
+                    resp = await self.aconn.request(
+                        **conv.request_args(data, headers))
+                conv.receive(resp)
+            except Exception:
+                traceback.print_exc()
+                # Try again later
+                await asyncio.sleep(consumer.failed(batch, attempt))
+                attempt += 1
+                continue
+            attempt = 0
+            await self.loop.run_in_executor(self.executor, consumer.complete,
+                                            conv, batch, started)
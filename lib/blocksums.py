@@ -0,0 +1,197 @@
+'''
+Block checksums - finding (and repairing) the places where the buffer of a
+session diverged from the pad on the server.
+
+The text is cut into blocks of `block_size` characters, each summed with
+Adler-32 (of its UTF-8 encoding). Both sides sum their copy at the same cr_n;
+only the blocks whose sums differ are fetched again. As in rsync, a block is
+also looked for in the local copy shifted by the difference of the lengths,
+so that a few missing or extra characters do not cost the whole tail.
+'''
+
+import sys
+import zlib
+
+
+st_version = 2 if sys.version_info < (3,) else 3
+
+if st_version == 3:
+    from .rope import Rope
+elif st_version == 2:
+    from rope import Rope
+
+
+DEFAULT_BLOCK_SIZE = 4096
+
+# Modulus of the two halves of an Adler-32
+_ADLER_MOD = 65521
+
+
+def block_sum(text):
+    '''Adler-32 of a block of text'''
+    return zlib.adler32(text.encode('UTF-8')) & 0xffffffff
+
+
+def _combine(first, second, length):
+    '''
+    Adler-32 of the concatenation of two strings, from theirs and the length
+    (in bytes) of the second one
+    '''
+    a1, b1 = first & 0xffff, first >> 16
+    a = a1 + (second & 0xffff) - 1
+    b = b1 + (second >> 16) + length * (a1 - 1)
+    return (b % _ADLER_MOD) << 16 | a % _ADLER_MOD
+
+
+def _remove_head(whole, head, length):
+    '''Adler-32 of what follows head in whole, `length` bytes long'''
+    a1 = head & 0xffff
+    a = (whole & 0xffff) - a1 + 1
+    b = (whole >> 16) - (head >> 16) - length * (a1 - 1)
+    return (b % _ADLER_MOD) << 16 | a % _ADLER_MOD
+
+
+def _remove_tail(whole, tail, length):
+    '''Adler-32 of what precedes tail (`length` bytes long) in whole'''
+    a = (whole & 0xffff) - (tail & 0xffff) + 1
+    b = (whole >> 16) - (tail >> 16) - length * (a - 1)
+    return (b % _ADLER_MOD) << 16 | a % _ADLER_MOD
+
+
+def _concat(first, second):
+    '''(sum, length in bytes) of the concatenation of two strings'''
+    return _combine(first[0], second[0], second[1]), first[1] + second[1]
+
+
+def checksums(text, block_size=DEFAULT_BLOCK_SIZE):
+    '''Sums of the blocks of a string'''
+    return [block_sum(text[start:start + block_size])
+            for start in range(0, len(text), block_size)]
+
+
+class ChecksummedRope(Rope):
+    '''
+    Rope keeping the sums of its blocks. Its text is kept cut into spans,
+    the blocks as of the last checksums(): an edit only drops the sums of the
+    spans it touches, the spans after it move along with their text. Once
+    asked for, the sum of a block is derived from those of the spans it
+    overlaps (see _span_sum), so that only the edited spans, and a few
+    characters around the others if the length changed, are read again.
+    '''
+
+    def __init__(self, text='', leaf_size=2048,
+                 block_size=DEFAULT_BLOCK_SIZE):
+        super(ChecksummedRope, self).__init__(text, leaf_size)
+        self.block_size = block_size
+        # [characters, bytes, sum] of each span, bytes and sum None once
+        # edited
+        self._spans = [[len(text), None, None]] if text else []
+        self._aligned = not text  # The spans are the blocks, all summed
+
+    def insert(self, pos, text):
+        if text:
+            self._edited(max(0, min(pos, len(self))), 0, len(text))
+        super(ChecksummedRope, self).insert(pos, text)
+
+    def delete(self, pos, length):
+        pos = max(0, pos)
+        length = min(length, len(self) - pos)
+        if length > 0:
+            self._edited(pos, length, 0)
+        super(ChecksummedRope, self).delete(pos, length)
+
+    def _edited(self, pos, removed, added):
+        '''Replaces the spans touched by an edit with an unsummed one'''
+        self._aligned = False
+        spans = self._spans
+        if not spans:
+            spans.append([added, None, None])
+            return
+        first, start = 0, 0
+        while first < len(spans) - 1 and start + spans[first][0] <= pos:
+            start += spans[first][0]
+            first += 1
+        last, end = first, start + spans[first][0]
+        while end < pos + removed:
+            last += 1
+            end += spans[last][0]
+        length = end - start - removed + added
+        spans[first:last + 1] = [[length, None, None]] if length else []
+
+    def checksums(self):
+        '''Sums of the blocks of the text'''
+        if self._aligned:
+            return [span[2] for span in self._spans]
+        spans, size, length = self._spans, self.block_size, len(self)
+        blocks = []
+        index, span_start = 0, 0
+        for start in range(0, length, size):
+            end = min(start + size, length)
+            while start >= span_start + spans[index][0]:
+                span_start += spans[index][0]
+                index += 1
+            block = (1, 0)  # Sum and length (in bytes) of ''
+            i, i_start = index, span_start
+            while i_start < end:
+                span = spans[i]
+                block = _concat(block, self._span_sum(
+                    span, i_start, max(start, i_start),
+                    min(end, i_start + span[0])))
+                i_start += span[0]
+                i += 1
+            blocks.append([end - start, block[1], block[0]])
+        self._spans = blocks
+        self._aligned = True
+        return [block[2] for block in blocks]
+
+    def _span_sum(self, span, span_start, start, end):
+        '''
+        Sum and length in bytes of the text between start and end, within
+        the span starting at span_start: from the sum of the span, less the
+        sum of the rest of it if that is shorter, or else read
+        '''
+        chars, size, total = span
+        span_end = span_start + chars
+        if total is not None and 2 * (end - start) > chars:
+            if start == span_start and end == span_end:
+                return total, size
+            if start == span_start:
+                tail_sum, tail_size = self._sum(end, span_end)
+                return (_remove_tail(total, tail_sum, tail_size),
+                        size - tail_size)
+            if end == span_end:
+                head_sum, head_size = self._sum(span_start, start)
+                return (_remove_head(total, head_sum, size - head_size),
+                        size - head_size)
+        return self._sum(start, end)
+
+    def _sum(self, start, end):
+        '''Sum and length in bytes of the text between start and end'''
+        data = self.substr(start, end).encode('UTF-8')
+        return zlib.adler32(data) & 0xffffffff, len(data)
+
+    def match_blocks(self, sums, length):
+        '''
+        Finds the blocks of another copy of the text, `length` characters
+        long and with the given block sums, in this one. Returns the position
+        of each block here, or None for the blocks not found.
+        '''
+        size = self.block_size
+        local = self.checksums()
+        shift = len(self) - length
+        found = []
+        for index, block in enumerate(sums):
+            start = index * size
+            end = min(start + size, length)
+            if index < len(local) and local[index] == block and \
+                    min(start + size, len(self)) == end:
+                found.append(start)
+                continue
+            if shift and 0 <= start + shift and \
+                    end + shift <= len(self) and \
+                    block_sum(self.substr(start + shift, end + shift)) == \
+                    block:
+                found.append(start + shift)
+            else:
+                found.append(None)
+        return found
@@ -1,6 +1,57 @@
 """Change-requests handling"""
 
 import re
+from array import array
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+
+# Characters that can not travel raw inside a serialized CR (legacy format;
+# the compact one has the values length-prefixed instead)
+_ESCAPES = (('\\:', ':'), ('\\n', '\n'), ('\\r', '\r'), ('\\t', '\t'))
+
+
+def escape_value(text):
+    """Escapes the payload of a CR for the (legacy) wire format"""
+    for escaped, raw in _ESCAPES:
+        text = text.replace(raw, escaped)
+    return text
+
+
+def unescape_value(value):
+    """Reverts escape_value()"""
+    for escaped, raw in _ESCAPES[::-1]:
+        value = value.replace(escaped, raw)
+    return value
+
+
+_NUMERALS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+def to_base36(x):
+    """Encodes a (possibly negative) integer in base 36"""
+    if x < 0:
+        return '-' + to_base36(-x)
+    digits = []
+    while True:
+        x, d = divmod(x, 36)
+        digits.append(_NUMERALS[d])
+        if not x:
+            return ''.join(reversed(digits))
+
+
+# Legacy (version 1) CR format
+_CR_PATTERN = re.compile(
+    r'(?P<auth>.+?):(?P<cr>-?[0-9a-z]+?):(?P<pos>[0-9a-z]+?)(?P<op>[+-]?)(?P<delta>[0-9a-z]+?):(?P<data>(\\:|[^:])*?):'
+)
+# One CR of a legacy list, up to the '>' that follows it (a '>' may also be
+# the value of a CR)
+_CR_ITEM = re.compile(
+    r'(.+?:-?[0-9a-z]+?:[0-9a-z]+?[+-]?[0-9a-z]+?:(?:\\:|[^:])*?:)(?:>|\Z)'
+)
 
 
 class ChangeRequest(object):
@@ -12,57 +63,34 @@ class ChangeRequest(object):
         pos - position of the edit
         op - edit operation (+ / -)
         delta - number of modified characters
-        value - actual edit data (empty for deletions)
+        value - actual edit data (empty for deletions), raw: it is escaped
+                only in the legacy wire format
     """
 
-    def __init__(self, author='', cr_n=0, pos=0, delta=0, op=0, value=''):
-        super(ChangeRequest, self).__init__()
+    __slots__ = ('author', 'cr_n', 'pos', 'delta', 'op', 'value', 'trace')
 
+    def __init__(self, author='', cr_n=0, pos=0, delta=0, op=0, value=''):
         self.author, self.cr_n, self.pos, self.delta, self.op, self.value =\
             author, cr_n, pos, delta, op, value
-
-        if self.value == ':':
-            self.value = '\\:'
-        elif self.value == '\n':
-            self.value = '\\n'
-        elif self.value == '\r':
-            self.value = '\\r'
-        elif self.value == '\t':
-            self.value = '\\t'
+        # Stages reached in the sync pipeline (see metrics.Trace)
+        self.trace = None
 
     # Edit types
     ADD_EDIT = 0
     DEL_EDIT = 1
 
     def serialize(self):
-        """Produces a string that encodes the CR"""
-
-        def baseN(x, b=36, numerals="0123456789abcdefghijklmnopqrstuvwxyz"):
-            if x < 0:
-                return x
-            return (x == 0) and numerals[0] or \
-                   (baseN(x // b, b, numerals).lstrip(numerals[0]) +
-                    numerals[x % b])
-
-        parts = {}
-        parts['op'] = '-'
-        if self.op == ChangeRequest.ADD_EDIT:
-            parts['op'] = '+'
-        parts['auth'] = self.author
-        # Encode numbers in a higher base (36)
-        parts['cr_n'] = baseN(self.cr_n)
-        parts['pos'] = baseN(self.pos)
-        parts['delta'] = baseN(self.delta)
-        parts['content'] = self.value
-
-        return "%(auth)s:%(cr_n)s:%(pos)s%(op)s%(delta)s:%(content)s:" % parts
+        """Produces a string that encodes the CR (legacy format)"""
+        # Numbers are encoded in a higher base (36)
+        return ''.join((self.author, ':', to_base36(self.cr_n), ':',
+                        to_base36(self.pos),
+                        '+' if self.op == ChangeRequest.ADD_EDIT else '-',
+                        to_base36(self.delta), ':', escape_value(self.value),
+                        ':'))
 
     def deserialize(self, edit):
-        pattern = re.compile(
-            r'(?P<auth>.+?):(?P<cr>-?[0-9a-z]+?):(?P<pos>[0-9a-z]+?)(?P<op>[+-]?)(?P<delta>[0-9a-z]+?):(?P<data>(\\:|[^:])*?):'
-        )
         try:
-            sections = re.search(pattern, edit).groups()
+            sections = re.search(_CR_PATTERN, edit).groups()
         except AttributeError:
             print('Unable to parse change request. Bad format!')
             return
@@ -77,13 +105,80 @@ class ChangeRequest(object):
         self.pos = int(sections[2], 36)
         self.delta = int(sections[4], 36)
         self.op = op
-        self.value = sections[5]
+        self.value = unescape_value(sections[5])
+
+    def pack(self):
+        """
+        Produces the compact (version 2) encoding of the CR:
+            <cr_n>:<pos>:<op><delta>:<len>:<author><len>:<value>
+        Numbers are in base 36 and strings are length-prefixed, so the value
+        travels raw (no escaping).
+        """
+        author, value = self.author, self.value
+        return ''.join((to_base36(self.cr_n), ':', to_base36(self.pos), ':',
+                        '+' if self.op == ChangeRequest.ADD_EDIT else '-',
+                        to_base36(self.delta), ':',
+                        to_base36(len(author)), ':', author,
+                        to_base36(len(value)), ':', value))
+
+    def merge(self, other):
+        """
+        Absorbs `other`, a CR made right after this one by the same author, if
+        the two edits touch the same run of text. Returns True on success, in
+        which case `other` must be discarded.
+        """
+        if other.author != self.author or other.cr_n != self.cr_n:
+            return False
+
+        if self.op == ChangeRequest.ADD_EDIT:
+            text = self.value
+            offset = other.pos - self.pos
+            if other.op == ChangeRequest.ADD_EDIT:
+                # Typing inside (or at the end of) the inserted run
+                if not 0 <= offset <= len(text):
+                    return False
+                text = text[:offset] + other.value + text[offset:]
+            elif other.op == ChangeRequest.DEL_EDIT:
+                # Deleting part of what was just typed
+                if offset < 0 or offset + other.delta > len(text) or \
+                        other.delta >= len(text):
+                    return False
+                text = text[:offset] + text[offset + other.delta:]
+            else:
+                return False
+            self.value = text
+            self.delta = len(text)
+            return True
+        elif self.op == ChangeRequest.DEL_EDIT:
+            if other.op != ChangeRequest.DEL_EDIT:
+                return False
+            if other.pos == self.pos:
+                # Forward deletion (Del key)
+                self.delta += other.delta
+            elif other.pos + other.delta == self.pos:
+                # Backward deletion (Backspace key)
+                self.pos = other.pos
+                self.delta += other.delta
+            else:
+                return False
+            return True
+        return False
 
     def apply_over(self, instr):
-        val = self.value.replace('\\n', '\n')
-        val = val.replace('\\r', '\r')
-        val = val.replace('\\t', '\t')
-        val = val.replace('\\:', ':')
+        """
+        Applies the CR over a text buffer and returns the result. Plain strings
+        are copied; other buffers (e.g. Rope) are edited in place through their
+        insert()/delete() methods and returned.
+        """
+        val = self.value
+        if not isinstance(instr, basestring):
+            if self.op == ChangeRequest.ADD_EDIT:
+                instr.insert(self.pos, val)
+            elif self.op == ChangeRequest.DEL_EDIT:
+                instr.delete(self.pos, self.delta)
+            else:
+                print('UNKNOWN OPERATION')
+            return instr
         if self.op == ChangeRequest.ADD_EDIT:
             head = instr[:self.pos]
             tail = instr[self.pos:]
@@ -115,6 +210,512 @@ class ChangeRequest(object):
                oper + ':' + str(self.value) + '>'
 
 
+class CRBatch(object):
+    """
+    A list of CRs stored by columns: parallel arrays of their numbers,
+    positions, deltas and operations, the index of their authors in
+    `authors`, and their values concatenated in `payload` (the value of CR i
+    ends at ends[i]). Decoding, applying and encoding a batch makes no
+    ChangeRequest objects; crs() makes them, once, for the code that needs
+    them (e.g. transform), and so does indexing or iterating the batch.
+    """
+
+    def __init__(self):
+        self.cr_n = array('l')
+        self.pos = array('l')
+        self.delta = array('l')
+        self.op = array('b')
+        self.author = array('l')
+        self.authors = []
+        self.ends = array('l')
+        self.payload = ''
+        # Stages reached in the sync pipeline, by all the CRs at once
+        self.trace = None
+        self._crs = None
+
+    @staticmethod
+    def from_crs(crs):
+        batch = CRBatch()
+        authors = {}
+        values = []
+        end = 0
+        for cr in crs:
+            batch.cr_n.append(cr.cr_n)
+            batch.pos.append(cr.pos)
+            batch.delta.append(cr.delta)
+            batch.op.append(cr.op)
+            author = authors.get(cr.author)
+            if author is None:
+                author = authors[cr.author] = len(batch.authors)
+                batch.authors.append(cr.author)
+            batch.author.append(author)
+            end += len(cr.value)
+            batch.ends.append(end)
+            values.append(cr.value)
+        batch.payload = ''.join(values)
+        return batch
+
+    @staticmethod
+    def unpack(data, count, i=0):
+        """
+        Decodes `count` CRs in the compact format (see ChangeRequest.pack),
+        starting at data[i]. Raises ValueError on malformed input.
+        """
+        batch = CRBatch()
+        add_cr_n, add_pos = batch.cr_n.append, batch.pos.append
+        add_delta, add_op = batch.delta.append, batch.op.append
+        add_author, add_end = batch.author.append, batch.ends.append
+        index = data.index
+        size = len(data)
+        authors = {}
+        values = []
+        total = 0
+        for _ in range(count):
+            j = index(':', i)
+            add_cr_n(int(data[i:j], 36))
+            i = j + 1
+            j = index(':', i)
+            add_pos(int(data[i:j], 36))
+            i = j + 1
+            j = index(':', i)
+            op = data[i:i + 1]
+            if op == '+':
+                add_op(ChangeRequest.ADD_EDIT)
+            elif op == '-':
+                add_op(ChangeRequest.DEL_EDIT)
+            else:
+                raise ValueError('Unknown operation ' + op)
+            add_delta(int(data[i + 1:j], 36))
+            i = j + 1
+            j = index(':', i)
+            end = j + 1 + int(data[i:j], 36)
+            name = data[j + 1:end]
+            author = authors.get(name)
+            if author is None:
+                author = authors[name] = len(batch.authors)
+                batch.authors.append(name)
+            add_author(author)
+            j = index(':', end)
+            i = j + 1
+            end = i + int(data[end:j], 36)
+            if end > size:
+                raise ValueError('Truncated change request')
+            values.append(data[i:end])
+            total += end - i
+            add_end(total)
+            i = end
+        batch.payload = ''.join(values)
+        return batch
+
+    def pack(self):
+        """The compact encodings of the CRs, one after the other"""
+        pieces = []
+        add = pieces.extend
+        authors, payload, ends = self.authors, self.payload, self.ends
+        start = 0
+        for i in range(len(self.op)):
+            author = authors[self.author[i]]
+            end = ends[i]
+            add((to_base36(self.cr_n[i]), ':', to_base36(self.pos[i]), ':',
+                 '+' if self.op[i] == ChangeRequest.ADD_EDIT else '-',
+                 to_base36(self.delta[i]), ':',
+                 to_base36(len(author)), ':', author,
+                 to_base36(end - start), ':', payload[start:end]))
+            start = end
+        return ''.join(pieces)
+
+    def crs(self):
+        """The CRs of the batch, as ChangeRequests sharing its trace"""
+        if self._crs is None:
+            crs = []
+            authors, payload, ends = self.authors, self.payload, self.ends
+            start = 0
+            for i in range(len(self.op)):
+                cr = ChangeRequest(authors[self.author[i]], self.cr_n[i],
+                                   self.pos[i], self.delta[i], self.op[i],
+                                   payload[start:ends[i]])
+                cr.trace = self.trace
+                crs.append(cr)
+                start = ends[i]
+            self._crs = crs
+        return self._crs
+
+    def edit_scripts(self):
+        """An EditScript per CR (see compose)"""
+        scripts = []
+        pos, delta, op = self.pos, self.delta, self.op
+        payload, ends = self.payload, self.ends
+        start = 0
+        for i in range(len(op)):
+            scripts.append(EditScript.from_edit(pos[i], delta[i], op[i],
+                                                payload[start:ends[i]]))
+            start = ends[i]
+        return scripts
+
+    def apply_over(self, instr):
+        """
+        Applies the CRs in order over a text buffer and returns the result,
+        like ChangeRequest.apply_over: other buffers than strings (e.g. Rope)
+        are edited in place, CR by CR; strings are rebuilt in one pass
+        """
+        if isinstance(instr, basestring):
+            return compose(self).apply_over(instr)
+        insert, delete = instr.insert, instr.delete
+        pos, delta, op = self.pos, self.delta, self.op
+        payload, ends = self.payload, self.ends
+        start = 0
+        for i in range(len(op)):
+            if op[i] == ChangeRequest.ADD_EDIT:
+                insert(pos[i], payload[start:ends[i]])
+            elif op[i] == ChangeRequest.DEL_EDIT:
+                delete(pos[i], delta[i])
+            else:
+                print('UNKNOWN OPERATION')
+            start = ends[i]
+        return instr
+
+    def __len__(self):
+        return len(self.op)
+
+    def __iter__(self):
+        return iter(self.crs())
+
+    def __getitem__(self, index):
+        return self.crs()[index]
+
+
+def _moved(cr, pos, delta=None):
+    """Copy of a CR at another position (and with another length)"""
+    moved = ChangeRequest(cr.author, cr.cr_n, pos,
+                          cr.delta if delta is None else delta, cr.op,
+                          cr.value)
+    moved.trace = cr.trace
+    return moved
+
+
+def _transform_one(a, b, a_first):
+    """
+    Transforms CR `a` to apply after the concurrent CR `b`. Returns a list,
+    since a deletion may be split in two (or vanish) by the transformation.
+    """
+    if b.op == ChangeRequest.ADD_EDIT:
+        n = len(b.value)
+        if a.op == ChangeRequest.ADD_EDIT:
+            if a.pos < b.pos or (a.pos == b.pos and a_first):
+                return [a]
+            return [_moved(a, a.pos + n)]
+        if b.pos <= a.pos:
+            return [_moved(a, a.pos + n)]
+        if b.pos >= a.pos + a.delta:
+            return [a]
+        # Text inserted inside the deleted range survives: delete around it
+        head = b.pos - a.pos
+        return [_moved(a, a.pos, head), _moved(a, a.pos + n, a.delta - head)]
+
+    elif b.op == ChangeRequest.DEL_EDIT:
+        b_end = b.pos + b.delta
+        if a.op == ChangeRequest.ADD_EDIT:
+            if a.pos <= b.pos:
+                return [a]
+            if a.pos >= b_end:
+                return [_moved(a, a.pos - b.delta)]
+            return [_moved(a, b.pos)]
+        a_end = a.pos + a.delta
+        if a_end <= b.pos:
+            return [a]
+        if a.pos >= b_end:
+            return [_moved(a, a.pos - b.delta)]
+        # Overlapping deletions: only delete what is left
+        overlap = min(a_end, b_end) - max(a.pos, b.pos)
+        if overlap >= a.delta:
+            return []
+        return [_moved(a, min(a.pos, b.pos), a.delta - overlap)]
+    return [a]
+
+
+def transform(left, right, left_first=True):
+    """
+    Operational transformation of two concurrent sequences of CRs, both made
+    over the same text. Returns (left', right') such that applying `right`
+    and then `left'` gives the same text as applying `left` and then
+    `right'`. When both insert at the same position, the text of `left` ends
+    up first if `left_first`, and last otherwise.
+
+    The input CRs are never modified.
+    """
+    if not left or not right:
+        return list(left), list(right)
+    if len(left) == 1 and len(right) == 1:
+        return (_transform_one(left[0], right[0], left_first),
+                _transform_one(right[0], left[0], not left_first))
+    # Halve the longer side (keeps the recursion shallow)
+    if len(left) >= len(right):
+        half = len(left) // 2
+        left1, right = transform(left[:half], right, left_first)
+        left2, right = transform(left[half:], right, left_first)
+        return left1 + left2, right
+    half = len(right) // 2
+    left, right1 = transform(left, right[:half], left_first)
+    left, right2 = transform(left, right[half:], left_first)
+    return left, right1 + right2
+
+
+class EditScript(object):
+    """
+    A normalized edit script: what a sequence of CRs does to a text, as one
+    pass over it. Its spans, in order, are
+        a positive int n - keep the next n characters
+        a negative int -n - delete the next n characters
+        a string - insert it
+    Adjacent spans of a kind are merged, an insertion comes before a deletion
+    at the same point and the text after the last span is kept.
+    """
+
+    def __init__(self, spans=None):
+        self.spans = []
+        for span in spans or []:
+            self._add(span)
+
+    @staticmethod
+    def from_cr(cr):
+        return EditScript.from_edit(cr.pos, cr.delta, cr.op, cr.value)
+
+    @staticmethod
+    def from_edit(pos, delta, op, value):
+        """Script of the edit of a CR, given its fields"""
+        script = EditScript()
+        script._add(pos)
+        if op == ChangeRequest.ADD_EDIT:
+            script._add(value)
+        elif op == ChangeRequest.DEL_EDIT:
+            script._add(-delta)
+        return script
+
+    def _add(self, span):
+        spans = self.spans
+        if not span:
+            return
+        if isinstance(span, basestring):
+            if spans and isinstance(spans[-1], int) and spans[-1] < 0:
+                # Keep insertions before deletions
+                if len(spans) > 1 and isinstance(spans[-2], basestring):
+                    spans[-2] += span
+                else:
+                    spans.insert(len(spans) - 1, span)
+                return
+            if spans and isinstance(spans[-1], basestring):
+                spans[-1] += span
+                return
+        elif spans and isinstance(spans[-1], int) and \
+                (spans[-1] > 0) == (span > 0):
+            spans[-1] += span
+            return
+        spans.append(span)
+
+    def _extend(self, spans):
+        """Adds normalized spans"""
+        tail = self.spans
+        for k, span in enumerate(spans):
+            moved = isinstance(span, basestring) and tail and \
+                isinstance(tail[-1], int) and tail[-1] < 0
+            self._add(span)
+            if not moved:
+                # The rest can't merge with what is there
+                tail.extend(spans[k + 1:])
+                return
+
+    def then(self, other):
+        """
+        Composes the script with `other`, made over the text this one
+        produces, into one script
+        """
+        result = EditScript()
+        add = result._add
+        a, b = self.spans, other.spans
+        i = j = 0
+        span_a = a[0] if a else None
+        span_b = b[0] if b else None
+        while True:
+            if span_a is None:
+                # The rest of the text is kept by self
+                if span_b is not None:
+                    add(span_b)
+                    result._extend(b[j + 1:])
+                break
+            if span_b is None:
+                add(span_a)
+                result._extend(a[i + 1:])
+                break
+            inserting = isinstance(span_a, basestring)
+            if not inserting and span_a < 0:
+                add(span_a)
+                i += 1
+                span_a = a[i] if i < len(a) else None
+                continue
+            if isinstance(span_b, basestring):
+                add(span_b)
+                j += 1
+                span_b = b[j] if j < len(b) else None
+                continue
+
+            # span_a produces characters, span_b keeps or deletes them
+            size_a = len(span_a) if inserting else span_a
+            size_b = abs(span_b)
+            if span_b > 0 and size_a < size_b:
+                # Whole spans of self kept by other, copied as they are
+                add(span_a)
+                left = size_b - size_a
+                k = i + 1
+                while k < len(a):
+                    span = a[k]
+                    size = len(span) if isinstance(span, basestring) \
+                        else span
+                    if size >= left:
+                        break
+                    if size > 0:
+                        left -= size
+                    k += 1
+                result._extend(a[i + 1:k])
+                i = k
+                span_a = a[i] if i < len(a) else None
+                span_b = left
+                continue
+            if not inserting and size_b < size_a:
+                # Whole spans of other over text kept by self
+                add(span_b)
+                left = size_a - size_b
+                k = j + 1
+                while k < len(b):
+                    span = b[k]
+                    if not isinstance(span, basestring):
+                        if abs(span) >= left:
+                            break
+                        left -= abs(span)
+                    k += 1
+                result._extend(b[j + 1:k])
+                j = k
+                span_b = b[j] if j < len(b) else None
+                span_a = left
+                continue
+
+            size = min(size_a, size_b)
+            if span_b > 0:
+                add(span_a[:size] if inserting else size)
+            elif not inserting:
+                add(-size)
+            if size_a > size:
+                span_a = span_a[size:] if inserting else span_a - size
+            else:
+                i += 1
+                span_a = a[i] if i < len(a) else None
+            if size_b > size:
+                span_b = span_b - size if span_b > 0 else span_b + size
+            else:
+                j += 1
+                span_b = b[j] if j < len(b) else None
+        # The rest of the text is kept anyway
+        if result.spans and isinstance(result.spans[-1], int) and \
+                result.spans[-1] > 0:
+            result.spans.pop()
+        return result
+
+    def min_length(self):
+        """Length of the shortest text the script can apply over"""
+        return sum([abs(span) for span in self.spans
+                    if not isinstance(span, basestring)])
+
+    def edits(self):
+        """
+        The changes the script makes, as (pos, deleted, inserted) in the
+        coordinates of the text it applies over, in order
+        """
+        edits = []
+        pos = 0
+        for span in self.spans:
+            if isinstance(span, basestring):
+                edits.append([pos, 0, span])
+            elif span > 0:
+                pos += span
+                continue
+            elif edits and edits[-1][0] + edits[-1][1] == pos:
+                # Deletion right after an insertion: a replacement
+                edits[-1][1] -= span
+                pos -= span
+                continue
+            else:
+                edits.append([pos, -span, ''])
+                pos -= span
+        return [tuple(edit) for edit in edits]
+
+    def apply_over(self, instr):
+        """
+        Applies the script over a text buffer and returns the result, like
+        ChangeRequest.apply_over: plain strings are rebuilt in one pass, other
+        buffers (e.g. Rope) are edited in place, from the last edit back
+        """
+        if not isinstance(instr, basestring):
+            for pos, deleted, inserted in reversed(self.edits()):
+                if deleted:
+                    instr.delete(pos, deleted)
+                if inserted:
+                    instr.insert(pos, inserted)
+            return instr
+        pieces = []
+        i = 0
+        for span in self.spans:
+            if isinstance(span, basestring):
+                pieces.append(span)
+            elif span > 0:
+                pieces.append(instr[i:i + span])
+                i += span
+            else:
+                i -= span
+        pieces.append(instr[i:])
+        return ''.join(pieces)
+
+
+def compose(crs):
+    """
+    Composes a sequence of CRs (each made over the text the previous ones
+    produced) into one EditScript. Scripts are composed pairwise, so that it
+    takes O(k log k) for k CRs. A CRBatch is read column by column.
+    """
+    if isinstance(crs, CRBatch):
+        scripts = crs.edit_scripts()
+    else:
+        scripts = [EditScript.from_cr(cr) for cr in crs]
+    if not scripts:
+        return EditScript()
+    while len(scripts) > 1:
+        composed = [scripts[i].then(scripts[i + 1])
+                    for i in range(0, len(scripts) - 1, 2)]
+        if len(scripts) % 2:
+            composed.append(scripts[-1])
+        scripts = composed
+    return scripts[0]
+
+
+def squash(crs):
+    """
+    Returns as few CRs as make the same edits as a sequence of CRs (see
+    compose), by the author and with the cr_n of the first one
+    """
+    if not len(crs):
+        return []
+    first = crs[0]
+    squashed = []
+    # From the last edit back, so that the positions of the others hold
+    for pos, deleted, inserted in reversed(compose(crs).edits()):
+        if deleted:
+            squashed.append(ChangeRequest(first.author, first.cr_n, pos,
+                                          deleted, ChangeRequest.DEL_EDIT))
+        if inserted:
+            squashed.append(ChangeRequest(first.author, first.cr_n, pos,
+                                          len(inserted),
+                                          ChangeRequest.ADD_EDIT, inserted))
+    return squashed
+
+
 class EncodingHandler:
 
     # Response Type-to-Code
@@ -128,6 +729,7 @@ class EncodingHandler:
             'no':                   203,  # Negative answer (not error)
 
             # POST
+            'updates':              207,  # Per-pad updates are in msg-body
 
             # PUT
             'pad_already_exists':   409,  # Error message
@@ -135,6 +737,7 @@ class EncodingHandler:
         # Pad
             # GET
             "nan":                  501,  # Not a number
+            'history_compacted':    410,  # CRs replaced by a snapshot
 
             # POST
 
@@ -147,6 +750,104 @@ class EncodingHandler:
     for tp in resp_ttoc:
         resp_ctot[resp_ttoc[tp]] = tp
 
+    # Wire formats of CR lists: 1 - legacy, '>' separated, escaped payloads;
+    # 2 - versioned and length-prefixed (see ChangeRequest.pack)
+    LEGACY_FORMAT = 1
+    COMPACT_FORMAT = 2
+    SUPPORTED_FORMATS = (LEGACY_FORMAT, COMPACT_FORMAT)
+
+    @staticmethod
+    def encode_crs(crs, fmt=LEGACY_FORMAT):
+        '''
+        Encodes a list of ChangeRequests (or a CRBatch) in the given wire
+        format
+        '''
+        if fmt == EncodingHandler.COMPACT_FORMAT:
+            if isinstance(crs, CRBatch):
+                body = crs.pack()
+            else:
+                body = ''.join([cr.pack() for cr in crs])
+            return '~2:' + to_base36(len(crs)) + ':' + body
+        return EncodingHandler.serialize_list([cr.serialize() for cr in crs])
+
+    @staticmethod
+    def legacy_crs(cr):
+        '''
+        The CRs the legacy format can carry cr as. It does not escape the
+        backslash (a typed '\\n' would arrive as a newline), so a coalesced
+        value with a backslash or a '>' goes one CR per character, as it was
+        typed.
+        '''
+        if cr.op != ChangeRequest.ADD_EDIT or len(cr.value) < 2 or \
+                ('\\' not in cr.value and '>' not in cr.value):
+            return [cr]
+        crs = []
+        for i, char in enumerate(cr.value):
+            typed = ChangeRequest(cr.author, cr.cr_n, cr.pos + i, 1, cr.op,
+                                  char)
+            typed.trace = cr.trace
+            crs.append(typed)
+        return crs
+
+    @staticmethod
+    def decode_crs(data):
+        '''
+        Decodes a list of ChangeRequests. Compact lists are recognized by their
+        '~<version>:' header, anything else is taken as a legacy list.
+        '''
+        if data and not data.startswith('~'):
+            crs = []
+            for c in EncodingHandler.deserialize_list(data):
+                cr = ChangeRequest()
+                cr.deserialize(c)
+                crs.append(cr)
+            return crs
+        return EncodingHandler.decode_batch(data).crs()
+
+    @staticmethod
+    def decode_batch(data):
+        '''
+        Decodes a list of ChangeRequests into a CRBatch, straight from the
+        compact format
+        '''
+        if not data:
+            return CRBatch()
+        if not data.startswith('~'):
+            return CRBatch.from_crs(EncodingHandler.decode_crs(data))
+
+        try:
+            i = data.index(':')
+            if data[1:i] != '2':
+                raise ValueError('Unsupported format version ' + data[1:i])
+            j = data.index(':', i + 1)
+            count = int(data[i + 1:j], 36)
+            return CRBatch.unpack(data, count, j + 1)
+        except ValueError as e:
+            print('Unable to parse change requests list. Bad format!', e)
+            return CRBatch()
+
+    @staticmethod
+    def encode_fields(fields):
+        '''
+        Encodes a list of strings, each prefixed by its length in base 36:
+            <len>:<string><len>:<string>...
+        '''
+        return ''.join([to_base36(len(f)) + ':' + f for f in fields])
+
+    @staticmethod
+    def decode_fields(data):
+        '''Reverts encode_fields. Raises ValueError on malformed input.'''
+        fields = []
+        i = 0
+        while i < len(data):
+            j = data.index(':', i)
+            end = j + 1 + int(data[i:j], 36)
+            if end > len(data):
+                raise ValueError('Truncated field')
+            fields.append(data[j + 1:end])
+            i = end
+        return fields
+
     @staticmethod
     def serialize_list(l):
         '''Serializes a list into a string'''
@@ -155,5 +856,13 @@ class EncodingHandler:
     @staticmethod
     def deserialize_list(sl):
         '''Deserializes a serialized list'''
-        # FIXME: this will not handle '>' inserts right
-        return sl.split('>')
+        items = []
+        pos = 0
+        while pos < len(sl):
+            match = _CR_ITEM.match(sl, pos)
+            if match is None:
+                # Not a CR: left for ChangeRequest.deserialize to report
+                return items + sl[pos:].split('>')
+            items.append(match.group(1))
+            pos = match.end()
+        return items
@@ -1,3 +1,4 @@
+import socket
 import sys
 
 
@@ -6,21 +7,45 @@ st_version = 2 if sys.version_info < (3,) else 3
 if st_version == 3:
     from .restful_lib import Connection
     from .changerequests import *
+    from .profiling import profiled
 elif st_version == 2:
     from restful_lib import Connection
     from changerequests import *
+    from profiling import profiled
 
 
 class ConversationStarter:
     '''Factory class for Conversation objects'''
 
-    def __init__(self, target_uri):
+    def __init__(self, target_uri, **conn_options):
+        '''Connection options (pool_size, retries...) go to Connection'''
         self.uri = target_uri
-        self.conn = Connection(target_uri)
+        self.conn = Connection(target_uri, **conn_options)
+        self.stream = None  # StreamConnection in use, if any
 
     def new(self, method, resource=''):
         return Conversation(self.conn, method, resource)
 
+    def answered(self, method, resource, responses):
+        '''
+        A conversation already answered: `responses` maps the data that may
+        be sent to the response it gets (as returned by Connection.request)
+        '''
+        return PrefetchedConversation(self.conn, method, resource, responses)
+
+    def use_stream(self, stream):
+        '''
+        Sends the conversations over a StreamConnection from now on, if it
+        can be opened (else keeps the current connection)
+        '''
+        try:
+            stream.connect()
+        except socket.error as e:
+            print('Unable to open the stream connection', e)
+            return False
+        self.conn = self.stream = stream
+        return True
+
 
 class Conversation:
     '''
@@ -35,36 +60,38 @@ class Conversation:
         self.response_code = 0
         self.response_data = ''
         self.response_headers = {}
+        self.prefetched = False  # Whether the response was known beforehand
 
-    def send(self, data='', headers={}):
+    @profiled
+    def send(self, data='', headers=None):
         '''
         Sends the request and receives the response
         After this method finishes, response data will be available
         '''
+        resp = self.response_for(data)
+        if resp is None:
+            resp = self._conn.request(**self.request_args(data, headers))
+        self.receive(resp)
+
+    def response_for(self, data):
+        '''The response to sending `data`, if already known (else None)'''
+        return None
+
+    def request_args(self, data='', headers=None):
+        '''Arguments of Connection.request sending `data`'''
         data = str(data)
-        resp = None
+        args = {'resource': self._resource, 'method': self._method.lower(),
+                'headers': headers}
         if self._method == 'GET':
-            resp = self._conn.request_get(resource=self._resource,
-                                          args={'data': data},
-                                          headers=headers)
-        elif self._method == 'DELETE':
-            resp = self._conn.request_delete(resource=self._resource,
-                                             body=data,
-                                             headers=headers)
-        elif self._method == 'HEAD':
-            resp = self._conn.request_head(resource=self._resource,
-                                           headers=headers)
-        elif self._method == 'POST':
-            resp = self._conn.request_post(resource=self._resource,
-                                           body=data,
-                                           headers=headers)
-        elif self._method == 'PUT':
-            resp = self._conn.request_put(resource=self._resource,
-                                          body=data,
-                                          headers=headers)
-        else:
+            args['args'] = {'data': data}
+        elif self._method in ('DELETE', 'POST', 'PUT'):
+            args['body'] = data
+        elif self._method != 'HEAD':
             raise UndefinedMethodError()
+        return args
 
+    def receive(self, resp):
+        '''Takes the response (as returned by Connection.request)'''
         # Set response data
         self.response_headers = resp['headers']
 
@@ -88,6 +115,24 @@ class Conversation:
         return self.__repr__()
 
 
+class PrefetchedConversation(Conversation):
+    '''
+    A Conversation whose responses to some data were received beforehand
+    (e.g. as part of a batched request). Sending other data makes a request.
+    '''
+
+    def __init__(self, conn, method, resource, responses):
+        Conversation.__init__(self, conn, method, resource)
+        self._responses = dict((str(data), resp)
+                               for data, resp in responses.items())
+
+    def response_for(self, data):
+        resp = self._responses.get(str(data))
+        if resp is not None:
+            self.prefetched = True
+        return resp
+
+
 class UndefinedMethodError(Exception):
     def __str__(self):
         return "Undefined HTTP method. Try on of: GET, POST, PUT, HEAD, DELETE"
@@ -0,0 +1,248 @@
+'''
+Write-ahead journal of the local CRs of a pad that the server has not
+acknowledged yet, so that they survive a crash (of the editor or of the
+connection) and are replayed once the pad is joined again.
+
+The journal of a pad is an append-only file of records, each one a list of
+fields (see EncodingHandler.encode_fields), itself length-prefixed:
+    'C', cr_n, CRs, sent - checkpoint: the CRs not acknowledged as of cr_n,
+        the first `sent` of which were sent to the server (they may have
+        been committed without the session knowing)
+    'A', CRs - CRs edited after those of the previous records
+CRs are in the compact wire format. The CRs of the last checkpoint and of the
+records after it apply, in order, over the text of the pad at its cr_n; a
+record cut short by a crash is ignored. Once no CR is pending, the file is
+truncated.
+
+Records are flushed as soon as written, but synced to disk (fsync) at most
+every `fsync_interval` seconds, from a timer thread, so that edits never wait
+for the disk.
+'''
+
+import hashlib
+import os
+import sys
+import threading
+
+
+st_version = 2 if sys.version_info < (3,) else 3
+
+if st_version == 3:
+    from .changerequests import EncodingHandler
+elif st_version == 2:
+    from changerequests import EncodingHandler
+
+
+class Journal(object):
+    '''Journal of the unacknowledged CRs of a pad (see open)'''
+
+    # Size past which a checkpoint rewrites the file instead of appending
+    MAX_SIZE = 1024 * 1024
+
+    # Paths of the journals open in this process
+    _open = set()
+    _open_lock = threading.Lock()
+
+    def __init__(self, path, fsync_interval=0.2):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.cr_n = None  # Of the last checkpoint, None while empty
+        self._file = None
+        self._size = 0
+        self._timer = None  # Pending fsync
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def open(directory, url, pad, fsync_interval=0.2):
+        '''
+        Returns the journal of a pad on a server, or None if another session
+        of this process already keeps it
+        '''
+        key = (url + '\n' + pad).encode('UTF-8')
+        path = os.path.join(directory,
+                            hashlib.sha1(key).hexdigest() + '.journal')
+        with Journal._open_lock:
+            if path in Journal._open:
+                return None
+            Journal._open.add(path)
+        return Journal(path, fsync_interval)
+
+    def close(self):
+        with self._lock:
+            self._close()
+        with Journal._open_lock:
+            Journal._open.discard(self.path)
+
+    def load(self):
+        '''
+        Returns (cr_n, CRs, sent) of the CRs left pending by the last session
+        of the pad (see checkpoint), or None if there are none
+        '''
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read().decode('UTF-8', 'ignore')
+        except (IOError, OSError):
+            return None
+
+        cr_n, crs, sent = None, [], 0
+        i = 0
+        while i < len(data):
+            try:
+                j = data.index(':', i)
+                end = j + 1 + int(data[i:j], 36)
+                if end > len(data):
+                    raise ValueError('Truncated record')
+                fields = EncodingHandler.decode_fields(data[j + 1:end])
+                if fields[0] == 'C':
+                    cr_n = int(fields[1])
+                    crs = EncodingHandler.decode_crs(fields[2])
+                    sent = int(fields[3])
+                elif fields[0] == 'A' and cr_n is not None:
+                    crs += EncodingHandler.decode_crs(fields[1])
+                else:
+                    raise ValueError('Unknown record ' + fields[0])
+            except (ValueError, IndexError) as e:
+                print('Ignoring the end of the journal', self.path, e)
+                break
+            i = end
+        if cr_n is None or not crs:
+            return None
+        return cr_n, crs, sent
+
+    def append(self, cr_n, crs):
+        '''
+        Records CRs edited locally after the ones already journaled (over the
+        text of the pad at cr_n, if there are none)
+        '''
+        with self._lock:
+            if self.cr_n is None:
+                self._write(self._record('C', cr_n, crs, 0))
+                self.cr_n = cr_n
+            else:
+                self._write(self._record('A', None, crs))
+
+    def checkpoint(self, cr_n, crs, sent=0):
+        '''
+        Records that the CRs not acknowledged as of cr_n are `crs` (applying
+        over the text of the pad at cr_n), the first `sent` of them being on
+        their way to the server. Truncates the journal if there are none.
+        '''
+        with self._lock:
+            record = self._record('C', cr_n, crs, sent)
+            if not crs:
+                self._truncate()
+            elif self.cr_n is None or self._size >= Journal.MAX_SIZE:
+                # Also drops what an earlier session left (maybe torn)
+                self._rewrite(record)
+            else:
+                self._write(record)
+            self.cr_n = cr_n if crs else None
+
+    def clear(self):
+        '''Forgets all the journaled CRs'''
+        with self._lock:
+            self._truncate()
+            self.cr_n = None
+
+    def sync(self):
+        '''Syncs the records written so far to disk'''
+        with self._lock:
+            self._timer = None
+            if self._file is not None:
+                try:
+                    os.fsync(self._file.fileno())
+                except (IOError, OSError) as e:
+                    print('Unable to sync the journal', self.path, e)
+
+    @staticmethod
+    def _record(kind, cr_n, crs, sent=None):
+        fields = [kind] if cr_n is None else [kind, str(cr_n)]
+        fields.append(EncodingHandler.encode_crs(
+            crs, EncodingHandler.COMPACT_FORMAT))
+        if sent is not None:
+            fields.append(str(sent))
+        return EncodingHandler.encode_fields(
+            [EncodingHandler.encode_fields(fields)]).encode('UTF-8')
+
+    def _write(self, record):
+        try:
+            if self._file is None:
+                directory = os.path.dirname(self.path)
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                self._file = open(self.path, 'ab')
+                self._size = os.fstat(self._file.fileno()).st_size
+            self._file.write(record)
+            self._file.flush()
+        except (IOError, OSError) as e:
+            print('Unable to write the journal', self.path, e)
+            self._close()
+            return
+        self._size += len(record)
+        self._written()
+
+    def _written(self):
+        '''Has the records written synced, now or soon'''
+        if self.fsync_interval <= 0:
+            try:
+                os.fsync(self._file.fileno())
+            except (IOError, OSError) as e:
+                print('Unable to sync the journal', self.path, e)
+        elif self._timer is None:
+            self._timer = threading.Timer(self.fsync_interval, self.sync)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _truncate(self):
+        if self._file is None:
+            if not os.path.exists(self.path):
+                return
+            try:
+                self._file = open(self.path, 'ab')
+                self._size = os.fstat(self._file.fileno()).st_size
+            except (IOError, OSError) as e:
+                print('Unable to truncate the journal', self.path, e)
+                return
+        if not self._size:
+            return
+        try:
+            self._file.truncate(0)
+        except (IOError, OSError) as e:
+            print('Unable to truncate the journal', self.path, e)
+            return
+        self._size = 0
+        self._written()
+
+    def _rewrite(self, record):
+        '''Replaces the journal with a single record'''
+        self._close()
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(record)
+                f.flush()
+                os.fsync(f.fileno())
+            if hasattr(os, 'replace'):
+                os.replace(tmp_path, self.path)
+            else:
+                # rename can't overwrite on Windows
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            print('Unable to rewrite the journal', self.path, e)
+            # The records appended so far still stand
+            self._write(record)
+
+    def _close(self):
+        if self._file is not None:
+            try:
+                if self._timer is not None:
+                    os.fsync(self._file.fileno())
+                self._file.close()
+            except (IOError, OSError):
+                pass
+            self._file = None
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
@@ -0,0 +1,192 @@
+'''
+Metrics - latency and throughput instrumentation of the sync pipeline.
+
+Every CR carries a Trace: the times it reached the stages of the pipeline
+(the CRs of a CRBatch share one).
+Local CRs go through
+    captured -> enqueued -> dequeued -> sent -> received -> applied
+and remote ones through
+    received -> applied -> rendered
+The time taken by each step is kept, per session, in a rolling histogram,
+along with request latencies, queue depths and counters. Raw events can also
+be appended to a file (one JSON object per line) for offline analysis.
+'''
+
+import json
+import threading
+import time
+from collections import deque
+
+
+LOCAL_STAGES = ('captured', 'enqueued', 'dequeued', 'sent', 'received',
+                'applied')
+REMOTE_STAGES = ('received', 'applied', 'rendered')
+
+
+class Trace(object):
+    '''Stages reached by `count` CRs, as a list of (stage, time)'''
+    __slots__ = ('id', 'stages', 'count')
+
+    def __init__(self, id, count=1):
+        self.id = id
+        self.count = count
+        self.stages = []
+
+
+class RollingHistogram(object):
+    '''The last `size` samples of a quantity, and their percentiles'''
+
+    def __init__(self, size=1000):
+        self.samples = deque(maxlen=size)
+        self.count = 0  # All samples ever added
+
+    def add(self, value):
+        self.samples.append(value)
+        self.count += 1
+
+    def percentiles(self, *ps):
+        '''Returns the given percentiles (0-100) of the samples in window'''
+        ordered = sorted(self.samples)
+        if not ordered:
+            return [0] * len(ps)
+        last = len(ordered) - 1
+        return [ordered[min(last, int(round(p / 100.0 * last)))] for p in ps]
+
+    def summary(self):
+        p50, p90, p99, top = self.percentiles(50, 90, 99, 100)
+        return {'count': self.count, 'p50': p50, 'p90': p90, 'p99': p99,
+                'max': top}
+
+
+class EventLog(object):
+    '''Appends raw metric events to a file, one JSON object per line'''
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+
+    def write(self, event):
+        line = json.dumps(event, sort_keys=True) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+
+class SessionMetrics(object):
+    '''
+    Metrics of one session.
+
+    @name:
+        Name of the session (the pad), tagging its logged events
+    @log:
+        EventLog receiving the raw events, if any
+    @window:
+        Number of samples the rolling histograms keep
+    '''
+
+    def __init__(self, name, log=None, window=1000):
+        self.name = name
+        self.log = log
+        self.window = window
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}  # Durations in seconds, depths in messages
+        self._lock = threading.Lock()
+        self._next_id = 0
+
+    def _histogram(self, key):
+        if key not in self.histograms:
+            self.histograms[key] = RollingHistogram(self.window)
+        return self.histograms[key]
+
+    def stamp(self, crs, stage):
+        '''
+        Records that the CRs reached a stage of the pipeline. A CRBatch is
+        traced as a whole.
+        '''
+        now = time.time()
+        with self._lock:
+            if hasattr(crs, 'trace'):
+                self._stamp(crs, stage, now, len(crs))
+            else:
+                for cr in crs:
+                    self._stamp(cr, stage, now)
+
+    def _stamp(self, traced, stage, now, batch=None):
+        '''Stamps a CR, or a batch of `batch` CRs'''
+        trace = traced.trace
+        if trace is None:
+            trace = traced.trace = Trace(self._next_id, batch or 1)
+            self._next_id += 1
+        elif trace.stages and trace.stages[-1][0] == stage:
+            # Pieces of a CR split by a transformation (or CRs of a batch)
+            return
+        stages = trace.stages
+        first = stages[0][0] if stages else stage
+        flow = 'local' if first == 'captured' else 'remote'
+        if stages:
+            self._histogram(flow + ' ' + stage).add(now - stages[-1][1])
+        stages.append((stage, now))
+        if stage == (LOCAL_STAGES if flow == 'local'
+                     else REMOTE_STAGES)[-1]:
+            self._histogram(flow + ' total').add(now - stages[0][1])
+            self._count(flow + ' crs', trace.count)
+        if self.log:
+            event = {'t': now, 'pad': self.name, 'event': stage,
+                     'cr': trace.id}
+            if batch is None:
+                event.update(author=traced.author, pos=traced.pos,
+                             delta=traced.delta, op=traced.op)
+            else:
+                event['crs'] = batch
+            self.log.write(event)
+
+    def request(self, kind, seconds, code):
+        '''Records a request to the server and how long it took'''
+        with self._lock:
+            self._histogram(kind + ' request').add(seconds)
+            self._count(kind + ' requests')
+            if self.log:
+                self.log.write({'t': time.time(), 'pad': self.name,
+                                'event': 'request', 'kind': kind,
+                                'seconds': seconds, 'code': code})
+
+    def gauge(self, name, value):
+        '''Samples a quantity, e.g. the depth of the queue'''
+        with self._lock:
+            self._histogram(name).add(value)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self._count(name, n)
+
+    def _count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self, extra=None):
+        '''
+        Returns a human readable summary of the metrics, listing the `extra`
+        dict of values too
+        '''
+        with self._lock:
+            elapsed = max(time.time() - self.started, 1e-6)
+            lines = ['Pad "%s" (%.0f s)' % (self.name, elapsed)]
+            for name in sorted(self.counters):
+                count = self.counters[name]
+                lines.append('  %-24s %8d  (%.2f/s)' %
+                             (name, count, count / elapsed))
+            for name in sorted(extra or {}):
+                lines.append('  %-24s %8s' % (name, extra[name]))
+            for key in sorted(self.histograms):
+                s = self.histograms[key].summary()
+                if key == 'queue depth':
+                    fmt = '  %-24s %8d  p50 %g  p90 %g  p99 %g  max %g'
+                    values = (s['p50'], s['p90'], s['p99'], s['max'])
+                else:
+                    fmt = '  %-24s %8d  p50 %.1f  p90 %.1f  p99 %.1f  ' + \
+                        'max %.1f ms'
+                    values = tuple(s[p] * 1000
+                                   for p in ('p50', 'p90', 'p99', 'max'))
+                lines.append(fmt % ((key, s['count']) + values))
+        return '\n'.join(lines)
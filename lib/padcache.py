@@ -0,0 +1,101 @@
+'''
+On-disk cache of pad texts, so that rejoining a pad only fetches the CRs
+committed since this machine last saw it.
+
+Entries are keyed by server URL and pad name and hold the text of the pad
+together with the last acknowledged cr_n and a hash of the text. The cache is
+bounded in size: the least recently used entries are evicted first.
+'''
+
+import hashlib
+import os
+import threading
+
+
+class PadCache(object):
+    '''Size-bounded (LRU) directory of cached pads'''
+
+    VERSION = '1'
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def _path(self, url, pad):
+        key = (url + '\n' + pad).encode('UTF-8')
+        return os.path.join(self.directory,
+                            hashlib.sha1(key).hexdigest() + '.pad')
+
+    def load(self, url, pad):
+        '''
+        Returns (cr_n, text) of the cached pad, or None if it is not cached
+        or the entry is damaged (in which case it is dropped)
+        '''
+        path = self._path(url, pad)
+        try:
+            with open(path, 'rb') as f:
+                header = f.readline().decode('ascii').split()
+                data = f.read()
+        except (IOError, OSError, UnicodeDecodeError):
+            return None
+
+        if len(header) != 3 or header[0] != PadCache.VERSION or \
+                hashlib.sha1(data).hexdigest() != header[2]:
+            print('Dropping damaged cache entry for pad', pad)
+            self._remove(path)
+            return None
+        try:
+            os.utime(path, None)  # Most recently used
+        except OSError:
+            pass
+        return int(header[1]), data.decode('UTF-8')
+
+    def store(self, url, pad, cr_n, text):
+        '''Caches the text of a pad at cr_n'''
+        data = text.encode('UTF-8')
+        header = ' '.join((PadCache.VERSION, str(cr_n),
+                           hashlib.sha1(data).hexdigest())) + '\n'
+        path = self._path(url, pad)
+        tmp_path = path + '.tmp' + str(threading.current_thread().ident)
+        with self._lock:
+            try:
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+                with open(tmp_path, 'wb') as f:
+                    f.write(header.encode('ascii'))
+                    f.write(data)
+                # Replace the old entry (rename can't overwrite on Windows)
+                self._remove(path)
+                os.rename(tmp_path, path)
+            except (IOError, OSError) as e:
+                print('Unable to cache pad', pad, e)
+                self._remove(tmp_path)
+                return
+            self._evict()
+
+    def _evict(self):
+        '''Removes least recently used entries until the cache fits'''
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.pad'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum([size for _, size, _ in entries])
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
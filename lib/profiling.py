@@ -0,0 +1,176 @@
+'''
+Profiling of the sync threads from inside the editor, where no profiler can be
+attached to them. Started and stopped by the "Together: Start/Stop profiling"
+command, in one of two modes:
+    sample - a sampler thread records the stacks of the sync threads every
+             `interval` seconds; cheap, and sees whole threads (waits too)
+    cprofile - the calls of the functions decorated with @profiled (the
+               bodies of the run loops of the sync threads and the send
+               path) run under cProfile, one profile per thread
+Once stopped, the results are dumped to a directory:
+    together-<time>.collapsed - the sampled stacks, one per line, root
+        first: 'thread;function (file:line);... count', as read by
+        flamegraph.pl or speedscope
+    together-<time>-<thread>.pstats - the profile of each thread (see pstats)
+While no profiler runs, a decorated call only costs a global lookup.
+'''
+
+import cProfile
+import functools
+import os
+import re
+import sys
+import threading
+import time
+
+
+# Name prefixes of the threads the sampler records
+SYNC_THREADS = ('ChangesConsumer', 'UpdateScheduler', 'SyncWorker',
+                'AsyncTransport', 'StreamReader')
+
+# The running Profiler, if any
+_active = None
+
+
+def active_profiler():
+    '''Returns the running Profiler, or None'''
+    return _active
+
+
+def profiled(func):
+    '''Decorator having the calls of func profiled in the cprofile mode'''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        profiler = _active
+        if profiler is None or profiler.mode != 'cprofile':
+            return func(*args, **kwargs)
+        return profiler.call(func, args, kwargs)
+    return wrapper
+
+
+class Profiler(object):
+    '''A profiling run of the sync threads (see the module docstring)'''
+
+    MODES = ('sample', 'cprofile')
+
+    def __init__(self, mode='sample', interval=0.005, threads=SYNC_THREADS):
+        if mode not in Profiler.MODES:
+            raise ValueError('Unknown profiling mode ' + str(mode))
+        self.mode = mode
+        self.interval = interval
+        self.threads = tuple(threads)
+        self.started = None
+        self.stopped = None
+        self.samples = 0
+        self.stacks = {}  # Collapsed stack: times sampled
+        self._profiles = {}  # Thread ident: (thread name, cProfile.Profile)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def start(self):
+        global _active
+        if _active is not None:
+            raise RuntimeError('Already profiling')
+        self.started = time.time()
+        if self.mode == 'sample':
+            self._sampler = threading.Thread(target=self._sample,
+                                             name='ProfileSampler')
+            self._sampler.daemon = True
+            self._sampler.start()
+        _active = self
+
+    def stop(self):
+        global _active
+        if _active is self:
+            _active = None
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        self.stopped = time.time()
+
+    def call(self, func, args, kwargs):
+        '''Calls func under the profile of the current thread'''
+        local = self._local
+        if getattr(local, 'inside', False):
+            # Already counted by the outer profiled call
+            return func(*args, **kwargs)
+        profile = self._profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is active (since Python 3.12, cProfile
+            # profiles one thread at a time)
+            return func(*args, **kwargs)
+        local.inside = True
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+            local.inside = False
+
+    def _profile(self):
+        thread = threading.current_thread()
+        with self._lock:
+            entry = self._profiles.get(thread.ident)
+            if entry is None:
+                entry = self._profiles[thread.ident] = \
+                    (thread.name, cProfile.Profile())
+        return entry[1]
+
+    def _sample(self):
+        '''Body of the sampler thread'''
+        me = threading.current_thread().ident
+        while True:
+            self._stop.wait(self.interval)
+            if self._stop.is_set():
+                break
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                name = names.get(ident)
+                if ident != me and name and name.startswith(self.threads):
+                    self._record(name, frame)
+            self.samples += 1
+
+    def _record(self, name, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s (%s:%d)' % (code.co_name,
+                                         os.path.basename(code.co_filename),
+                                         code.co_firstlineno))
+            frame = frame.f_back
+        stack.append(name.replace(';', ':'))
+        key = ';'.join(reversed(stack))
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def dump(self, directory):
+        '''Writes the results to directory. Returns the paths written.'''
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        prefix = os.path.join(directory, 'together-' + time.strftime(
+            '%Y%m%d-%H%M%S', time.localtime(self.started)))
+        paths = []
+        if self.stacks:
+            path = prefix + '.collapsed'
+            with open(path, 'w') as f:
+                for stack, count in sorted(self.stacks.items()):
+                    f.write('%s %d\n' % (stack, count))
+            paths.append(path)
+        with self._lock:
+            profiles = sorted(self._profiles.items())
+        for ident, (name, profile) in profiles:
+            path = '%s-%s-%d.pstats' % (prefix, re.sub(r'\W', '_', name),
+                                        ident)
+            profile.dump_stats(path)
+            paths.append(path)
+        return paths
+
+    def summary(self):
+        '''One line about the run'''
+        seconds = (self.stopped or time.time()) - self.started
+        if self.mode == 'sample':
+            return 'Profiled %.1fs: %d samples of %d stacks' % (
+                seconds, self.samples, len(self.stacks))
+        return 'Profiled %.1fs: %d threads' % (seconds, len(self._profiles))
@@ -25,7 +25,11 @@ __author__ = "Benjamin O'Steen <bosteen@gmail.com>"
 __version__ = '0.1'
 
 
+import socket
 import sys
+import time
+import zlib
+from threading import BoundedSemaphore, Lock
 
 
 st_version = 2 if sys.version_info < (3,) else 3
@@ -33,15 +37,35 @@ st_version = 2 if sys.version_info < (3,) else 3
 if st_version == 3:
     import http.client as httplib
     import urllib.parse as urlparse
+    from urllib.parse import urlencode
 elif st_version == 2:
     import httplib
     import urlparse
-
-import urllib
+    from urllib import urlencode
 
 
 class Connection:
-    def __init__(self, base_url):
+    '''
+    Thread-safe pool of persistent (keep-alive) HTTP connections to one server.
+
+    At most `pool_size` requests are in flight at once, each on its own
+    connection; idle connections are reused by the next request. A request
+    that fails on a broken socket is retried on a fresh connection up to
+    `retries` times, waiting `backoff`, 2 * `backoff`, 4 * `backoff`...
+    seconds in between. A request that may have been processed already is
+    only retried if it is idempotent, or if the keep-alive connection it was
+    written to turned out to be stale (closed without a byte of response).
+
+    With `compression` on, responses may come gzip or deflate encoded, and
+    request bodies of at least `compress_min_size` bytes are sent gzipped
+    once the server has listed gzip in an Accept-Encoding response header.
+    '''
+
+    # Safe to re-send even if the server may have processed them already
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'DELETE')
+
+    def __init__(self, base_url, pool_size=4, retries=3, backoff=0.1,
+                 timeout=None, compression=True, compress_min_size=1024):
         self.base_url = base_url
 
         self.url = urlparse.urlparse(base_url)
@@ -52,32 +76,92 @@ class Connection:
         self.host = netloc
         self.path = path
 
-        self.h = httplib.HTTPConnection(netloc, strict=False)
-        self.h.follow_all_redirects = True
-
-    def request_get(self, resource, args=None, headers={}):
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._idle = []  # Connections ready to be reused (LIFO)
+        self._idle_lock = Lock()
+        self._slots = BoundedSemaphore(pool_size)
+        self.compression = compression
+        self.compress_min_size = compress_min_size
+        self._server_gzip = False  # Server accepts gzipped request bodies
+
+    def _new_connection(self):
+        if st_version == 2:
+            return httplib.HTTPConnection(self.host, strict=False,
+                                          timeout=self.timeout)
+        return httplib.HTTPConnection(self.host, timeout=self.timeout)
+
+    def _checkout(self):
+        '''Returns (connection, reused) - a free slot must be held'''
+        with self._idle_lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return self._new_connection(), False
+
+    def _checkin(self, h):
+        with self._idle_lock:
+            self._idle.append(h)
+
+    def encode_body(self, body, headers):
+        '''Gzips the body, if worth it and the server accepts it'''
+        if not (self.compression and self._server_gzip) or \
+                len(body) < self.compress_min_size:
+            return body
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compressed = compressor.compress(body) + compressor.flush()
+        if len(compressed) >= len(body):
+            return body
+        headers['Content-Encoding'] = 'gzip'
+        headers['Content-Length'] = str(len(compressed))
+        return compressed
+
+    def _decode_body(self, headers, data):
+        '''Undoes the content encoding of a response body'''
+        if not self.compression:
+            return data
+        advertised = headers.get('accept-encoding', '')
+        if 'gzip' in advertised.lower():
+            self._server_gzip = True
+        encoding = headers.get('content-encoding', '').strip().lower()
+        if encoding in ('gzip', 'x-gzip'):
+            return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        if encoding == 'deflate':
+            try:
+                return zlib.decompress(data)
+            except zlib.error:
+                # Some servers send raw deflate data, without zlib header
+                return zlib.decompress(data, -zlib.MAX_WBITS)
+        return data
+
+    def request_get(self, resource, args=None, headers=None):
         return self.request(resource, "get", args, headers=headers)
 
-    def request_delete(self, resource, args=None, headers={}):
+    def request_delete(self, resource, args=None, headers=None):
         return self.request(resource, "delete", args, headers=headers)
 
-    def request_head(self, resource, args=None, headers={}):
+    def request_head(self, resource, args=None, headers=None):
         return self.request(resource, "head", args, headers=headers)
 
-    def request_post(self, resource, args=None, body=None, headers={}):
+    def request_post(self, resource, args=None, body=None, headers=None):
         return self.request(resource, "post", args, body=body, headers=headers)
 
-    def request_put(self, resource, args=None, body=None, headers={}):
+    def request_put(self, resource, args=None, body=None, headers=None):
         return self.request(resource, "put", args, body=body, headers=headers)
 
-    def request(self, resource, method="get", args=None, body=None, headers={}):
+    def prepare_request(self, resource, method="get", args=None, body=None,
+                        headers=None):
+        '''
+        Returns the method, URL path, body (bytes) and headers of a request,
+        before content encoding (see encode_body)
+        '''
         path = resource
+        headers = dict(headers or {})
         headers['User-Agent'] = 'Basic Agent'
 
         if body:
             if not headers.get('Content-Type', None):
                 headers['Content-Type'] = 'text/xml'
-            headers['Content-Length'] = str(len(body))
         else:
             if 'Content-Length' in headers:
                 del headers['Content-Length']
@@ -85,13 +169,16 @@ class Connection:
             headers['Content-Type'] = 'text/plain'
 
             if args:
-                print('ARGS:', args)
-                print('ARGS(encoded):', urllib.urlencode(args))
                 if method == "get":
-                    path += u"?" + urllib.urlencode(args)
+                    path += u"?" + urlencode(args)
                 elif method == "put" or method == "post":
                     headers['Content-Type'] = 'application/x-www-form-urlencoded'
-                    body = urllib.urlencode(args)
+                    body = urlencode(args)
+
+        if body:
+            if not isinstance(body, bytes):
+                body = body.encode('UTF-8')
+            headers['Content-Length'] = str(len(body))
 
         request_path = []
         # Normalise the / in the url path
@@ -105,25 +192,71 @@ class Connection:
             else:
                 request_path.append(path)
 
-        self.h.set_debuglevel(0)
-
-        resp = None
-        # success = False
-        # while not success:
-        #     try:
         headers['Accept'] = '*/*'
-        # print('RESOURCE:', u'/'.join(request_path))
-        # print('BODY:', body)
-        # print('HEADERS:', headers)
-        self.h.request(method.upper(), u'/'.join(request_path), body=body, headers=headers)
-        print('SENT')
-        resp = self.h.getresponse()
-        print('resp: ', resp)
-
-            #     success = True
-            # except Exception:
-            #     print('Retry...')
+        if self.compression:
+            headers['Accept-Encoding'] = 'gzip, deflate'
+        return method.upper(), u'/'.join(request_path), body, headers
+
+    def read_response(self, header_items, data):
+        '''
+        Returns the response as {'headers', 'body'} (decoded), given its
+        (name, value) headers and its raw body
+        '''
+        data = self._decode_body(
+            dict((name.lower(), value) for name, value in header_items), data)
         headers = {}
-        for hdr in resp.getheaders():
+        for hdr in header_items:
             headers[hdr[0]] = hdr[1]
-        return {'headers': headers, 'body': resp.read().decode('UTF-8')}
+        return {'headers': headers, 'body': data.decode('UTF-8')}
+
+    def request(self, resource, method="get", args=None, body=None,
+                headers=None):
+        method, url, body, headers = self.prepare_request(
+            resource, method, args, body, headers)
+
+        attempt = 0
+        while True:
+            send_headers = dict(headers)
+            send_body = body and self.encode_body(body, send_headers)
+            self._slots.acquire()
+            h, reused = self._checkout()
+            sent = stale = False
+            try:
+                h.request(method, url, body=send_body, headers=send_headers)
+                sent = True
+                resp = h.getresponse()
+                # The whole body must be read before reusing the connection
+                data = resp.read()
+            except (socket.error, httplib.HTTPException) as e:
+                h.close()
+                # A request that reached the server is only repeated when it
+                # is harmless, or when it was written to a stale keep-alive
+                # connection: one the server had already dropped, closed
+                # before any response (not a timeout, the request may be
+                # under way)
+                stale = reused and (not sent or
+                                    isinstance(e, httplib.BadStatusLine))
+                retry = stale or not sent or \
+                    method in Connection.IDEMPOTENT_METHODS
+                if not retry or attempt >= self.retries:
+                    raise
+            else:
+                if resp.will_close:
+                    h.close()
+                else:
+                    self._checkin(h)
+                if resp.status == 415 and \
+                        'Content-Encoding' in send_headers:
+                    # The server does not take compressed bodies after all
+                    self._server_gzip = False
+                    continue
+                break
+            finally:
+                self._slots.release()
+            if stale:
+                # Just a stale connection, try another one right away
+                continue
+            time.sleep(self.backoff * (2 ** attempt))
+            attempt += 1
+
+        return self.read_response(resp.getheaders(), data)
@@ -0,0 +1,207 @@
+'''
+Rope - text buffer backed by a height-balanced (AVL) tree of text chunks.
+
+Inserting or deleting touches only the path from the root to the edited
+chunks, so edits cost O(log n) instead of the O(n) copying of a flat string.
+The flat text is built only when it is asked for (see Rope.flatten).
+'''
+
+
+class _Leaf(object):
+    __slots__ = ('text', 'length')
+    height = 0
+
+    def __init__(self, text):
+        self.text = text
+        self.length = len(text)
+
+
+class _Node(object):
+    __slots__ = ('left', 'right', 'length', 'height')
+
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+        self.length = left.length + right.length
+        self.height = 1 + max(left.height, right.height)
+
+
+def _rotate_left(t):
+    r = t.right
+    return _Node(_Node(t.left, r.left), r.right)
+
+
+def _rotate_right(t):
+    l = t.left
+    return _Node(l.left, _Node(l.right, t.right))
+
+
+def _join_right(tl, tr):
+    '''Joins two trees, where tl is at least two levels taller than tr'''
+    l, c = tl.left, tl.right
+    if c.height <= tr.height + 1:
+        t = _Node(c, tr)
+        if t.height <= l.height + 1:
+            return _Node(l, t)
+        return _rotate_left(_Node(l, _rotate_right(t)))
+    t = _join_right(c, tr)
+    if t.height <= l.height + 1:
+        return _Node(l, t)
+    return _rotate_left(_Node(l, t))
+
+
+def _join_left(tl, tr):
+    '''Joins two trees, where tr is at least two levels taller than tl'''
+    c, r = tr.left, tr.right
+    if c.height <= tl.height + 1:
+        t = _Node(tl, c)
+        if t.height <= r.height + 1:
+            return _Node(t, r)
+        return _rotate_right(_Node(_rotate_left(t), r))
+    t = _join_left(tl, c)
+    if t.height <= r.height + 1:
+        return _Node(t, r)
+    return _rotate_right(_Node(t, r))
+
+
+def _join(l, r, leaf_size):
+    if l is None:
+        return r
+    if r is None:
+        return l
+    if l.height == 0 and r.height == 0 and l.length + r.length <= leaf_size:
+        # Keep small chunks together
+        return _Leaf(l.text + r.text)
+    if l.height > r.height + 1:
+        return _join_right(l, r)
+    if r.height > l.height + 1:
+        return _join_left(l, r)
+    return _Node(l, r)
+
+
+def _split(t, i, leaf_size):
+    '''Splits the tree at offset i into two trees (either may be None)'''
+    if t is None:
+        return None, None
+    if t.height == 0:
+        head, tail = t.text[:i], t.text[i:]
+        return (_Leaf(head) if head else None), (_Leaf(tail) if tail else None)
+    left_len = t.left.length
+    if i < left_len:
+        ll, lr = _split(t.left, i, leaf_size)
+        return ll, _join(lr, t.right, leaf_size)
+    elif i > left_len:
+        rl, rr = _split(t.right, i - left_len, leaf_size)
+        return _join(t.left, rl, leaf_size), rr
+    return t.left, t.right
+
+
+def _insert_in_leaf(t, i, text, leaf_size):
+    '''
+    Inserts text by rebuilding only the leaf holding offset i, if that leaf
+    has room for it. Returns None when it does not.
+    '''
+    if t.height == 0:
+        if t.length + len(text) > leaf_size:
+            return None
+        return _Leaf(t.text[:i] + text + t.text[i:])
+    left_len = t.left.length
+    if i <= left_len:
+        left = _insert_in_leaf(t.left, i, text, leaf_size)
+        return left and _Node(left, t.right)
+    right = _insert_in_leaf(t.right, i - left_len, text, leaf_size)
+    return right and _Node(t.left, right)
+
+
+def _build(text, start, end, leaf_size):
+    '''Builds a perfectly balanced tree from text[start:end]'''
+    if end - start <= leaf_size:
+        return _Leaf(text[start:end])
+    # Split on a chunk boundary so that leaves stay full
+    chunks = (end - start + leaf_size - 1) // leaf_size
+    mid = start + (chunks // 2) * leaf_size
+    return _Node(_build(text, start, mid, leaf_size),
+                 _build(text, mid, end, leaf_size))
+
+
+def _collect(t, start, end, out):
+    '''Appends to out the pieces of text covering [start, end) of t'''
+    while t.height != 0:
+        left_len = t.left.length
+        if end <= left_len:
+            t = t.left
+        elif start >= left_len:
+            start -= left_len
+            end -= left_len
+            t = t.right
+        else:
+            _collect(t.left, start, left_len, out)
+            start, end, t = 0, end - left_len, t.right
+    out.append(t.text[start:end])
+
+
+class Rope(object):
+    '''
+    Mutable text buffer with O(log n) insert and delete.
+
+    Besides Rope, any object providing insert(pos, text), delete(pos, length),
+    flatten() and len() can back a Session (see ChangeRequest.apply_over).
+    '''
+
+    def __init__(self, text='', leaf_size=2048):
+        self.leaf_size = leaf_size
+        self._root = _build(text, 0, len(text), leaf_size) if text else None
+        self._flat = text
+
+    def __len__(self):
+        return self._root.length if self._root is not None else 0
+
+    def insert(self, pos, text):
+        '''Inserts text at pos'''
+        if not text:
+            return
+        pos = max(0, min(pos, len(self)))
+        self._flat = None
+        if self._root is None:
+            self._root = _build(text, 0, len(text), self.leaf_size)
+            return
+        root = None
+        if len(text) <= self.leaf_size:
+            root = _insert_in_leaf(self._root, pos, text, self.leaf_size)
+        if root is None:
+            head, tail = _split(self._root, pos, self.leaf_size)
+            middle = _build(text, 0, len(text), self.leaf_size)
+            root = _join(_join(head, middle, self.leaf_size), tail,
+                         self.leaf_size)
+        self._root = root
+
+    def delete(self, pos, length):
+        '''Deletes length characters starting at pos'''
+        pos = max(0, pos)
+        length = min(length, len(self) - pos)
+        if length <= 0:
+            return
+        self._flat = None
+        head, rest = _split(self._root, pos, self.leaf_size)
+        _, tail = _split(rest, length, self.leaf_size)
+        self._root = _join(head, tail, self.leaf_size)
+
+    def substr(self, start, end):
+        '''Returns the text between start and end'''
+        start, end = max(0, start), min(end, len(self))
+        if start >= end:
+            return ''
+        if self._flat is not None:
+            return self._flat[start:end]
+        out = []
+        _collect(self._root, start, end, out)
+        return ''.join(out)
+
+    def flatten(self):
+        '''Returns the whole text as a string (cached until the next edit)'''
+        if self._flat is None:
+            self._flat = self.substr(0, len(self))
+        return self._flat
+
+    def __repr__(self):
+        return 'Rope(' + str(len(self)) + ' chars)'
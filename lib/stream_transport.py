@@ -0,0 +1,210 @@
+'''
+Stream transport - a persistent TCP connection to the server, instead of an
+HTTP request per message.
+
+Messages travel as frames: a 4 byte big-endian length, then as many bytes of
+UTF-8 text made of length-prefixed fields (see EncodingHandler.encode_fields):
+    request:  'req', id, method, resource, data, header name, value...
+    response: 'resp', id, body, header name, value...
+    push:     'push', pad, cr_n, new_cr_n, wire format, CRs
+Requests may be answered in any order (they are matched by id), so several
+can be in flight at once, from any thread. Once a pad is subscribed to (SUB
+request), the server pushes the CRs committed to it as soon as they are: the
+ones after cr_n, up to new_cr_n.
+'''
+
+import socket
+import struct
+import sys
+import time
+from threading import Event, Lock, Thread
+
+
+st_version = 2 if sys.version_info < (3,) else 3
+
+if st_version == 3:
+    from urllib.parse import urlsplit
+    from .changerequests import EncodingHandler
+elif st_version == 2:
+    from urlparse import urlsplit
+    from changerequests import EncodingHandler
+
+
+DEFAULT_PORT = 8001
+
+
+class NotSentError(socket.error):
+    '''The request surely did not reach the server'''
+
+
+def _text(value):
+    '''Unicode text of a field'''
+    if isinstance(value, bytes):
+        return value.decode('UTF-8')
+    return value
+
+
+class StreamConnection(object):
+    '''
+    Connection to the stream endpoint of a server (tcp://host:port), with the
+    request() of restful_lib.Connection. It is opened on first use and again
+    once broken, renewing the subscriptions. A failed request is retried up
+    to `retries` times, waiting `backoff`, 2 * `backoff`... seconds in
+    between, unless it may have reached the server and is not idempotent.
+
+    @on_push:
+        Called with (pad, cr_n, new_cr_n, wire format, CRs) for every push,
+        on the thread reading the connection
+    @on_reconnect:
+        Called once the connection was opened again (pushes may have been
+        missed meanwhile)
+    '''
+
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'DELETE', 'SUB')
+
+    def __init__(self, url, timeout=None, retries=3, backoff=0.1,
+                 on_push=None, on_reconnect=None):
+        scheme, netloc, _, _, _ = urlsplit(url)
+        host, _, port = netloc.partition(':')
+        self.scheme = scheme
+        self.host = netloc
+        self.address = (host, int(port or DEFAULT_PORT))
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.on_push = on_push
+        self.on_reconnect = on_reconnect
+        self.subscriptions = {}  # Pad: headers of its SUB request
+        self._sock = None
+        self._opened = 0  # Times the connection was opened
+        self._pending = {}  # Request id: [Event, response]
+        self._next_id = 1
+        self._lock = Lock()  # Guards the above
+        self._send_lock = Lock()
+
+    def connect(self):
+        '''Opens the connection, unless open. Raises socket.error on failure'''
+        with self._lock:
+            if self._sock is not None:
+                return
+            sock = socket.create_connection(self.address, self.timeout)
+            sock.settimeout(None)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._sock = sock
+            self._opened += 1
+            reopened = self._opened > 1
+            subscriptions = list(self.subscriptions.items())
+        reader = Thread(target=self._read, args=(sock,),
+                        name='StreamReader')
+        reader.daemon = True
+        reader.start()
+        if reopened:
+            for pad, headers in subscriptions:
+                self._call('SUB', pad, '', headers)
+            if self.on_reconnect:
+                self.on_reconnect()
+
+    def request(self, resource, method='get', args=None, body=None,
+                headers=None):
+        method = method.upper()
+        data = body if body is not None else (args or {}).get('data', '')
+        attempt = 0
+        while True:
+            try:
+                self.connect()
+                return self._call(method, resource, data, headers)
+            except socket.error as e:
+                retry = isinstance(e, NotSentError) or \
+                    method in self.IDEMPOTENT_METHODS
+                if not retry or attempt >= self.retries:
+                    raise
+            time.sleep(self.backoff * (2 ** attempt))
+            attempt += 1
+
+    def subscribe(self, pad, headers=None):
+        '''
+        Asks the server to push the CRs committed to the pad from now on.
+        Returns False if it could not be reached (the subscription is renewed
+        on reconnection anyway).
+        '''
+        self.subscriptions[pad] = headers
+        try:
+            self.request(pad, method='SUB', headers=headers)
+        except socket.error as e:
+            print('Unable to subscribe to ' + pad, e)
+            return False
+        return True
+
+    def _call(self, method, resource, data, headers):
+        '''Sends a request on the open connection and waits for its response'''
+        waiter = [Event(), None]
+        with self._lock:
+            sock = self._sock
+            if sock is None:
+                raise NotSentError('Not connected')
+            request_id = self._next_id
+            self._next_id += 1
+            self._pending[request_id] = waiter
+        fields = ['req', str(request_id), method, resource, str(data)]
+        for name, value in (headers or {}).items():
+            fields += [name, str(value)]
+        frame = EncodingHandler.encode_fields(
+            [_text(f) for f in fields]).encode('UTF-8')
+        try:
+            with self._send_lock:
+                sock.sendall(struct.pack('>I', len(frame)) + frame)
+        except socket.error as e:
+            # A frame cut short is dropped by the server
+            self._close(sock)
+            raise NotSentError(str(e))
+
+        waiter[0].wait(self.timeout)
+        if not waiter[0].is_set():
+            self._close(sock)
+            raise socket.timeout('No response from the server')
+        if waiter[1] is None:
+            raise socket.error('Connection lost')
+        return waiter[1]
+
+    def _read(self, sock):
+        '''Reads the frames coming from the server, until it disconnects'''
+        rfile = sock.makefile('rb')
+        try:
+            while True:
+                head = rfile.read(4)
+                if len(head) < 4:
+                    break
+                size = struct.unpack('>I', head)[0]
+                frame = rfile.read(size)
+                if len(frame) < size:
+                    break
+                fields = EncodingHandler.decode_fields(frame.decode('UTF-8'))
+                if fields[0] == 'resp':
+                    headers = dict(zip(fields[3::2], fields[4::2]))
+                    with self._lock:
+                        waiter = self._pending.pop(int(fields[1]), None)
+                    if waiter:
+                        waiter[1] = {'headers': headers, 'body': fields[2]}
+                        waiter[0].set()
+                elif fields[0] == 'push' and self.on_push:
+                    self.on_push(*fields[1:6])
+        except (socket.error, ValueError, IndexError) as e:
+            print('Stream connection broken:', e)
+        self._close(sock)
+
+    def _close(self, sock):
+        '''Closes the connection, failing the requests waiting on it'''
+        with self._lock:
+            if self._sock is not sock:
+                return
+            self._sock = None
+            pending = self._pending
+            self._pending = {}
+        for waiter in pending.values():
+            waiter[0].set()
+        try:
+            # Also wakes up the reader
+            sock.shutdown(socket.SHUT_RDWR)
+            sock.close()
+        except socket.error:
+            pass
@@ -0,0 +1,134 @@
+'''
+Textdiff - finds the edits that turn one text into another.
+
+Used to capture the local edits that can't be read from the command history
+(paste, undo/redo, reindent, multiple cursors): the view is compared with the
+text it had before, and the differences become a few range CRs.
+
+The common prefix and suffix are trimmed first (a paste or an undo usually
+touches one spot), then the middle is diffed with Myers' O(ND) algorithm,
+bounded so that very different texts are simply replaced.
+'''
+
+
+def common_prefix(a, b):
+    '''Length of the common prefix of a and b'''
+    # Binary search over slice comparisons, done at C speed
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def common_suffix(a, b):
+    '''Length of the common suffix of a and b'''
+    lo, hi = 0, min(len(a), len(b))
+    la, lb = len(a), len(b)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[la - mid:la - lo] == b[lb - mid:lb - lo]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _myers(a, b, max_d):
+    '''
+    Shortest edit script from a to b, as a list of (x, y) moves through the
+    edit graph, or None if it takes more than max_d insertions and deletions
+    '''
+    n, m = len(a), len(b)
+    v = {1: 0}
+    trace = []
+    for d in range(max_d + 1):
+        trace.append(v.copy())
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[k - 1] < v[k + 1]):
+                x = v[k + 1]  # Down: insertion
+            else:
+                x = v[k - 1] + 1  # Right: deletion
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            v[k] = x
+            if x >= n and y >= m:
+                return _backtrack(trace, n, m)
+    return None
+
+
+def _backtrack(trace, x, y):
+    '''Walks the trace of _myers back from (x, y) to the edit moves'''
+    moves = []
+    for d in range(len(trace) - 1, 0, -1):
+        v = trace[d]
+        k = x - y
+        if k == -d or (k != d and v[k - 1] < v[k + 1]):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = v[prev_k]
+        prev_y = prev_x - prev_k
+        # Skip the snake (equal characters)
+        snake = min(x - prev_x, y - prev_y)
+        moves.append((prev_x, prev_y, x - snake, y - snake))
+        x, y = prev_x, prev_y
+    moves.reverse()
+    return moves
+
+
+def diff(old, new, max_cost=1000000, max_d=256):
+    '''
+    Returns the edits turning old into new, as (pos, deleted, inserted)
+    tuples: `deleted` characters are removed at pos, then `inserted` is
+    inserted there. Each edit's pos is in the text left by the previous ones.
+
+    @max_cost:
+        Bound of the Myers diff work ((N + M) * D); beyond it the changed
+        middle is replaced as a whole
+    @max_d:
+        Most insertions plus deletions looked for by the Myers diff
+    '''
+    if old == new:
+        return []
+    prefix = common_prefix(old, new)
+    suffix = common_suffix(old[prefix:], new[prefix:])
+    a = old[prefix:len(old) - suffix]
+    b = new[prefix:len(new) - suffix]
+    if not a or not b:
+        # Pure insertion or deletion
+        return [(prefix, len(a), b)]
+
+    moves = None
+    max_d = min(max_d, max_cost // (len(a) + len(b)))
+    if max_d > 1:
+        moves = _myers(a, b, max_d)
+    if moves is None:
+        return [(prefix, len(a), b)]
+
+    # Group the moves into runs of deletions and insertions
+    runs = []  # [x, deleted, inserted, y after the run]
+    for prev_x, prev_y, x, y in moves:
+        if runs and runs[-1][0] + runs[-1][1] == prev_x and \
+                runs[-1][3] == prev_y:
+            run = runs[-1]
+        else:
+            run = [prev_x, 0, '', prev_y]
+            runs.append(run)
+        if x == prev_x:
+            run[2] += b[prev_y]
+        else:
+            run[1] += 1
+        run[3] = y
+
+    edits = []
+    shift = prefix
+    for x, deleted, inserted, _ in runs:
+        edits.append((x + shift, deleted, inserted))
+        shift += len(inserted) - deleted
+    return edits
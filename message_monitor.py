@@ -10,64 +10,482 @@ __license__ = 'MIT http://www.opensource.org/licenses/mit-license.php'
 __author__ = "Iulius Curt <iulius.curt@gmail.com>, http://iuliux.ro"
 
 
-from threading import Condition, Thread
+import copy
+import sys
+import time
+import traceback
+from collections import deque
+from threading import Condition, RLock, Thread
+
+
+st_version = 2 if sys.version_info < (3,) else 3
+
+if st_version == 3:
+    from .lib.changerequests import EncodingHandler, squash
+    from .lib.profiling import profiled
+elif st_version == 2:
+    from lib.changerequests import EncodingHandler, squash
+    from lib.profiling import profiled
 
 
 class MessageProdConsMonitor:
-    '''Monitor for Producers-Consumers type of message queue'''
+    '''
+    Monitor for Producers-Consumers type of message queue
+
+    Messages wait in two lanes: commits, consumed first and in order, and
+    polls. An UPDATE_MSG is useless while a COMMIT_MSG is pending (the
+    commit's response brings the missing updates anyway), so at most one poll
+    is kept and only while no commit is queued; superseded polls are dropped.
+
+    Consecutive COMMIT_MSGs are coalesced: while the last queued commit is
+    younger than `coalesce_window` seconds and smaller than
+    `coalesce_max_size` characters, adjacent edits are merged into its CR
+    (see ChangeRequest.merge) and the consumer holds it back until the window
+    closes. A window of 0 disables coalescing.
+
+    At most `capacity` commits are queued (0 for no limit). Past the
+    high-water mark (half of it), the queue is lagging; at the limit, the
+    `policy` decides:
+        coalesce - from the high-water mark on, the queued commits are
+                   squashed into as few CRs as their edits allow (see
+                   squash); only if that does not make room, they are
+                   dropped as with resync
+        resync - the queued commits are dropped, and so are the next ones,
+                 until the producer queues instead the CRs turning the text
+                 the server has into the local one (see resync; a
+                 RESYNC_MSG is consumed meanwhile, to have it done)
+        block - the producer holds its commits back (squashed into one
+                edit) until the queue is down to the high-water mark (see
+                hold)
+
+    Counters:
+        enqueued - messages added (coalesced ones included)
+        coalesced - commits merged into the previous one
+        squashed - times the queued commits were squashed
+        dropped - commits dropped to be resynced
+        blocked - times the producer held its commits back
+        dropped_polls - polls dropped as superseded
+        max_depth - highest number of messages waiting at once
+    '''
 
     UPDATE_MSG = 0
     COMMIT_MSG = 1
+    RESYNC_MSG = 2
+
+    POLICIES = ('coalesce', 'resync', 'block')
 
-    def __init__(self):
-        self.itemCount = 0
-        self.empty = Condition()
-        self.queue = list()
+    def __init__(self, coalesce_window=0, coalesce_max_size=0, capacity=0,
+                 policy='coalesce'):
+        lock = RLock()
+        self.empty = Condition(lock)
+        self.commits = deque()
+        self.polls = deque()
+        self.coalesce_window = coalesce_window
+        self.coalesce_max_size = coalesce_max_size
+        self.capacity = capacity
+        self.high_water = capacity // 2
+        if policy not in MessageProdConsMonitor.POLICIES:
+            raise ValueError('Unknown queue policy ' + str(policy))
+        self.policy = policy
+        # Creation time of the tail COMMIT_MSG while it still accepts merges
+        self._open_since = None
+        # Number of commits to squash the queue at again
+        self._squash_at = self.high_water
+        # Whether commits are dropped, until resync(), and whether a
+        # RESYNC_MSG is due
+        self._dropping = False
+        self._resync_due = False
+        self._waiting = False  # Whether the producer holds commits back
+        self.enqueued = 0
+        self.coalesced = 0
+        self.squashed = 0
+        self.dropped = 0
+        self.blocked = 0
+        self.dropped_polls = 0
+        self.max_depth = 0
+        # Called (with the lock held) whenever messages are added, for
+        # consumers that can't block on the condition (see remove_nowait)
+        self.listener = None
+        # Called (with the lock held) once the producer may queue the
+        # commits it held back (see hold)
+        self.room_listener = None
+
+    def depth(self):
+        '''Number of messages waiting to be consumed'''
+        return len(self.commits) + len(self.polls) + int(self._resync_due)
+
+    def dropping(self):
+        '''Whether commits are dropped, waiting for resync()'''
+        return self._dropping
+
+    def lagging(self):
+        '''Whether the queue is past its high-water mark'''
+        return self._dropping or self._waiting or \
+            bool(self.capacity) and len(self.commits) >= self.high_water
+
+    def _is_open(self):
+        '''Returns the seconds the tail commit may still accept merges'''
+        if self._open_since is None:
+            return 0
+        _, _, cr = self.commits[-1]
+        if cr.delta >= self.coalesce_max_size:
+            return 0
+        return self._open_since + self.coalesce_window - time.time()
 
     def add(self, item):
         '''Add produced item to the queue'''
         self.empty.acquire()
 
-        print('[ADD]', item)
-        # TODO: (optimization) Before append COMMIT_MSG, remove all UPDATE_MSGs
-        #       that preceed because they are useless.
-        self.queue.append(item)
-        self.itemCount += 1
+        self.enqueued += 1
+        msg, _, cr = item
+        if msg == MessageProdConsMonitor.COMMIT_MSG and self._dropping:
+            # Covered by the resync to come
+            self.dropped += 1
+        elif msg == MessageProdConsMonitor.COMMIT_MSG:
+            tail = self.commits[-1][2] if self._is_open() > 0 else None
+            if tail is not None:
+                # Queued CRs are numbered when sent; the provisional number
+                # of the tail may be older if a response came in between
+                cr.cr_n = tail.cr_n
+            if tail is not None and tail.merge(cr):
+                # Coalesced into the tail commit, nothing new to consume
+                self.coalesced += 1
+            else:
+                self.commits.append(item)
+                if self.coalesce_window > 0:
+                    self._open_since = time.time()
+            # Pending polls are superseded by the commit
+            self.dropped_polls += len(self.polls)
+            self.polls.clear()
+            self._limit()
+        elif self.commits:
+            self.dropped_polls += 1
+        else:
+            # Only the newest poll is worth sending
+            self.dropped_polls += len(self.polls)
+            self.polls.clear()
+            self.polls.append(item)
+        self.max_depth = max(self.max_depth, self.depth())
         self.empty.notify()
+        if self.listener:
+            self.listener()
 
         self.empty.release()
 
+    def _limit(self):
+        '''Enforces the capacity of the queue, after a commit was added'''
+        if not self.capacity:
+            return
+        if len(self.commits) < self.high_water:
+            self._squash_at = self.high_water
+        elif self.policy == 'coalesce' and \
+                len(self.commits) >= self._squash_at:
+            self._squash()
+            # Squash again only once the queue doubled
+            self._squash_at = max(self.high_water, 2 * len(self.commits))
+        if len(self.commits) >= self.capacity and self.policy != 'block':
+            self.dropped += len(self.commits)
+            self.commits.clear()
+            self._open_since = None
+            self._dropping = self._resync_due = True
+
+    def _squash(self):
+        '''Replaces the queued commits with as few CRs making the same edits'''
+        commits = self.commits
+        first = commits[0][2]
+        squashed = squash([cr for _, _, cr in commits])
+        self.commits = deque()
+        for i, cr in enumerate(squashed):
+            # Timed from the oldest edit
+            cr.trace = first.trace
+            msg, conv, _ = commits[i] if i < len(commits) else commits[0]
+            self.commits.append((msg, conv if i < len(commits)
+                                 else copy.copy(conv), cr))
+        self._open_since = None
+        self.squashed += 1
+
+    def compact(self):
+        '''
+        Squashes the queued commits, e.g. the backlog left by a broken
+        connection, so that it is sent again in as few CRs as possible
+        '''
+        self.empty.acquire()
+        if len(self.commits) > 1:
+            self._squash()
+        self.empty.release()
+
+    def hold(self):
+        '''
+        With the block policy, whether the producer must hold its commits
+        back rather than queue them: from the time the queue is full until
+        it is down to the high-water mark, when room_listener is called
+        '''
+        if self.policy != 'block' or not self.capacity:
+            return False
+        self.empty.acquire()
+        if not self._waiting and len(self.commits) >= self.capacity:
+            self.blocked += 1
+            self._waiting = True
+        waiting = self._waiting
+        self.empty.release()
+        return waiting
+
+    def _removed_commits(self):
+        '''Lets the producer queue again, once commits were consumed'''
+        if self._waiting and len(self.commits) <= self.high_water:
+            self._waiting = False
+            if self.room_listener:
+                self.room_listener()
+
+    def resync(self, items):
+        '''
+        Ends the dropping of commits: queues the COMMIT_MSGs standing for all
+        the ones dropped (and for those not queued yet)
+        '''
+        self.empty.acquire()
+
+        self._dropping = self._resync_due = False
+        self.commits.extend(items)
+        self.max_depth = max(self.max_depth, self.depth())
+        self.empty.notify()
+        if self.listener:
+            self.listener()
+
+        self.empty.release()
+
+    def _take(self):
+        '''
+        Removes the next item, if one may be consumed now. Returns the item,
+        or None and how long to wait for one (None for until the next add).
+        '''
+        if self._resync_due:
+            self._resync_due = False
+            return (MessageProdConsMonitor.RESYNC_MSG, None, None), 0
+        if not self.commits and not self.polls:
+            return None, None
+        # Hold back a lone commit that may still absorb following edits
+        remaining = self._is_open() if len(self.commits) == 1 else 0
+        if remaining > 0:
+            return None, remaining
+
+        if self.commits:
+            item = self.commits.popleft()
+            if not self.commits:
+                self._open_since = None
+            self._removed_commits()
+        else:
+            item = self.polls.popleft()
+        return item, 0
+
     def remove(self):
         '''Retrieve and remove from queue an item for consumption'''
         self.empty.acquire()
 
-        while self.itemCount < 1:
-            self.empty.wait()
-
-        item = self.queue.pop(0)
-        self.itemCount -= 1
-        print('[RM]', item)
+        item, wait = self._take()
+        while item is None:
+            self.empty.wait(wait)
+            item, wait = self._take()
 
         self.empty.release()
 
         return item
 
+    def remove_nowait(self):
+        '''
+        Like remove, but returns (None, seconds to wait) instead of waiting
+        when no item may be consumed yet (None seconds: until the next add)
+        '''
+        self.empty.acquire()
+        result = self._take()
+        self.empty.release()
+        return result
+
+    def remove_commits(self, limit):
+        '''
+        Retrieve and remove, without waiting, up to `limit` of the queued
+        COMMIT_MSGs
+        '''
+        self.empty.acquire()
+
+        items = []
+        while self.commits and len(items) < limit:
+            items.append(self.commits.popleft())
+        if not self.commits:
+            self._open_since = None
+        self._removed_commits()
+
+        self.empty.release()
+
+        return items
+
+    def push_front(self, items):
+        '''Put COMMIT_MSGs back at the head of the queue, in the given order'''
+        self.empty.acquire()
+
+        if self._dropping:
+            self.dropped += len(items)
+        else:
+            self.commits.extendleft(reversed(items))
+        self.dropped_polls += len(self.polls)
+        self.polls.clear()
+        self.empty.notify()
+        if self.listener:
+            self.listener()
+
+        self.empty.release()
+
+    def pending_commits(self):
+        '''Returns the CRs of the queued COMMIT_MSGs, in order'''
+        self.empty.acquire()
+        crs = [cr for _, _, cr in self.commits]
+        self.empty.release()
+        return crs
+
+    def rebase_commits(self, rebase):
+        '''
+        Replaces the CR of every queued COMMIT_MSG, in order, with the list of
+        CRs returned by rebase(cr) (it may drop or split a CR)
+        '''
+        self.empty.acquire()
+
+        commits = deque()
+        for msg, conv, cr in self.commits:
+            for i, new_cr in enumerate(rebase(cr)):
+                commits.append((msg, conv if i == 0 else copy.copy(conv),
+                                new_cr))
+        self.commits = commits
+        if not self.commits:
+            self._open_since = None
+
+        self.empty.release()
+
 
 class ChangesConsumer(Thread):
-    def __init__(self, monitor, session):
+    def __init__(self, monitor, session, batch_size=1, in_flight=None):
+        '''
+        With a batch_size above 1, up to that many queued commits are sent
+        together in a single request (the server must support batches).
+        `in_flight` is a semaphore, shared by the consumers, bounding the
+        requests they make at once.
+        '''
         super(ChangesConsumer, self).__init__(name='ChangesConsumer')
         self.monitor = monitor
         self.session = session
+        self.batch_size = batch_size
+        self.in_flight = in_flight
 
     def run(self):
+        attempt = 0
         while True:
             item = self.monitor.remove()
-            msg, conv, cr = item
+            conv, data, headers, batch = self.prepare(item)
+            if conv is None:
+                continue
+            started = time.time()
+            if self.in_flight:
+                self.in_flight.acquire()
+            try:
+                conv.send(data, headers=headers)
+                sent = True
+            except Exception:
+                traceback.print_exc()
+                sent = False
+            finally:
+                if self.in_flight:
+                    self.in_flight.release()
+            if not sent:
+                time.sleep(self.failed(batch, attempt))
+                attempt += 1
+                continue
+            attempt = 0
+            self.complete(conv, batch, started)
+
+    def failed(self, batch, attempt):
+        '''
+        Handles a request that could not be made (the `attempt`th in a row):
+        its commits are queued again, squashed with the ones queued
+        meanwhile. Returns the seconds to wait before the next one.
+        '''
+        self.session.metrics.count('send failures')
+        # Only the commits are worth keeping
+        if batch:
+            self.monitor.push_front(batch)
+            self.monitor.compact()
+        return min(2 ** attempt, 60)
+
+    def _legacy_batch(self, batch):
+        '''
+        The batch with its CRs as the legacy format can carry them (see
+        EncodingHandler.legacy_crs): the commits past the batch size go back
+        at the head of the queue.
+        '''
+        items = [(msg, conv, c) for msg, conv, cr in batch
+                 for c in EncodingHandler.legacy_crs(cr)]
+        if len(items) > self.batch_size:
+            self.monitor.push_front(items[self.batch_size:])
+            items = items[:self.batch_size]
+        return items
+
+    @profiled
+    def prepare(self, item):
+        '''
+        Takes the COMMIT_MSGs to send along with a dequeued item. Returns the
+        conversation, the data and headers to send and the batch of
+        COMMIT_MSGs sent (empty for an UPDATE_MSG). A RESYNC_MSG is handled
+        right away, and gives a None conversation.
+        '''
+        metrics = self.session.metrics
+        msg, conv, cr = item
+        if msg == MessageProdConsMonitor.RESYNC_MSG:
+            self.session.requeue_dropped()
+            return None, None, None, []
+        metrics.gauge('queue depth', self.monitor.depth() + 1)
+
+        if msg == MessageProdConsMonitor.COMMIT_MSG:
+            batch = [item]
+            if self.batch_size > 1:
+                batch += self.monitor.remove_commits(self.batch_size - 1)
+            if self.session.wire_format == EncodingHandler.LEGACY_FORMAT:
+                batch = self._legacy_batch(batch)
+            crs = [c for _, _, c in batch]
+            metrics.stamp(crs, 'dequeued')
+            # Each CR is based on what the server had when it was sent
+            # (including the previous CRs of the batch)
+            for i, c in enumerate(crs):
+                c.cr_n = self.session.cr_n + i
+            self.session.journal_sending(crs)
+            headers = self.session.request_headers()
+            if len(batch) > 1:
+                headers['Batch-Size'] = str(len(crs))
+            data = self.session.encode_crs(crs)
+            metrics.stamp(crs, 'sent')
+            return conv, data, headers, batch
+        # Ask from the current number: commits consumed after this poll was
+        # queued have already moved it forward
+        return conv, self.session.cr_n, self.session.request_headers(), []
 
-            if msg == MessageProdConsMonitor.COMMIT_MSG:
-                conv.send(cr.serialize())
-                self.session.handle_response(conv, cr)
-            elif msg == MessageProdConsMonitor.UPDATE_MSG:
-                conv.send(cr)
+    @profiled
+    def complete(self, conv, batch, started):
+        '''Handles the response to a request made of prepare()'s results'''
+        metrics = self.session.metrics
+        if self.monitor.dropping():
+            # Before the response brings remote CRs to rebase the local ones
+            # on
+            self.session.requeue_dropped([c for _, _, c in batch])
+        if batch:
+            crs = [c for _, _, c in batch]
+            metrics.request('commit', time.time() - started,
+                            conv.response_code)
+            metrics.stamp(crs, 'received')
+            if len(batch) > 1:
+                self.session.handle_batch_response(conv, batch)
+            else:
+                self.session.handle_response(conv, crs[0])
+        else:
+            if not conv.prefetched:
+                metrics.request('poll', time.time() - started,
+                                conv.response_code)
+            self.session.handle_response(conv, None)
 
-                self.session.handle_response(conv, None)
+        self.session.checkpoint()
+        self.session.show_lag()
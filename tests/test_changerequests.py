@@ -0,0 +1,194 @@
+'''Tests of the change requests and of their wire formats'''
+
+import random
+import unittest
+
+from lib.changerequests import (ChangeRequest, CRBatch, EncodingHandler,
+                                compose, escape_value, squash, transform,
+                                unescape_value)
+
+ADD = ChangeRequest.ADD_EDIT
+DEL = ChangeRequest.DEL_EDIT
+
+
+def apply_all(crs, text):
+    for cr in crs:
+        text = cr.apply_over(text)
+    return text
+
+
+def random_crs(rand, text, count, author='A', alphabet='abc'):
+    '''count CRs, each made over the text the previous ones produced'''
+    crs = []
+    for _ in range(count):
+        if text and rand.random() < 0.4:
+            pos = rand.randint(0, len(text) - 1)
+            cr = ChangeRequest(author, 0, pos,
+                               rand.randint(1, len(text) - pos), DEL)
+        else:
+            value = ''.join(rand.choice(alphabet)
+                            for _ in range(rand.randint(1, 4)))
+            cr = ChangeRequest(author, 0, rand.randint(0, len(text)),
+                               len(value), ADD, value)
+        text = cr.apply_over(text)
+        crs.append(cr)
+    return crs
+
+
+def fields(crs):
+    return [(cr.author, cr.cr_n, cr.pos, cr.delta, cr.op, cr.value)
+            for cr in crs]
+
+
+class TransformTest(unittest.TestCase):
+
+    def test_converges(self):
+        rand = random.Random(1)
+        for _ in range(500):
+            text = ''.join(rand.choice('xyz') for _ in range(rand.randint(
+                0, 12)))
+            left = random_crs(rand, text, rand.randint(0, 5), 'A', 'ab')
+            right = random_crs(rand, text, rand.randint(0, 5), 'B', 'cd')
+            for left_first in (True, False):
+                left2, right2 = transform(left, right, left_first)
+                self.assertEqual(apply_all(right2, apply_all(left, text)),
+                                 apply_all(left2, apply_all(right, text)))
+
+    def test_inputs_not_modified(self):
+        rand = random.Random(2)
+        left = random_crs(rand, 'hello', 4)
+        right = random_crs(rand, 'hello', 4)
+        before = fields(left), fields(right)
+        transform(left, right)
+        self.assertEqual((fields(left), fields(right)), before)
+
+    def test_tie_order(self):
+        left = [ChangeRequest('A', 0, 1, 1, ADD, 'a')]
+        right = [ChangeRequest('B', 0, 1, 1, ADD, 'b')]
+        left2, right2 = transform(left, right, True)
+        self.assertEqual(apply_all(right2, apply_all(left, 'xy')), 'xaby')
+        left2, right2 = transform(left, right, False)
+        self.assertEqual(apply_all(right2, apply_all(left, 'xy')), 'xbay')
+
+    def test_overlapping_deletions(self):
+        left = [ChangeRequest('A', 0, 1, 3, DEL)]
+        right = [ChangeRequest('B', 0, 2, 3, DEL)]
+        left2, right2 = transform(left, right)
+        self.assertEqual(apply_all(right2, apply_all(left, 'abcdefg')),
+                         'afg')
+        self.assertEqual(apply_all(left2, apply_all(right, 'abcdefg')),
+                         'afg')
+
+
+class ComposeTest(unittest.TestCase):
+
+    def test_compose(self):
+        rand = random.Random(3)
+        for _ in range(300):
+            text = ''.join(rand.choice('xyz') for _ in range(rand.randint(
+                0, 12)))
+            crs = random_crs(rand, text, rand.randint(0, 12))
+            expected = apply_all(crs, text)
+            self.assertEqual(compose(crs).apply_over(text), expected)
+            self.assertEqual(compose(CRBatch.from_crs(crs)).apply_over(text),
+                             expected)
+
+    def test_squash(self):
+        rand = random.Random(4)
+        for _ in range(300):
+            text = ''.join(rand.choice('xyz') for _ in range(rand.randint(
+                0, 12)))
+            crs = random_crs(rand, text, rand.randint(1, 12))
+            for i, cr in enumerate(crs):
+                cr.cr_n = 7 + i
+            squashed = squash(crs)
+            self.assertEqual(apply_all(squashed, text), apply_all(crs, text))
+            self.assertTrue(len(squashed) <= 2 * len(crs))
+            for cr in squashed:
+                self.assertEqual((cr.author, cr.cr_n), ('A', 7))
+
+    def test_squash_typing(self):
+        crs = [ChangeRequest('A', 0, i, 1, ADD, c)
+               for i, c in enumerate('hello')]
+        self.assertEqual(fields(squash(crs)), [('A', 0, 0, 5, ADD, 'hello')])
+        self.assertEqual(squash([]), [])
+
+
+class WireFormatTest(unittest.TestCase):
+
+    VALUES = ['', 'a', ':', 'a:b', '\n', 'x\r\ny', '\t', u'caf\u00e9',
+              '\\', 'a\\b', '\\:', '\\n', '>', '~2:']
+
+    def crs(self):
+        return [ChangeRequest('A', i - 1, 3 * i, len(value) or 1,
+                              ADD if value else DEL, value)
+                for i, value in enumerate(self.VALUES)]
+
+    def test_legacy_bytes(self):
+        cr = ChangeRequest('A', 35, 10, 4, ADD, 'a:\n\t')
+        self.assertEqual(cr.serialize(), 'A:z:a+4:a\\:\\n\\t:')
+        cr = ChangeRequest('B', -1, 0, 2, DEL)
+        self.assertEqual(cr.serialize(), 'B:-1:0-2::')
+        # Coalesced values the legacy escaping can not carry go as typed
+        crs = EncodingHandler.legacy_crs(
+            ChangeRequest('A', 1, 2, 4, ADD, 'a>\\n'))
+        data = EncodingHandler.encode_crs(crs, EncodingHandler.LEGACY_FORMAT)
+        self.assertEqual(data, 'A:1:2+1:a:>A:1:3+1:>:>A:1:4+1:\\:>A:1:5+1:n:')
+        self.assertEqual(fields(EncodingHandler.decode_crs(data)), fields(crs))
+        cr = ChangeRequest('A', 1, 2, 4, ADD, 'a:\n')
+        self.assertEqual(EncodingHandler.legacy_crs(cr), [cr])
+
+    def test_escapes(self):
+        for value in ['', 'plain', ':', 'a:b:c', '\n\r\t', 'x\r\ny:']:
+            escaped = escape_value(value)
+            self.assertFalse(set(':\n\r\t') & set(
+                escaped.replace('\\:', '')))
+            self.assertEqual(unescape_value(escaped), value)
+
+    def test_legacy_round_trip(self):
+        crs = [typed for cr in self.crs()
+               for typed in EncodingHandler.legacy_crs(cr)]
+        data = EncodingHandler.encode_crs(crs, EncodingHandler.LEGACY_FORMAT)
+        self.assertEqual(fields(EncodingHandler.decode_crs(data)),
+                         fields(crs))
+        self.assertEqual(apply_all(crs, 'x' * 60),
+                         apply_all(self.crs(), 'x' * 60))
+
+    def test_compact_round_trip(self):
+        crs = self.crs()
+        data = EncodingHandler.encode_crs(crs, EncodingHandler.COMPACT_FORMAT)
+        self.assertTrue(data.startswith('~2:'))
+        self.assertEqual(fields(EncodingHandler.decode_crs(data)),
+                         fields(crs))
+        batch = EncodingHandler.decode_batch(data)
+        self.assertEqual(len(batch), len(crs))
+        self.assertEqual(fields(batch.crs()), fields(crs))
+        self.assertEqual(EncodingHandler.encode_crs(
+            batch, EncodingHandler.COMPACT_FORMAT), data)
+
+    def test_batch_pack(self):
+        crs = self.crs()
+        batch = CRBatch.from_crs(crs)
+        data = ''.join(cr.pack() for cr in crs)
+        self.assertEqual(batch.pack(), data)
+        self.assertEqual(fields(CRBatch.unpack(data, len(crs)).crs()),
+                         fields(crs))
+        self.assertEqual(batch.apply_over('x' * 60),
+                         apply_all(crs, 'x' * 60))
+
+    def test_compact_malformed(self):
+        data = ''.join(cr.pack() for cr in self.crs()[:3])
+        for end in range(len(data)):
+            self.assertRaises(ValueError, CRBatch.unpack, data[:end], 3)
+        self.assertRaises(ValueError, CRBatch.unpack, '0:0:*1:1:A0:', 1)
+        self.assertEqual(len(EncodingHandler.decode_batch('~2:3:0:0:')), 0)
+
+    def test_fields(self):
+        values = ['', 'a', '1:2', u'caf\u00e9', ':' * 40]
+        data = EncodingHandler.encode_fields(values)
+        self.assertEqual(EncodingHandler.decode_fields(data), values)
+        self.assertRaises(ValueError, EncodingHandler.decode_fields, data[:-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,425 @@
+'''
+Two clients editing the same pads through a stand-in server (see
+tools/standin_server.py), with the plugin running on the fake Sublime Text
+API (see tools/fake_sublime.py). Each test checks that both views end up
+with the text of the server, and that the server answered with the codes
+of the path under test.
+
+The plugin picks its transport when it is imported, once per process: the
+tests run over the threads one, unless TOGETHER_TEST_TRANSPORT says
+otherwise (see test_stream.py).
+'''
+
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+
+TOOLS = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'tools')
+sys.path.insert(0, TOOLS)
+
+import fake_sublime
+from fake_sublime import run_on_main, wait_until
+from standin_server import StandinServer, StandinStreamServer
+
+TIMEOUT = 30
+TRANSPORT = os.environ.get('TOGETHER_TEST_TRANSPORT', 'threads')
+
+# Set up by setUpModule: the plugin module is loaded once per process
+together = None
+server = None
+stream_server = None
+codes = []  # (method, batched, response code) of every request
+
+
+def setUpModule():
+    global together, server, stream_server
+    server = StandinServer().start()
+    stream_server = StandinStreamServer(server.pads).start()
+    handle = server.pads.handle
+
+    def recording(method, resource, data, headers):
+        response = handle(method, resource, data, headers)
+        codes.append((method, 'batch-size' in headers,
+                      int(response[0]['code'])))
+        return response
+    server.pads.handle = recording
+
+    settings = fake_sublime.read_settings(
+        os.path.join(fake_sublime.ROOT, 'together.sublime-settings'))
+    settings.update(server_url=server.url, transport=TRANSPORT,
+                    stream_url=stream_server.url,
+                    cache_dir=tempfile.mkdtemp(prefix='together-test'),
+                    cache_max_size=0, metrics_log='', coalesce_window=0,
+                    snapshot_interval=0, checksum_interval=0,
+                    # Update checks only when the tests ask for them
+                    poll_min_interval=3600, poll_max_interval=3600)
+    fake_sublime.install(settings)
+    together = fake_sublime.load_plugin()
+
+
+def tearDownModule():
+    stream_server.stop()
+    server.stop()
+
+
+class SessionsTest(unittest.TestCase):
+    '''Helpers driving sessions of a pad of its own per test'''
+
+    def setUp(self):
+        del codes[:]
+        self.sessions = []
+        self.pad = self.id().split('.')[-1]
+
+    def tearDown(self):
+        for session in self.sessions:
+            session.active = False
+            together.update_scheduler.set_visible(session, False)
+
+    def start(self, author, join=False):
+        '''A session of the pad of the test, in a new view'''
+        view = fake_sublime.View()
+        session = together.Session(view, self.pad)
+        session.author = author
+        # Its consumer thread never ends
+        session.cr_consumer.daemon = True
+        if join:
+            session.join()
+        else:
+            session.initiate()
+        self.assertTrue(session.active, getattr(session, 'error', None))
+        together.sessions_by_view[view.id()] = session
+        self.sessions.append(session)
+        return session
+
+    def type(self, session, text, pos=None):
+        '''Types text at pos (default: at the end)'''
+        if pos is None:
+            pos = len(session.view.text)
+        for i, char in enumerate(text):
+            run_on_main(session.view.type, char, pos + i)
+
+    def sent(self, *sessions):
+        '''Waits until the local edits of the sessions were acknowledged'''
+        def done():
+            for session in sessions:
+                if session.msgmonitor.depth() or session._captured or \
+                        session.view.text != session.buffer.flatten():
+                    return False
+            return not together.sync_pool.is_alive()
+        self.assertTrue(wait_until(done, TIMEOUT))
+
+    def converge(self):
+        '''Has the sessions check for updates until they all have the pad'''
+        pad = server.pads.pads[self.pad]
+
+        def synced():
+            text = pad.text.flatten()
+            return all(session.view.text == session.buffer.flatten() == text
+                       for session in self.sessions)
+        for _ in range(20):
+            self.sent(*self.sessions)
+            together.update_scheduler.check(self.sessions)
+            if wait_until(synced, 1):
+                return pad.text.flatten()
+        self.fail('The views did not converge: %r' % (
+            [pad.text.flatten()] +
+            [session.view.text for session in self.sessions]))
+
+    def compact(self):
+        '''Has the server replace the history of the pad with a snapshot'''
+        pad = server.pads.pads[self.pad]
+        with server.pads.lock:
+            pad.snapshot = (pad.last(), pad.text.flatten())
+            pad.compact(pad.last())
+
+    def crash(self, session):
+        '''Stops the session as if it crashed, leaving its journal as is'''
+        session.journal_sending = lambda crs: None
+        session._journal_pending = lambda rebased=False: None
+        session.active = False
+        together.update_scheduler.set_visible(session, False)
+        self.sessions.remove(session)
+        session.journal.close()
+
+    def journaled(self, session, sent, pos, value):
+        '''
+        Has the journal of the session hold an edit at pos, over the CRs it
+        has, as if it were about to be sent (or not, with `sent`)
+        '''
+        ChangeRequest = together.ChangeRequest
+        cr = ChangeRequest(session.author, session.cr_n, pos, len(value),
+                           ChangeRequest.ADD_EDIT, value)
+        session.journal.checkpoint(session.cr_n, [cr], sent=int(sent))
+
+    def converged(self):
+        '''Waits until the sessions all have the pad, without update checks'''
+        pad = server.pads.pads[self.pad]
+
+        def synced():
+            text = pad.text.flatten()
+            return all(session.view.text == session.buffer.flatten() == text
+                       for session in self.sessions)
+        self.assertTrue(wait_until(synced, TIMEOUT), (
+            [pad.text.flatten()] +
+            [session.view.text for session in self.sessions]))
+        return pad.text.flatten()
+
+
+@unittest.skipIf(TRANSPORT != 'threads', 'Update requests over HTTP')
+class ConvergenceTest(SessionsTest):
+
+    def test_commit_and_update(self):
+        a = self.start('A')
+        # Negotiated when the pad is created
+        self.assertEqual(a.wire_format, 2)
+        b = self.start('B', join=True)
+        self.type(a, 'hello')
+        self.sent(a)
+        self.assertIn(('PUT', False, 200), codes)
+        # B commits without having seen the edits of A
+        self.type(b, 'XY', 0)
+        self.sent(b)
+        self.assertIn(('PUT', False, 206), codes)
+        # Inserted at the same place: the edit committed first comes first
+        self.assertEqual(b.view.text, 'helloXY')
+        # A gets the edit of B from a batched update check
+        self.assertEqual(self.converge(), 'helloXY')
+        self.assertIn(('POST', False, 207), codes)
+
+    def test_updates_decoded_off_main(self):
+        main = run_on_main(threading.current_thread)
+        handler = together.EncodingHandler
+        decode_batch = handler.decode_batch
+        threads = []
+
+        def decoding(data):
+            threads.append(threading.current_thread())
+            return decode_batch(data)
+        handler.decode_batch = staticmethod(decoding)
+        try:
+            a = self.start('A')
+            b = self.start('B', join=True)
+            self.type(a, 'abc')
+            self.sent(a)
+            self.type(b, 'xyz', 0)
+            self.assertEqual(self.converge(), 'abcxyz')
+        finally:
+            handler.decode_batch = staticmethod(decode_batch)
+        self.assertTrue(threads)
+        self.assertNotIn(main, threads)
+
+    def test_concurrent_batches(self):
+        settings = together.settings
+        settings.set('batch_commits', True)
+        try:
+            a = self.start('A')
+            b = self.start('B', join=True)
+        finally:
+            settings.set('batch_commits', False)
+        rand = random.Random(1)
+
+        def typing(session, alphabet):
+            for _ in range(150):
+                view = session.view
+                pos = rand.randint(0, len(view.text))
+                run_on_main(view.type, rand.choice(alphabet), pos)
+        threads = [threading.Thread(target=typing, args=(a, 'ab')),
+                   threading.Thread(target=typing, args=(b, 'xy'))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        text = self.converge()
+        self.assertEqual(len(text), 300)
+        self.assertIn(('PUT', True, 206), codes)
+        # Edits made while a commit is on its way go in one batch
+        with server.pads.lock:
+            self.type(a, 'batch')
+        self.sent(a)
+        self.assertIn(('PUT', True, 200), codes)
+        self.assertEqual(self.converge(), text + 'batch')
+
+    def test_history_compacted(self):
+        a = self.start('A')
+        b = self.start('B', join=True)
+        self.type(a, 'abc')
+        self.converge()
+        self.type(a, 'def')
+        self.sent(a)
+        self.compact()
+        # B commits over CRs the server dropped: it catches up from the
+        # snapshot, then commits again
+        self.type(b, 'Z', 0)
+        self.sent(b)
+        self.assertIn(('PUT', False, 410), codes)
+        self.assertEqual(self.converge(), 'Zabcdef')
+        # Then misses some in an update check
+        self.type(a, 'g')
+        self.sent(a)
+        self.compact()
+        del codes[:]
+        self.assertEqual(self.converge(), 'Zabcdefg')
+        self.assertEqual(b.metrics.counters.get('resyncs'), 2)
+
+    def test_legacy_format(self):
+        settings = together.settings
+        settings.set('coalesce_window', 1000)
+        # A server that only knows the legacy wire format
+        server.pads.formats = (1,)
+        try:
+            a = self.start('A')
+            b = self.start('B', join=True)
+            self.type(a, 'if a > b: print("\\n")')
+            self.sent(a)
+            self.type(b, '>\\', 0)
+            text = self.converge()
+        finally:
+            settings.set('coalesce_window', 0)
+            server.pads.formats = (1, 2)
+        self.assertEqual(text, 'if a > b: print("\\n")>\\')
+        self.assertEqual((a.wire_format, b.wire_format), (1, 1))
+        # Typed in one run, but sent as typed where the format needs it
+        self.assertTrue(a.msgmonitor.coalesced)
+
+    def test_held_edits_journaled(self):
+        settings = together.settings
+        settings.set('queue_full_policy', 'block')
+        settings.set('queue_capacity', 2)
+        try:
+            a = self.start('A')
+        finally:
+            settings.set('queue_full_policy', 'coalesce')
+            settings.set('queue_capacity', 1000)
+        with server.pads.lock:
+            # 'a' on its way, 'b' and 'c' queued, the rest held back
+            self.type(a, 'a')
+            self.assertTrue(wait_until(
+                lambda: not a._captured and not a.msgmonitor.depth(),
+                TIMEOUT))
+            self.type(a, 'bcdefgh')
+            self.assertTrue(wait_until(
+                lambda: a._held and a._captured[0][0].value == 'defgh',
+                TIMEOUT))
+            for checkpoint in (lambda: a.journal_sending([]),
+                               lambda: a._journal_pending(rebased=True)):
+                checkpoint()
+                cr_n, crs, sent = a.journal.load()
+                text = 'a'
+                for cr in crs:
+                    text = cr.apply_over(text)
+                self.assertEqual(text, 'abcdefgh')
+        self.assertEqual(self.converge(), 'abcdefgh')
+
+    def test_replay_committed(self):
+        a = self.start('A')
+        b = self.start('B', join=True)
+        self.type(a, 'hello')
+        self.converge()
+        # A crashes after sending 'X', before the server answered
+        with server.pads.lock:
+            self.type(a, 'X', 5)
+            self.assertTrue(wait_until(
+                lambda: (a.journal.load() or (0, [], 0))[2] == 1, TIMEOUT))
+            self.crash(a)
+        self.type(b, 'B', 0)
+        self.assertEqual(self.converge(), 'BhelloX')
+        # The server committed it: not sent again
+        c = self.start('A', join=True)
+        self.assertFalse(c.metrics.counters.get('replayed'))
+        self.assertEqual(self.converge(), 'BhelloX')
+
+    def test_replay_not_committed(self):
+        a = self.start('A')
+        b = self.start('B', join=True)
+        self.type(a, 'hello')
+        self.converge()
+        # A crashes with 'X' sent, but lost on its way
+        self.journaled(a, True, 5, 'X')
+        self.crash(a)
+        self.type(b, 'B', 0)
+        self.converge()
+        c = self.start('A', join=True)
+        self.assertEqual(c.metrics.counters.get('replayed'), 1)
+        self.assertEqual(self.converge(), 'BhelloX')
+
+    def test_replay_compacted(self):
+        a = self.start('A')
+        b = self.start('B', join=True)
+        self.type(a, 'hello')
+        self.converge()
+        self.journaled(a, False, 5, 'X')
+        self.crash(a)
+        self.type(b, 'B')
+        self.converge()
+        # The CRs the journal is based on are gone: 'X' goes over the
+        # snapshot, where it was made
+        self.compact()
+        del codes[:]
+        c = self.start('A', join=True)
+        self.assertIn(('GET', False, 410), codes)
+        self.assertEqual(c.metrics.counters.get('replayed'), 1)
+        self.assertEqual(self.converge(), 'helloXB')
+
+
+@unittest.skipIf(TRANSPORT != 'stream', 'Run by test_stream.py')
+class StreamTest(SessionsTest):
+
+    def test_pushes(self):
+        a = self.start('A')
+        b = self.start('B', join=True)
+        self.type(a, 'hello')
+        # No update check: the server pushes the CRs to B
+        self.assertEqual(self.converged(), 'hello')
+        self.assertTrue(b.metrics.counters.get('pushes'))
+        self.assertNotIn(('GET', False, 206), codes)
+
+    def test_concurrent_edits(self):
+        a = self.start('A')
+        b = self.start('B', join=True)
+        rand = random.Random(2)
+
+        def typing(session, alphabet):
+            for _ in range(100):
+                view = session.view
+                pos = rand.randint(0, len(view.text))
+                run_on_main(view.type, rand.choice(alphabet), pos)
+        threads = [threading.Thread(target=typing, args=(a, 'ab')),
+                   threading.Thread(target=typing, args=(b, 'xy'))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.sent(a, b)
+        self.assertEqual(len(self.converged()), 200)
+        self.assertTrue(a.metrics.counters.get('pushes'))
+        self.assertTrue(b.metrics.counters.get('pushes'))
+
+    def test_resubscribe(self):
+        a = self.start('A')
+        b = self.start('B', join=True)
+        self.type(a, 'ab')
+        self.sent(a)
+        self.converged()
+        stream = together.conv_starter.stream
+        opened = stream._opened
+        stream._sock.shutdown(socket.SHUT_RDWR)
+        self.assertTrue(wait_until(lambda: stream._sock is None, TIMEOUT))
+        # Committed by another client while the stream is broken: its push
+        # is missed
+        ChangeRequest = together.ChangeRequest
+        cr = ChangeRequest('C', a.cr_n, 0, 1, ChangeRequest.ADD_EDIT, 'C')
+        server.pads.handle('PUT', self.pad,
+                           together.EncodingHandler.encode_crs([cr]), {})
+        # The next request opens it again, and the sessions catch up
+        self.type(a, 'd')
+        self.assertEqual(self.converged(), 'Cabd')
+        self.assertEqual(stream._opened, opened + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
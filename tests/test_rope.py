@@ -0,0 +1,102 @@
+'''Tests of the Rope text buffer and of its block checksums'''
+
+import random
+import unittest
+
+from lib.blocksums import ChecksummedRope, block_sum, checksums
+from lib.rope import Rope
+
+
+def random_edits(rand, buffers, text, count, alphabet=u'ab\n\u00e9'):
+    '''Makes count random edits over the buffers and text, alike'''
+    for _ in range(count):
+        if text and rand.random() < 0.4:
+            pos = rand.randint(-1, len(text))
+            length = rand.randint(-1, 40)
+            for buf in buffers:
+                buf.delete(pos, length)
+            pos = max(0, pos)
+            text = text[:pos] + text[pos + max(0, length):]
+        else:
+            pos = rand.randint(-1, len(text) + 1)
+            value = ''.join(rand.choice(alphabet)
+                            for _ in range(rand.randint(0, 40)))
+            for buf in buffers:
+                buf.insert(pos, value)
+            pos = max(0, min(pos, len(text)))
+            text = text[:pos] + value + text[pos:]
+    return text
+
+
+class RopeTest(unittest.TestCase):
+
+    def test_edits(self):
+        rand = random.Random(1)
+        text = 'hello world' * 20
+        rope = Rope(text, leaf_size=8)
+        for _ in range(300):
+            text = random_edits(rand, [rope], text, 1)
+            self.assertEqual(len(rope), len(text))
+            start = rand.randint(-2, len(text) + 2)
+            end = rand.randint(-2, len(text) + 2)
+            self.assertEqual(rope.substr(start, end),
+                             text[max(0, start):max(0, end)])
+        self.assertEqual(rope.flatten(), text)
+
+    def test_large_insertions(self):
+        rope = Rope(leaf_size=4)
+        rope.insert(0, 'x' * 1000)
+        rope.insert(500, 'y' * 1000)
+        rope.delete(0, 499)
+        self.assertEqual(rope.flatten(), 'x' + 'y' * 1000 + 'x' * 500)
+
+
+class ChecksummedRopeTest(unittest.TestCase):
+
+    def test_sums_follow_edits(self):
+        rand = random.Random(2)
+        for block_size in (1, 3, 16):
+            text = 'abcdef' * 10
+            rope = ChecksummedRope(text, leaf_size=8, block_size=block_size)
+            for _ in range(100):
+                text = random_edits(rand, [rope], text, rand.randint(1, 3))
+                self.assertEqual(rope.checksums(),
+                                 checksums(text, block_size))
+            self.assertEqual(rope.flatten(), text)
+
+    def test_incremental(self):
+        text = 'abcdefgh' * 1024
+        rope = ChecksummedRope(text, block_size=256)
+        rope.checksums()
+        read = []
+        substr = rope.substr
+        rope.substr = lambda start, end: read.append(end - start) or \
+            substr(start, end)
+        rope.insert(1000, 'xy')
+        rope.delete(5000, 1)
+        text = text[:1000] + 'xy' + text[1000:]
+        text = text[:5000] + text[5001:]
+        self.assertEqual(rope.checksums(), checksums(text, 256))
+        # The two edited blocks, and a few characters of the shifted ones
+        self.assertTrue(sum(read) < 4 * 256, sum(read))
+        read[:] = []
+        self.assertEqual(rope.checksums(), checksums(text, 256))
+        self.assertEqual(read, [])
+
+    def test_match_blocks(self):
+        text = ''.join(chr(ord('a') + i % 26) * 3 for i in range(100))
+        rope = ChecksummedRope(text, block_size=16)
+        remote = text[:100] + 'XY' + text[100:]
+        found = rope.match_blocks(checksums(remote, 16), len(remote))
+        for index, pos in enumerate(found):
+            block = remote[index * 16:(index + 1) * 16]
+            if pos is not None:
+                self.assertEqual(text[pos:pos + len(block)], block)
+        # Only the block with the difference is missing here
+        self.assertEqual([i for i, pos in enumerate(found) if pos is None],
+                         [6])
+        self.assertEqual(block_sum(''), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+'''
+Runs the tests of the stream transport (StreamTest, in test_convergence.py)
+in a process of their own: the plugin picks its transport when it is
+imported.
+'''
+
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class StreamTransportTest(unittest.TestCase):
+
+    def test_stream(self):
+        env = dict(os.environ, TOGETHER_TEST_TRANSPORT='stream')
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'unittest', '-v',
+             'tests.test_convergence.StreamTest'],
+            cwd=ROOT, env=env, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+        output = process.communicate()[0].decode('UTF-8', 'replace')
+        self.assertEqual(process.returncode, 0, output)
+        self.assertNotIn('skipped', output)
+
+
+if __name__ == '__main__':
+    unittest.main()
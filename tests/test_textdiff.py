@@ -0,0 +1,52 @@
+'''Tests of the text diff'''
+
+import random
+import unittest
+
+from lib.textdiff import common_prefix, common_suffix, diff
+
+
+def patch(text, edits):
+    for pos, deleted, inserted in edits:
+        text = text[:pos] + inserted + text[pos + deleted:]
+    return text
+
+
+class DiffTest(unittest.TestCase):
+
+    def test_random(self):
+        rand = random.Random(1)
+        for _ in range(300):
+            old = ''.join(rand.choice('abc\n') for _ in range(rand.randint(
+                0, 60)))
+            new = list(old)
+            for _ in range(rand.randint(0, 6)):
+                pos = rand.randint(0, len(new))
+                if new and rand.random() < 0.5:
+                    del new[pos:pos + rand.randint(1, 5)]
+                else:
+                    new[pos:pos] = rand.choice(['x', 'yz', 'abc'])
+            new = ''.join(new)
+            self.assertEqual(patch(old, diff(old, new)), new)
+
+    def test_minimal(self):
+        self.assertEqual(diff('same', 'same'), [])
+        self.assertEqual(diff('abc', 'abXc'), [(2, 0, 'X')])
+        self.assertEqual(diff('abXc', 'abc'), [(2, 1, '')])
+        self.assertEqual(diff('a1b2c', 'a3b4c'), [(1, 1, '3'), (3, 1, '4')])
+
+    def test_bounded(self):
+        old = 'a' + 'xy' * 200 + 'b'
+        new = 'a' + 'yx' * 200 + 'b'
+        edits = diff(old, new, max_cost=10)
+        self.assertEqual(edits, [(1, 400, 'yx' * 200)])
+        self.assertEqual(patch(old, diff(old, new)), new)
+
+    def test_affixes(self):
+        self.assertEqual(common_prefix('abcd', 'abxd'), 2)
+        self.assertEqual(common_suffix('abcd', 'xbcd'), 3)
+        self.assertEqual(common_prefix('', 'a'), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
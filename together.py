@@ -5,46 +5,191 @@ Together Sublime-Text-2 plugin - Collaborative editing
 __license__ = 'MIT http://www.opensource.org/licenses/mit-license.php'
 __author__ = "Iulius Curt <iulius.curt@gmail.com>, http://iuliux.ro"
 
+import os
 import sys
 
 import sublime
 import sublime_plugin
 
 import time
-import threading
-from threading import Thread, Lock
+from threading import BoundedSemaphore, Condition, Event, RLock, Thread
 
 
 st_version = 2 if sys.version_info < (3,) else 3
 
 if st_version == 3:
+    from .lib.blocksums import DEFAULT_BLOCK_SIZE, ChecksummedRope
     from .lib.communication import *
     from .lib.changerequests import *
+    from .lib.journal import Journal
+    from .lib.metrics import EventLog, SessionMetrics
+    from .lib.padcache import PadCache
+    from .lib.profiling import Profiler, active_profiler, profiled
+    from .lib.rope import Rope
+    from .lib.stream_transport import StreamConnection
+    from .lib.textdiff import diff
     from .message_monitor import *
+    from .worker_pool import SyncWorkerPool
 elif st_version == 2:
+    from lib.blocksums import DEFAULT_BLOCK_SIZE, ChecksummedRope
     from lib.communication import *
     from lib.changerequests import *
+    from lib.journal import Journal
+    from lib.metrics import EventLog, SessionMetrics
+    from lib.padcache import PadCache
+    from lib.profiling import Profiler, active_profiler, profiled
+    from lib.rope import Rope
+    from lib.stream_transport import StreamConnection
+    from lib.textdiff import diff
     from message_monitor import *
+    from worker_pool import SyncWorkerPool
+# The asyncio transport needs Python 3.5+
+try:
+    if st_version == 3:
+        from .lib.async_transport import AsyncTransport
+    elif st_version == 2:
+        from lib.async_transport import AsyncTransport
+except (ImportError, SyntaxError):
+    AsyncTransport = None
 
 
 # Dict to keep track of view-session associations
 sessions_by_view = {}
 
-# Lock for regulating message sending to server
-channel_lock = Lock()
-count = 0
-
 # Read settings
 settings = sublime.load_settings(__name__ + '.sublime-settings')
 
 # Create a global ConversationStarter
 # (which generates request-response conversations)
 try:
-    conv_starter = ConversationStarter(settings.get('server_url'))
+    conv_starter = ConversationStarter(
+        settings.get('server_url'),
+        pool_size=settings.get('connection_pool_size', 4),
+        retries=settings.get('request_retries', 3),
+        timeout=settings.get('request_timeout', 30),
+        compression=settings.get('compression', True),
+        compress_min_size=settings.get('compress_min_size', 1024))
     print('ConversationStarter CREATED!')
 except Exception:
     sublime.error_message("Can't establish the connection to server")
 
+# Single event loop driving the traffic of all sessions, if enabled (see the
+# transport setting); otherwise every session runs its own threads
+async_transport = None
+if settings.get('transport', 'threads') == 'asyncio':
+    if AsyncTransport is None:
+        print('The asyncio transport needs Python 3.5+, using threads')
+    elif conv_starter.conn.scheme != 'http':
+        print('The asyncio transport only speaks plain http, using threads')
+    else:
+        async_transport = AsyncTransport(
+            conv_starter.conn,
+            pool_size=settings.get('connection_pool_size', 4),
+            handlers=settings.get('sync_workers', 2)).start()
+        print('AsyncTransport STARTED!')
+
+# Bounds the requests the consumer threads of all sessions make at once (the
+# asyncio transport is bounded by its connection pool instead)
+in_flight = None
+if settings.get('max_in_flight', 8):
+    in_flight = BoundedSemaphore(settings.get('max_in_flight', 8))
+
+
+def _dispatch_push(pad, cr_n, new_cr_n, wire_format, crs):
+    '''
+    Queues the CRs pushed by the server (committed after cr_n, up to
+    new_cr_n) to the sessions of their pad, as answered update requests
+    '''
+    code = EncodingHandler.resp_ttoc
+    responses = {
+        cr_n: {'headers': {'code': str(code['update_needed']),
+                           'new_cr_n': new_cr_n,
+                           'wire_format': wire_format},
+               'body': crs},
+        # Sessions that committed them themselves
+        new_cr_n: {'headers': {'code': str(code['ok'])}, 'body': ''},
+    }
+    for session in list(update_scheduler.sessions):
+        if session.pad == pad and session.cr_n < int(new_cr_n):
+            session.metrics.count('pushes')
+            session.check_remote(responses)
+
+
+def _stream_reconnected():
+    '''Catches up on the pushes missed while the stream was broken'''
+    for session in list(update_scheduler.sessions):
+        session.check_remote()
+
+
+# Persistent stream connection to the server, if enabled (see the transport
+# setting); the conversations then go over it, instead of HTTP requests
+if settings.get('transport', 'threads') == 'stream':
+    stream = StreamConnection(
+        settings.get('stream_url'),
+        timeout=settings.get('request_timeout', 30),
+        retries=settings.get('request_retries', 3),
+        on_push=_dispatch_push, on_reconnect=_stream_reconnected)
+    if conv_starter.use_stream(stream):
+        print('StreamConnection OPENED!')
+    else:
+        print('Falling back to HTTP requests')
+
+
+def cache_directory():
+    '''Directory of the files kept across sessions (see cache_dir)'''
+    directory = settings.get('cache_dir')
+    if not directory:
+        if hasattr(sublime, 'cache_path'):
+            directory = os.path.join(sublime.cache_path(), 'Together')
+        else:
+            directory = os.path.join(sublime.packages_path(), 'User',
+                                     'Together.cache')
+    return directory
+
+
+# On-disk cache of pads (created on first use)
+_pad_cache = None
+
+
+def get_pad_cache():
+    '''Returns the PadCache, or None if caching is disabled'''
+    global _pad_cache
+    max_size = settings.get('cache_max_size', 50)
+    if _pad_cache is None and max_size > 0:
+        _pad_cache = PadCache(cache_directory(), max_size * 1024 * 1024)
+    return _pad_cache
+
+
+def open_journal(pad):
+    '''
+    Returns the Journal of the unacknowledged local CRs of a pad, or None if
+    journaling is disabled (or another session keeps it)
+    '''
+    if not settings.get('journal', True):
+        return None
+    journal = Journal.open(
+        cache_directory(), conv_starter.uri, pad,
+        fsync_interval=settings.get('journal_fsync_interval', 200) / 1000.0)
+    if journal is None:
+        print('Pad ' + pad + ' is already journaled by another session')
+    return journal
+
+
+# Raw metric events of all sessions (see the metrics_log setting)
+_metrics_log = None
+
+
+def get_metrics_log():
+    '''Returns the EventLog, or None if raw events are not logged'''
+    global _metrics_log
+    path = settings.get('metrics_log')
+    if _metrics_log is None and path:
+        try:
+            _metrics_log = EventLog(path)
+        except (IOError, OSError) as e:
+            print('Unable to open the metrics log', path, e)
+    return _metrics_log
+
 
 class Session(object):
     '''Structure specific for each session. Each pad has it's own session'''
@@ -56,25 +201,61 @@ class Session(object):
         self.cr_n = -1  # Change request number (logical clock)
         self.view = view
         self.active = False
-        self.buffer = ''
-        # Producers-Consumers queue
-        self.msgmonitor = MessageProdConsMonitor()
-        self.cr_consumer = ChangesConsumer(self.msgmonitor, self)
-        self.remote_checker = UpdateCheckerThread(self)
+        # Local copy of the pad, as known by server
+        self.buffer = self._new_buffer()
+        self.shadow = Rope()  # The view, as of the last captured edit
+        self._snapshot_cr_n = -1  # cr_n of the last snapshot seen or sent
+        self._cached_cr_n = -1  # cr_n of the pad in the local cache
+        self._verified = time.time()  # Last time the buffer was verified
+        self._verify_due = False  # Verify the buffer as soon as possible
+        self._checksums = True  # Whether the server provides checksums
+        self.journal = None  # Of the local CRs not acknowledged yet
+        # Format of CR lists sent to server, upgraded once it advertises more
+        self.wire_format = EncodingHandler.LEGACY_FORMAT
+        # Guards the local CRs not yet sent (see _rebase_pending)
+        self.lock = RLock()
+        # Local CRs captured, but not yet queued by handle_change. Each entry
+        # is the list of CRs one capture became after rebasing.
+        self._captured = []
+        # Whether the first entry of _captured is held back, handled but
+        # waiting for room in the message queue (see handle_change)
+        self._held = False
+        self.metrics = SessionMetrics(pad, log=get_metrics_log())
+        # Producers-Consumers queue (coalesces bursts of keystrokes)
+        self.msgmonitor = MessageProdConsMonitor(
+            coalesce_window=settings.get('coalesce_window', 300) / 1000.0,
+            coalesce_max_size=settings.get('coalesce_max_size', 1024),
+            capacity=settings.get('queue_capacity', 1000),
+            policy=settings.get('queue_full_policy', 'coalesce'))
+        self.cr_consumer = ChangesConsumer(
+            self.msgmonitor, self,
+            batch_size=settings.get('batch_max_size', 50)
+            if settings.get('batch_commits', False) else 1,
+            in_flight=in_flight)
+        self.msgmonitor.room_listener = lambda: sync_pool.submit(self, None)
+        self._lagging = False  # Whether "sync lagging" is shown
+        # Local edits of this session are always handled by the same worker
+        self.worker_index = sync_pool.assign()
 
     def initiate(self):
         conv = conv_starter.new(method='PUT', resource='')
-        conv.send(self.pad)
+        conv.send(self.pad, headers=self.request_headers())
         # Handle response
         code = EncodingHandler.resp_ttoc
         if conv.response_code == code['ok']:
+            self._negotiate_wire_format(conv)
             # Get the local copy of the pad
             bufferRegion = sublime.Region(0, self.view.size())
-            self.buffer = self.view.substr(bufferRegion)
+            self.buffer = self._new_buffer(self.view.substr(bufferRegion))
+            self.shadow = Rope(self.buffer.flatten())
 
             # TODO: commit the current buffer
 
             self.active = True
+            # Left by an older pad of the same name
+            self.journal = open_journal(self.pad)
+            if self.journal:
+                self.journal.clear()
         elif conv.response_code == code['pad_already_exists']:
             self.error = 'The name ' + self.pad + ' is already in use.' + \
                 ' Please pick another name, or use <Join pad> command.'
@@ -84,11 +265,7 @@ class Session(object):
             self.error = 'Error.'
 
         if self.active:
-            # Start the changes-consumer thread
-            self.cr_consumer.start()
-            print('Consumer thread started')
-            self.remote_checker.start()
-            print('RemoteChecker thread started')
+            self._start_sync()
 
     def join(self):
         # Check if pad exists
@@ -110,9 +287,21 @@ class Session(object):
             self.error = 'Error.'
             return
 
+        # Resume from the local cache of the pad, or else from the latest
+        # snapshot kept by the server (only fetched if newer than the cache),
+        # so that only the CRs committed after it are replayed
+        synced = self._load_cached()
+        synced = self._fetch_snapshot() or synced
+
         # Send update request
         conv = conv_starter.new(method='GET', resource=self.pad)
-        conv.send(self.cr_n)
+        conv.send(self.cr_n, headers=self.request_headers())
+        if conv.response_code == code['history_compacted']:
+            # A newer snapshot replaced the CRs we asked for
+            synced = self._fetch_snapshot()
+            conv = conv_starter.new(method='GET', resource=self.pad)
+            conv.send(self.cr_n, headers=self.request_headers())
+        self._negotiate_wire_format(conv)
         # Handle response
         if conv.response_code == code['ok']:
             # Activate session
@@ -121,7 +310,8 @@ class Session(object):
             # Commit updates, then current change
             self.cr_n = int(conv.response_headers['new_cr_n'])
             # Apply list
-            self._apply_crs(conv.response_data)
+            self._apply_crs(self._decode_updates(conv))
+            synced = True
             # Activate session
             self.active = True
         elif conv.response_code == code['nan']:
@@ -132,115 +322,695 @@ class Session(object):
             self.error = 'Error.'
 
         if self.active:
+            self.journal = open_journal(self.pad)
+            synced = self._replay_journal() or synced
+
+        if self.active and synced:
+            # The view still holds whatever it had before joining
+            self._on_main(self.update_view)
+            self._store_cached()
+        elif self.active:
+            whole = sublime.Region(0, self.view.size())
+            self.shadow = Rope(self.view.substr(whole))
+
+        if self.active:
+            self._start_sync()
+
+    def _replay_journal(self):
+        '''
+        Queues again the local CRs that an earlier session of the pad left
+        unacknowledged in the journal, once transformed past the CRs
+        committed since, and squashed into as few CRs as their edits allow.
+        The ones the server committed before it could answer are dropped.
+        If the server compacted the CRs committed since, the edits go over
+        the snapshot instead, as a diff of the text they make of it.
+        Returns False if there were none left.
+        '''
+        journaled = self.journal and self.journal.load()
+        if not journaled:
+            if self.journal:
+                self.journal.clear()
+            return False
+        cr_n, crs, sent = journaled
+        code = EncodingHandler.resp_ttoc
+        remote = []
+        if cr_n < self.cr_n:
+            conv = conv_starter.new(method='GET', resource=self.pad)
+            conv.send(cr_n, headers=self.request_headers())
+            if conv.response_code == code['update_needed']:
+                # Up to the CRs the buffer holds
+                remote = EncodingHandler.decode_crs(
+                    conv.response_data)[:self.cr_n - cr_n]
+            elif conv.response_code == code['history_compacted']:
+                # Like the rejected commits of _resync, minus the CRs to
+                # rebase them on: the text they were made over is gone
+                text = edited = self.buffer.flatten()
+                for cr in crs:
+                    edited = cr.apply_over(edited)
+                crs = diff_crs(crs[0].author, text, edited)
+                cr_n, sent = self.cr_n, 0
+        if len(remote) != self.cr_n - cr_n:
+            print('Unable to replay the %d journaled edits of pad %s' %
+                  (len(crs), self.pad))
+            self.journal.clear()
+            return False
+
+        crs = squash(self._unacknowledged(remote, crs, sent))
+        if not crs:
+            self.journal.clear()
+            return False
+        print('Replaying %d journaled edits of pad %s' % (len(crs), self.pad))
+        self.metrics.count('replayed', len(crs))
+        self.metrics.stamp(crs, 'captured')
+        self.metrics.stamp(crs, 'enqueued')
+        with self.lock:
+            for cr in crs:
+                cr.cr_n = self.cr_n
+                conv = conv_starter.new(method='PUT', resource=self.pad)
+                self.msgmonitor.add(
+                    (MessageProdConsMonitor.COMMIT_MSG, conv, cr))
+            self.journal.checkpoint(self.cr_n, crs)
+        return True
+
+    @staticmethod
+    def _unacknowledged(remote, crs, sent):
+        '''
+        Transforms journaled CRs past the remote CRs committed since their
+        checkpoint, leaving out the ones among the first `sent` that the
+        server committed: they are found in the remote CRs as a run by the
+        same author, matching what the server makes of them.
+        '''
+        author = crs[0].author
+        start = 0
+        while start < len(remote) and remote[start].author != author:
+            start += 1
+        before = remote[:start]
+        for count in range(min(sent, len(crs)), 0, -1):
+            others, committed = transform(before, crs[:count])
+            end = start + len(committed)
+            if [(c.pos, c.delta, c.op, c.value) for c in committed] == \
+                    [(c.pos, c.delta, c.op, c.value)
+                     for c in remote[start:end]]:
+                # Over the text with the committed ones, then past the
+                # remote CRs after them
+                _, rest = transform(others, crs[count:])
+                return transform(remote[end:], rest)[1]
+        return transform(remote, crs)[1]
+
+    def journal_sending(self, crs):
+        '''
+        Records in the journal the CRs about to be sent (see prepare), ahead
+        of the ones still queued, so that a replay can tell whether the
+        server committed them
+        '''
+        with self.lock:
+            if not self.journal or self.msgmonitor.dropping():
+                return
+            self.journal.checkpoint(self.cr_n, list(crs) + self._unsent(),
+                                    sent=len(crs))
+
+    def _journal_pending(self, rebased=False):
+        '''
+        Records in the journal the local CRs still not acknowledged as of
+        cr_n (truncating it if there are none). Unless they were `rebased`,
+        only once cr_n moved.
+        '''
+        with self.lock:
+            journal = self.journal
+            if not journal or journal.cr_n is None or \
+                    journal.cr_n == self.cr_n and not rebased:
+                return
+            if self.msgmonitor.dropping():
+                # Not queued until resynced; the journal still stands
+                return
+            journal.checkpoint(self.cr_n, self._unsent())
+
+    def _unsent(self):
+        '''
+        The local CRs yet to be sent, in order: the queued ones, then the ones
+        held back from the queue (see handle_change)
+        '''
+        crs = self.msgmonitor.pending_commits()
+        if self._held:
+            crs += self._captured[0]
+        return crs
+
+    def _start_sync(self):
+        '''Starts sending the local changes and checking for remote ones'''
+        if async_transport:
+            async_transport.add_session(self)
+            print('Session added to the asyncio transport')
+        else:
             # Start the changes-consumer thread
             self.cr_consumer.start()
             print('Consumer thread started')
-            self.remote_checker.start()
-            print('RemoteChecker thread started')
-
-    def handle_change(self, cr):
-        # Assign a number to this CR and increment current count
-        cr.cr_n = self.cr_n
-        # Send change request
-        conv = conv_starter.new(method='PUT', resource=self.pad)
-        global count
-        channel_lock.acquire()  # One message at a time
-        count += 1
-        print('------------- SIMULTANEOUS THREADS:', count)
-        print('         \---', threading.enumerate())
-        channel_lock.release()
-
-        msg_tuple = (MessageProdConsMonitor.COMMIT_MSG, conv, cr)
-        self.msgmonitor.add(msg_tuple)
-
-        channel_lock.acquire()
-        count -= 1
-        channel_lock.release()
+        update_scheduler.add(self)
+        if conv_starter.stream:
+            conv_starter.stream.subscribe(self.pad, self.request_headers())
+            # Edits committed before the subscription
+            self.check_remote()
+
+    def _fetch_snapshot(self):
+        '''
+        Loads the latest snapshot of the pad (full text, tagged with its
+        cr_n) into the buffer. Returns False if the server has none newer
+        than the buffer, or does not support snapshots.
+        '''
+        conv = conv_starter.new(method='GET', resource=self.pad + '/snapshot')
+        conv.send(self.cr_n)
+        if conv.response_code != EncodingHandler.resp_ttoc['ok']:
+            return False
+        self.buffer = self._new_buffer(conv.response_data)
+        self.cr_n = int(conv.response_headers['cr_n'])
+        self._snapshot_cr_n = self.cr_n
+        return True
+
+    @staticmethod
+    def _new_buffer(text=''):
+        '''A buffer holding text, keeping the checksums of its blocks'''
+        return ChecksummedRope(text, block_size=settings.get(
+            'checksum_block_size', DEFAULT_BLOCK_SIZE))
+
+    def _load_cached(self):
+        '''
+        Loads the pad from the local cache into the buffer. Returns False if
+        it is not cached (or the cached copy is damaged).
+        '''
+        cache = get_pad_cache()
+        cached = cache and cache.load(conv_starter.uri, self.pad)
+        if not cached:
+            return False
+        self.cr_n, text = cached
+        self.buffer = self._new_buffer(text)
+        self._snapshot_cr_n = self._cached_cr_n = self.cr_n
+        return True
+
+    def _store_cached(self):
+        '''Saves the buffer, as of cr_n, in the local cache'''
+        cache = get_pad_cache()
+        if cache:
+            cache.store(conv_starter.uri, self.pad, self.cr_n,
+                        self.buffer.flatten())
+        self._cached_cr_n = self.cr_n
+
+    def checkpoint(self):
+        '''
+        Every `snapshot_interval` CRs, uploads the buffer as the snapshot of
+        the pad at the current cr_n, so that the server can compact the
+        history; every `cache_interval` CRs, saves it in the local cache.
+        Also drops the acknowledged CRs from the journal.
+        Must be called from the consumer, between two messages.
+        '''
+        self._journal_pending()
+        interval = settings.get('snapshot_interval', 500)
+        if interval and self.cr_n - self._snapshot_cr_n >= interval:
+            conv = conv_starter.new(method='PUT',
+                                    resource=self.pad + '/snapshot')
+            conv.send(self.buffer.flatten(),
+                      headers={'Snapshot-Cr-N': str(self.cr_n)})
+            self._snapshot_cr_n = self.cr_n
+        interval = settings.get('cache_interval', 100)
+        if interval and self.cr_n - self._cached_cr_n >= interval:
+            self._store_cached()
+        interval = settings.get('checksum_interval', 60)
+        if self._checksums and (self._verify_due or interval and
+                                time.time() - self._verified >= interval):
+            self._verified = time.time()
+            if self.verify():
+                self._verify_due = False
+
+    def verify(self):
+        '''
+        Compares the checksums of the blocks of the buffer with the ones of
+        the pad on the server, at the same cr_n, and fetches again the blocks
+        that differ, merging the repair into the view like remote CRs.
+        Returns False if the server could not tell (it is at another cr_n by
+        now, or it does not provide checksums).
+        Must be called from the consumer, between two messages.
+        '''
+        code = EncodingHandler.resp_ttoc
+        cr_n = self.cr_n
+        headers = {'Block-Size': str(self.buffer.block_size)}
+        conv = conv_starter.new(method='GET',
+                                resource=self.pad + '/checksums')
+        conv.send(cr_n, headers=headers)
+        if conv.response_code != code['ok']:
+            if conv.response_code != code['no']:
+                print('No checksums from the server, not verifying the pad')
+                self._checksums = False
+            return False
+        try:
+            length = int(conv.response_headers['length'])
+            sums = [int(s, 36) for s in
+                    EncodingHandler.decode_fields(conv.response_data)]
+        except (KeyError, ValueError):
+            return False
+        if length == len(self.buffer) and sums == self.buffer.checksums():
+            return True
+
+        # Damaged: take the blocks found locally, fetch the others
+        found = self.buffer.match_blocks(sums, length)
+        missing = [i for i, pos in enumerate(found) if pos is None]
+        print('Pad diverged from the server, fetching %d of %d blocks' %
+              (len(missing), len(sums)))
+        fetched = {}
+        if missing:
+            conv = conv_starter.new(method='GET',
+                                    resource=self.pad + '/blocks')
+            conv.send(EncodingHandler.encode_fields(
+                [str(cr_n)] + [to_base36(i) for i in missing]),
+                headers=headers)
+            if conv.response_code != code['ok']:
+                return False
+            try:
+                blocks = EncodingHandler.decode_fields(conv.response_data)
+            except ValueError:
+                return False
+            if len(blocks) != len(missing):
+                return False
+            fetched = dict(zip(missing, blocks))
+        size = self.buffer.block_size
+        text = ''.join([
+            fetched[i] if pos is None else
+            self.buffer.substr(pos, pos + min(size, length - i * size))
+            for i, pos in enumerate(found)])
+
+        self.metrics.count('repairs')
+        self.metrics.count('repaired blocks', len(missing))
+        remote = diff_crs('', self.buffer.flatten(), text)
+        for cr in remote:
+            cr.apply_over(self.buffer)
+        self._merge_remote(remote)
+        return True
+
+    def capture(self, crs):
+        '''Takes the local CRs of one edit of the view (on the main thread)'''
+        self.metrics.stamp(crs, 'captured')
+        with self.lock:
+            for cr in crs:
+                cr.apply_over(self.shadow)
+            self._captured.append(list(crs))
+        sync_pool.submit(self, crs)
+        update_scheduler.activity(self)
+
+    def handle_change(self, crs):
+        '''
+        Queues the CRs of the oldest capture not handled yet (crs, as
+        captured; None once there is room for the ones held back). While the
+        message queue wants them held back (see MessageProdConsMonitor.hold),
+        they are squashed with the ones held instead, so that neither the
+        worker, shared with other sessions, nor the captures wait.
+        '''
+        with self.lock:
+            captured = self._captured
+            if crs is not None:
+                # As rebased meanwhile
+                crs = captured.pop(1 if self._held else 0)
+                if self.journal and crs:
+                    self.journal.append(self.cr_n, crs)
+                if self._held:
+                    held = captured[0]
+                    crs = held + crs
+                    held[:] = squash(crs)
+                    for cr in held:
+                        # Timed from the oldest edit
+                        cr.trace = crs[0].trace
+                else:
+                    captured.insert(0, crs)
+                    self._held = True
+            crs = []
+            if self._held and not self.msgmonitor.hold():
+                crs = captured.pop(0)
+                self._held = False
+                self.metrics.stamp(crs, 'enqueued')
+            for c_cr in crs:
+                # Provisional number (lets the monitor coalesce CRs); the
+                # consumer stamps the final one when sending
+                c_cr.cr_n = self.cr_n
+                # Send change request
+                conv = conv_starter.new(method='PUT', resource=self.pad)
+                msg_tuple = (MessageProdConsMonitor.COMMIT_MSG, conv, c_cr)
+                self.msgmonitor.add(msg_tuple)
+        self.show_lag()
+
+    def requeue_dropped(self, in_flight=()):
+        '''
+        Once the message queue dropped its commits (see the resync policy of
+        MessageProdConsMonitor), queues instead the CRs turning the buffer,
+        with the CRs in flight applied, into the view. The CRs captured but
+        not queued yet are part of those.
+        Must be called from the consumer, before a response is handled.
+        '''
+        with self.lock:
+            if not self.msgmonitor.dropping():
+                return
+            base = self.buffer.flatten()
+            if in_flight:
+                base = compose(in_flight).apply_over(base)
+            for captured in self._captured:
+                captured[:] = []
+            crs = diff_crs(self.author, base, self.shadow.flatten())
+            self.metrics.count('requeues')
+            self.metrics.stamp(crs, 'captured')
+            self.metrics.stamp(crs, 'enqueued')
+            items = []
+            for cr in crs:
+                cr.cr_n = self.cr_n
+                conv = conv_starter.new(method='PUT', resource=self.pad)
+                items.append((MessageProdConsMonitor.COMMIT_MSG, conv, cr))
+            self.msgmonitor.resync(items)
+
+    def show_lag(self):
+        '''
+        Shows "sync lagging" in the status bar of the view while the message
+        queue is past its high-water mark
+        '''
+        with self.lock:
+            lagging = self.msgmonitor.lagging()
+            if lagging == self._lagging:
+                return
+            self._lagging = lagging
+        view = self.view
+        if lagging:
+            sublime.set_timeout(lambda: view.set_status(
+                'together_lag', 'Together: sync lagging'), 0)
+        else:
+            sublime.set_timeout(lambda: view.erase_status('together_lag'), 0)
+
+    def request_headers(self):
+        '''Headers for requests exchanging CRs with the server'''
+        return {
+            'Accept-Wire-Format': ','.join(
+                [str(f) for f in EncodingHandler.SUPPORTED_FORMATS]),
+            'Wire-Format': str(self.wire_format),
+        }
+
+    def encode_crs(self, crs):
+        '''Encodes CRs for sending, in the format negotiated with server'''
+        return EncodingHandler.encode_crs(crs, self.wire_format)
+
+    def _negotiate_wire_format(self, conv):
+        '''Switches to the CR list format the server answered with'''
+        fmt = conv.response_headers.get('wire_format')
+        if fmt and fmt.isdigit() and \
+                int(fmt) in EncodingHandler.SUPPORTED_FORMATS:
+            self.wire_format = int(fmt)
 
     def handle_response(self, conv, cr):
+        self._negotiate_wire_format(conv)
         # Handle response
         code = EncodingHandler.resp_ttoc
         if conv.response_code == code['ok']:
             # Commit the change (if any)
             if cr:
                 self.cr_n += 1
-                new_buffer = cr.apply_over(self.buffer)
-                if new_buffer:
-                    self.buffer = new_buffer
+                cr.apply_over(self.buffer)
+                self.metrics.stamp([cr], 'applied')
             # Else, remote has no changes
         elif conv.response_code == code['update_needed']:
             # Commit updates, then current change (if any)
-            self.cr_n = int(conv.response_headers['new_cr_n'])
-            # Apply list
-            self._apply_crs(conv.response_data)
+            self._on_main(self._commit_updates, conv,
+                          self._decode_updates(conv), [cr] if cr else [])
+        elif conv.response_code == code['history_compacted']:
+            # The CRs we miss are gone, the change (if any) was not committed
+            rejected = []
+            if cr:
+                conv = conv_starter.new(method='PUT', resource=self.pad)
+                rejected.append((MessageProdConsMonitor.COMMIT_MSG, conv, cr))
+            self._resync(rejected)
         elif conv.response_code == code['generic_error']:
             self.error = 'Connection error! The pad may become inconsistent.'
+            self.metrics.count('errors')
+            # Find out (see checkpoint)
+            self._verify_due = True
         else:
             self.error = 'Error.'
-
-    def check_remote(self):
-        # Put an update request on the queue
-        conv = conv_starter.new(method='GET', resource=self.pad)
+            self.metrics.count('errors')
+
+    def _commit_updates(self, conv, remote, own):
+        '''
+        Applies the remote CRs of an update_needed response (decoded by
+        _decode_updates). The server committed our own CRs (if any) after
+        them, transformed against them.
+
+        The view is ahead of the buffer by our own CRs and by the local ones
+        not sent yet, so only the remote CRs, transformed past all of those,
+        are replayed over it; the pending CRs are transformed to apply after
+        the remote ones. Local edits are thus never reverted or moved.
+
+        Must run on the main thread, where the view is edited and local CRs
+        are captured, so that no edit slips in between.
+        '''
+        self.cr_n = int(conv.response_headers['new_cr_n'])
+        self._apply_crs(remote)
+        if own:
+            remote, own = transform(remote, own)
+            for cr in own:
+                cr.apply_over(self.buffer)
+            self.metrics.stamp(own, 'applied')
+        with self.lock:
+            self.update_view(self._rebase_pending(remote))
+        if remote:
+            update_scheduler.activity(self)
+
+    def _resync(self, rejected):
+        '''
+        Catches up from the latest snapshot, once the server compacted the
+        CRs the session is missing. The difference between the buffer and
+        the snapshot stands for them and is merged like remote CRs; the
+        rejected COMMIT_MSGs are queued again first, to be rebased as well.
+        '''
+        self.metrics.count('resyncs')
+        old = self.buffer.flatten()
+        if not self._fetch_snapshot():
+            self.error = 'Lost track of the pad. Please join it again.'
+            return
+        self._merge_remote(diff_crs('', old, self.buffer.flatten()), rejected)
+
+    def _merge_remote(self, remote, rejected=None):
+        '''
+        Merges CRs the buffer went through, outside of the usual updates,
+        into the view (queueing the `rejected` COMMIT_MSGs again first)
+        '''
+        def merge():
+            with self.lock:
+                if rejected:
+                    self.msgmonitor.push_front(rejected)
+                self.update_view(self._rebase_pending(remote))
+        self._on_main(merge)
+        update_scheduler.activity(self)
+
+    def _rebase_pending(self, remote):
+        '''
+        Transforms the local CRs not sent yet (queued or just captured) to
+        apply after the remote ones, and returns the remote ones transformed
+        to apply after them
+        '''
+        state = {'remote': remote}
+
+        def rebase(cr):
+            state['remote'], crs = transform(state['remote'], [cr])
+            return crs
+
+        if remote:
+            self.msgmonitor.rebase_commits(rebase)
+            for captured in self._captured:
+                rebased = []
+                for cr in captured:
+                    rebased += rebase(cr)
+                captured[:] = rebased
+            self._journal_pending(rebased=True)
+        return state['remote']
+
+    def _on_main(self, func, *args):
+        '''Runs func on the main thread and waits for it to finish'''
+        done = Event()
+
+        def run():
+            try:
+                func(*args)
+            finally:
+                done.set()
+        sublime.set_timeout(run, 0)
+        done.wait()
+
+    def handle_batch_response(self, conv, batch):
+        '''
+        Handles the response to a batch of COMMIT_MSGs. The server commits
+        the first `accepted` CRs of the batch; the others are queued again.
+        '''
+        code = EncodingHandler.resp_ttoc
+        crs = [cr for _, _, cr in batch]
+        self._negotiate_wire_format(conv)
+        if conv.response_code == code['ok']:
+            accepted = int(conv.response_headers.get('accepted', len(crs)))
+            for cr in crs[:accepted]:
+                self.cr_n += 1
+                cr.apply_over(self.buffer)
+            self.metrics.stamp(crs[:accepted], 'applied')
+            rejected = batch[accepted:]
+            if rejected:
+                self.msgmonitor.push_front(rejected)
+        elif conv.response_code == code['update_needed']:
+            self._on_main(self._commit_updates, conv,
+                          self._decode_updates(conv), crs)
+        elif conv.response_code == code['history_compacted']:
+            self._resync(batch)
+        else:
+            self.handle_response(conv, None)
+
+    def check_remote(self, answered=None):
+        '''
+        Queues an update request. `answered` maps cr_ns to the responses of
+        update requests from them, already made (see UpdateScheduler) or
+        pushed by the server; it is only sent if the session is at another
+        cr_n by then.
+        '''
+        if answered:
+            conv = conv_starter.answered('GET', self.pad, answered)
+        else:
+            conv = conv_starter.new(method='GET', resource=self.pad)
         msg_tuple = (MessageProdConsMonitor.UPDATE_MSG, conv, self.cr_n)
         self.msgmonitor.add(msg_tuple)
 
-    def _apply_crs(self, crs_list):
-        crs_to_update = EncodingHandler.deserialize_list(crs_list)
-        for c in crs_to_update:
-            c_cr = ChangeRequest()
-            c_cr.deserialize(c)
-            self.buffer = c_cr.apply_over(self.buffer)
-        self.update_view()
-
-    def update_view(self):
-        '''Update current buffer'''
+    @profiled
+    def _decode_updates(self, conv):
+        '''
+        Returns the remote CRs of an update_needed response, as a CRBatch.
+        Decoded where the response is handled, off the main thread.
+        '''
+        crs = EncodingHandler.decode_batch(conv.response_data)
+        self.metrics.stamp(crs, 'received')
+        return crs
+
+    def _apply_crs(self, crs):
+        '''Applies a CRBatch of remote CRs over the buffer'''
+        crs.apply_over(self.buffer)
+        self.metrics.stamp(crs, 'applied')
+
+    def update_view(self, crs=None):
+        '''
+        Update current buffer. If the list of applied CRs is given, only the
+        regions they touch are patched, otherwise the whole view is replaced.
+        '''
         edit = self.view.begin_edit('tog_update')
-        whole = sublime.Region(0, self.view.size())
-        self.view.erase(edit, whole)
-        self.view.insert(edit, 0, self.buffer)
+        script = compose(crs) if crs is not None else None
+        patched = script is not None and self._patch_view(edit, script)
+        if patched:
+            script.apply_over(self.shadow)
+        else:
+            text = self._local_text()
+            whole = sublime.Region(0, self.view.size())
+            self.view.erase(edit, whole)
+            self.view.insert(edit, 0, text)
+            self.shadow = Rope(text)
         self.view.end_edit(edit)
+        if crs:
+            self.metrics.stamp(crs, 'rendered')
+
+    def statistics(self):
+        '''Summary of the metrics of the session'''
+        monitor = self.msgmonitor
+        return self.metrics.summary({
+            'queue enqueued': monitor.enqueued,
+            'queue coalesced': monitor.coalesced,
+            'queue squashed': monitor.squashed,
+            'queue dropped commits': monitor.dropped,
+            'queue blocked': monitor.blocked,
+            'queue dropped polls': monitor.dropped_polls,
+            'queue max depth': monitor.max_depth,
+        })
+
+    def _local_text(self):
+        '''The buffer with the local CRs not sent yet applied over it'''
+        with self.lock:
+            crs = self.msgmonitor.pending_commits()
+            for captured in self._captured:
+                crs += captured
+            # In one pass over the text
+            return compose(crs).apply_over(self.buffer.flatten())
+
+    def _patch_view(self, edit, script):
+        '''
+        Applies an EditScript (the composed CRs) over the view, one region at
+        a time. Returns False if it does not fit in the view, meaning that the
+        view diverged from the buffer.
+        '''
+        if script.min_length() > self.view.size():
+            return False
+        # From the end, so that the positions of the others stay valid
+        for pos, deleted, inserted in reversed(script.edits()):
+            region = sublime.Region(pos, pos + deleted)
+            if deleted and inserted:
+                self.view.replace(edit, region, inserted)
+            elif deleted:
+                self.view.erase(edit, region)
+            else:
+                self.view.insert(edit, pos, inserted)
+        return True
 
 
 class CaptureEditing(sublime_plugin.EventListener):
     '''Event listener to watch for changes in the local buffer'''
+
+    # Characters compared on each side of a keystroke to validate it
+    CONTEXT = 32
+
     def on_modified(self, view):
         if view.id() not in sessions_by_view:
             return
-        i = 0
-        for sel in view.sel():
-            i += 1
-            curr_line, _ = view.rowcol(sel.begin())
-
-            # Get operation
-            action, content, _ = view.command_history(0, False)
-            if action == 'tog_update':
-                # Sync update, do nothing
-                return
-
-            op = None
-            value = ''
-            pos = sel.begin()
-            delta = 1
-            if action == 'insert':
-                pos -= 1
-                # print('  INSERT: pos=<', pos, '> delta=<', 1, '> value=<', content['characters'][-1], '>')
-                op = ChangeRequest.ADD_EDIT
-                value = content['characters'][-1]
-            elif action == 'left_delete' or action == 'right_delete':
-                # print('  DELETE: pos=<', pos, '> delta=<', 1, '>')
-                op = ChangeRequest.DEL_EDIT
-            else:
-                print('[!] Unrecognized action:', action)
-                return
+        session = sessions_by_view[view.id()]
 
-            cr = ChangeRequest(pos=pos,
-                               delta=delta,
-                               op=op,
-                               value=value)
+        # Get operation
+        action, content, _ = view.command_history(0, False)
+        if action == 'tog_update':
+            # Sync update, do nothing
+            return
 
-            thread = SyncThread(view.id(), cr)
-            thread.start()
-            ThreadProgress(thread, 'Synchronizing', '')
+        crs = self.typed(view, session, action, content)
+        if crs is None:
+            # Paste, undo/redo, multiple cursors etc.: diff the view against
+            # its text before the edit
+            whole = sublime.Region(0, view.size())
+            crs = diff_crs(session.author, session.shadow.flatten(),
+                           view.substr(whole))
+        if crs:
+            session.capture(crs)
+            show_sync_progress()
+
+    def typed(self, view, session, action, content):
+        '''
+        Fast path for a keystroke with a single cursor: returns its CR, or None
+        if the view does not look like the shadow plus that keystroke (the
+        history does not tell apart e.g. an undo).
+        '''
+        sels = view.sel()
+        if len(sels) != 1:
+            return None
+        pos = sels[0].begin()
+        shadow = session.shadow
+        if action == 'insert' and view.size() == len(shadow) + 1:
+            pos -= 1
+            value = content.get('characters', '')[-1:]
+            if view.substr(sublime.Region(pos, pos + 1)) != value:
+                return None
+            op, after = ChangeRequest.ADD_EDIT, pos
+        elif action in ('left_delete', 'right_delete') and \
+                view.size() == len(shadow) - 1:
+            value = ''
+            op, after = ChangeRequest.DEL_EDIT, pos + 1
+        else:
+            return None
+        # The text around it must be unchanged
+        context = self.CONTEXT
+        before = sublime.Region(max(0, pos - context), pos)
+        rest = sublime.Region(pos + len(value),
+                              pos + len(value) + context)
+        if view.substr(before) != shadow.substr(before.begin(), pos) or \
+                view.substr(rest) != shadow.substr(after, after + context):
+            return None
+        return [ChangeRequest(author=session.author, pos=pos, delta=1, op=op,
+                              value=value)]
 
     def on_close(self, view):
         print('*Closed*')
@@ -253,28 +1023,51 @@ class CaptureEditing(sublime_plugin.EventListener):
 
     def on_activated(self, view):
         # print('*Activated*')
-        pass
+        self._update_visibility()
 
     def on_deactivated(self, view):
         # print('*Deactivated*')
-        pass
-
-
-class SyncThread(Thread):
-    def __init__(self, view_id, cr):
-        super(SyncThread, self).__init__(name='SyncThread')
-        self.view_id = view_id
-        self.cr = cr
-        self.session = sessions_by_view[view_id]
-        # Augments CR with author info
-        self.cr.author = self.session.author
-
-    def run(self):
-        if self.session.active:
-            self.session.handle_change(self.cr)
-        else:
-            self.result = False  # Notify ThreadProgress of failure
-            sublime.error_message(self.session.error)
+        # The newly activated view is not known yet
+        sublime.set_timeout(self._update_visibility, 0)
+
+    def _update_visibility(self):
+        '''
+        Pauses the update checks of the sessions whose view is hidden (not the
+        active view of its group, or closed)
+        '''
+        for session in list(sessions_by_view.values()):
+            view = session.view
+            window = view.window()
+            visible = False
+            if window is not None:
+                group = window.get_view_index(view)[0]
+                active = window.active_view_in_group(group)
+                visible = active is not None and active.id() == view.id()
+            update_scheduler.set_visible(session, visible)
+
+
+def diff_crs(author, old, new):
+    '''Returns the CRs turning text old into new'''
+    crs = []
+    for pos, deleted, inserted in diff(old, new):
+        if deleted:
+            crs.append(ChangeRequest(author=author, pos=pos, delta=deleted,
+                                     op=ChangeRequest.DEL_EDIT))
+        if inserted:
+            crs.append(ChangeRequest(author=author, pos=pos,
+                                     delta=len(inserted),
+                                     op=ChangeRequest.ADD_EDIT,
+                                     value=inserted))
+    return crs
+
+
+@profiled
+def sync_change(session, crs):
+    '''Runs on a SyncWorker for the CRs of every edit caught by on_modified'''
+    if session.active:
+        session.handle_change(crs)
+    else:
+        sublime.error_message(session.error)
 
 
 class StartPadCommand(sublime_plugin.WindowCommand):
@@ -354,24 +1147,196 @@ class JoinPadThread(Thread):
             sublime.error_message(self.session.error)
 
 
-class UpdateCheckerThread(Thread):
-    def __init__(self, session):
-        super(UpdateCheckerThread, self).__init__(
-            name='UpdateCheckerThread-'+session.pad)
-        self.session = session
-        self._silent = False
+class ShowSyncStatisticsCommand(sublime_plugin.WindowCommand):
+    '''Command to show the sync metrics of all the pads in a panel'''
+
+    def run(self):
+        sessions = list(sessions_by_view.values())
+        if sessions:
+            text = '\n\n'.join([s.statistics() for s in sessions]) + '\n'
+        else:
+            text = 'No pads.\n'
+        print(text)
+        panel = self.window.get_output_panel('together_stats')
+        if st_version == 3:
+            panel.run_command('append', {'characters': text})
+        else:
+            edit = panel.begin_edit()
+            panel.insert(edit, 0, text)
+            panel.end_edit(edit)
+        self.window.run_command('show_panel',
+                                {'panel': 'output.together_stats'})
+
+
+class ToggleProfilingCommand(sublime_plugin.WindowCommand):
+    '''
+    Command to start profiling the sync threads, or to stop and save the
+    results (see lib/profiling.py)
+    '''
+
+    def run(self):
+        profiler = active_profiler()
+        if profiler is None:
+            try:
+                profiler = Profiler(
+                    settings.get('profile_mode', 'sample'),
+                    interval=settings.get('profile_interval', 5) / 1000.0)
+            except ValueError as e:
+                sublime.error_message(str(e))
+                return
+            profiler.start()
+            sublime.status_message('Together: profiling the sync threads')
+            return
+
+        profiler.stop()
+        directory = settings.get('profile_dir') or \
+            os.path.join(cache_directory(), 'profiles')
+        try:
+            paths = profiler.dump(directory)
+        except (IOError, OSError) as e:
+            sublime.error_message('Unable to save the profile: ' + str(e))
+            return
+        print(profiler.summary())
+        for path in paths:
+            print('  ' + path)
+        sublime.status_message('Together: %s, saved in %s' %
+                               (profiler.summary(), directory))
+
+
+class UpdateScheduler(Thread):
+    '''
+    Checks whether the pads of the sessions changed remotely, with a single
+    request listing each pad and its session's cr_n. The server only answers
+    for the pads that changed; the answers are queued to their sessions as
+    already answered update requests, so they are handled in order with the
+    commits. Servers not supporting batched checks get an update request per
+    pad instead.
+
+    Each pad is checked `min_interval` seconds after local or remote activity
+    (see activity), then less and less often while it stays idle, doubling
+    the interval up to `max_interval`. Pads whose view is not visible are not
+    checked at all until it shows again (see set_visible). While the server
+    pushes the remote CRs (`pushed`), activity makes no difference: the
+    checks are only a safety net.
+    '''
+    def __init__(self, min_interval=1, max_interval=60):
+        super(UpdateScheduler, self).__init__(name='UpdateScheduler')
+        self.daemon = True
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.sessions = []
+        self.batched = True  # Until the server proves otherwise
+        self.pushed = False
+        # Session: [time of its next check, current interval]
+        self._cadence = {}
+        self._hidden = set()
+        self._cond = Condition()
+
+    def add(self, session):
+        '''Checks the pad of the session from now on'''
+        with self._cond:
+            self.sessions.append(session)
+            self._cadence[session] = [time.time() + self.min_interval,
+                                      self.min_interval]
+            if self.ident is None:
+                self.start()
+
+    def activity(self, session):
+        '''Notes that the pad of the session was just edited'''
+        with self._cond:
+            cadence = self._cadence.get(session)
+            if cadence is None or cadence[1] == self.min_interval or \
+                    self.pushed:
+                return
+            cadence[1] = self.min_interval
+            cadence[0] = min(cadence[0], time.time() + self.min_interval)
+            self._cond.notify()
+
+    def set_visible(self, session, visible):
+        '''Pauses or resumes the checks of a session, as its view hides'''
+        with self._cond:
+            if not visible:
+                self._hidden.add(session)
+            elif session in self._hidden:
+                self._hidden.discard(session)
+                # Catch up right away
+                if session in self._cadence:
+                    self._cadence[session] = [time.time(), self.min_interval]
+                self._cond.notify()
 
     def run(self):
         while True:
-            if self.session.active:
-                self.session.check_remote()
-                self._silent = False
-            else:
-                self.result = False  # Notify ThreadProgress of failure
-                if not self._silent:
-                    sublime.error_message(self.session.error)
-                    self._silent = True
-            time.sleep(15)
+            self.check(self._wait_due())
+
+    def _wait_due(self):
+        '''Waits for sessions to be due for a check, and returns them'''
+        with self._cond:
+            while True:
+                now = time.time()
+                times = {}
+                for session, cadence in self._cadence.items():
+                    if session.active and session not in self._hidden:
+                        times[session] = cadence[0]
+                if times and min(times.values()) <= now:
+                    break
+                self._cond.wait(min(times.values()) - now if times else None)
+            # Those due soon come along, in the same request
+            due = [session for session in times
+                   if times[session] <= now + self.min_interval]
+            # Back off, until the next activity
+            for session in due:
+                cadence = self._cadence[session]
+                cadence[1] = min(cadence[1] * 2, self.max_interval)
+                cadence[0] = now + cadence[1]
+            return due
+
+    @profiled
+    def check(self, sessions):
+        '''Checks the pads of the sessions for remote changes'''
+        if self.batched:
+            try:
+                sessions = self._check_batched(sessions)
+            except Exception as e:
+                print('Batched update check failed:', e)
+        for session in sessions:
+            session.check_remote()
+
+    def _check_batched(self, sessions):
+        '''
+        Checks the pads of the sessions with one request. Returns the
+        sessions left to check one by one.
+        '''
+        # Those with commits queued get the updates along with the responses
+        idle = [(s, s.cr_n) for s in sessions if not s.msgmonitor.depth()]
+        if not idle:
+            return []
+        fields = []
+        for session, cr_n in idle:
+            fields += [session.pad, str(cr_n)]
+        conv = conv_starter.new(method='POST', resource='')
+        started = time.time()
+        conv.send(EncodingHandler.encode_fields(fields),
+                  headers=idle[0][0].request_headers())
+        seconds = time.time() - started
+        if conv.response_code != EncodingHandler.resp_ttoc['updates']:
+            print('The server does not support batched update checks')
+            self.batched = False
+            return sessions
+
+        for session, _ in idle:
+            session.metrics.request('batched poll', seconds,
+                                    conv.response_code)
+        # Groups of: index of the pad in the request, response code, number
+        # of the last CR and the CRs the session misses
+        fields = EncodingHandler.decode_fields(conv.response_data)
+        for i in range(0, len(fields) - 3, 4):
+            session, cr_n = idle[int(fields[i])]
+            headers = {'code': fields[i + 1], 'new_cr_n': fields[i + 2]}
+            if 'wire_format' in conv.response_headers:
+                headers['wire_format'] = conv.response_headers['wire_format']
+            session.check_remote(
+                {cr_n: {'headers': headers, 'body': fields[i + 3]}})
+        return []
 
 
 class ThreadProgress():
@@ -415,3 +1380,34 @@ class ThreadProgress():
         i += self.addend
 
         sublime.set_timeout(lambda: self.run(i), 100)
+
+
+# Workers shared by all sessions for handing local edits over to them
+sync_pool = SyncWorkerPool(settings.get('sync_workers', 2), sync_change)
+
+# Checks all pads for remote changes
+update_scheduler = UpdateScheduler(
+    min_interval=settings.get('poll_min_interval', 1),
+    max_interval=settings.get('poll_max_interval', 60))
+update_scheduler.pushed = conv_starter.stream is not None
+
+# Whether the status bar is already animated for sync_pool
+_sync_progress_shown = False
+
+
+class SyncProgress(ThreadProgress):
+    '''Single status animation shown while sync_pool has pending CRs'''
+
+    def run(self, i):
+        global _sync_progress_shown
+        if not self.thread.is_alive():
+            _sync_progress_shown = False
+        ThreadProgress.run(self, i)
+
+
+def show_sync_progress():
+    '''Starts the SyncProgress animation unless it is already running'''
+    global _sync_progress_shown
+    if not _sync_progress_shown:
+        _sync_progress_shown = True
+        SyncProgress(sync_pool, 'Synchronizing', '')
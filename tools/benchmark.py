@@ -0,0 +1,336 @@
+'''
+Headless benchmarks of the plugin.
+
+Runs the plugin against the fake Sublime Text API (tools/fake_sublime.py) and
+an in-process stand-in server (tools/standin_server.py), through these
+scenarios:
+    typing - bursts of keystrokes in one pad
+    paste - large pastes in one pad
+    join - joining a pad with a long history
+    concurrent - several pads typed into at the same time
+and prints the results (throughput, latency percentiles, peak memory...) as
+JSON, to be compared across commits:
+    python tools/benchmark.py -o before.json
+    (change things)
+    python tools/benchmark.py --compare before.json
+
+The plugin settings are read from together.sublime-settings; override them
+with --set name=value (the value in JSON), e.g. --set transport='"stream"'.
+'''
+
+__license__ = 'MIT http://www.opensource.org/licenses/mit-license.php'
+
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+TOOLS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, TOOLS)
+
+import fake_sublime
+from fake_sublime import run_on_main, wait_until
+from standin_server import Pad, StandinServer, StandinStreamServer
+
+SCENARIOS = ('typing', 'paste', 'join', 'concurrent')
+TEXT = 'def f(x):\n    return x * 2  # some code\n'
+
+
+class Benchmark(object):
+    def __init__(self, args):
+        self.args = args
+        self.server = StandinServer().start()
+        self.stream_server = StandinStreamServer(self.server.pads).start()
+        settings = fake_sublime.read_settings(
+            os.path.join(fake_sublime.ROOT, 'together.sublime-settings'))
+        settings.update(server_url=self.server.url,
+                        stream_url=self.stream_server.url, cache_max_size=0,
+                        cache_dir=tempfile.mkdtemp(prefix='together-bench'),
+                        metrics_log='')
+        for assignment in args.set:
+            name, _, value = assignment.partition('=')
+            settings[name] = json.loads(value)
+        self.settings = settings
+        fake_sublime.install(settings)
+        self.together = fake_sublime.load_plugin()
+        self.pad_count = 0
+
+    def new_session(self, join=False, pad=None):
+        '''Starts (or joins) a pad in a new view'''
+        T = self.together
+        if pad is None:
+            self.pad_count += 1
+            pad = 'bench-' + str(self.pad_count)
+        view = fake_sublime.View()
+        session = T.Session(view, pad)
+        # Keep every latency sample
+        session.metrics.window = 10 ** 7
+        if join:
+            session.join()
+        else:
+            session.initiate()
+        if not session.active:
+            raise RuntimeError(session.error)
+        T.sessions_by_view[view.id()] = session
+        return session, view
+
+    def wait_synced(self, sessions):
+        '''Waits until the server acknowledged all local edits'''
+        def synced():
+            for session in sessions:
+                if session.msgmonitor.depth() or session._captured or \
+                        session.view.text != session.buffer.flatten():
+                    return False
+            return not self.together.sync_pool.is_alive()
+        return wait_until(synced, self.args.timeout, 0.02)
+
+    def type_bursts(self, view, keystrokes):
+        for i in range(keystrokes):
+            run_on_main(view.type, TEXT[i % len(TEXT)])
+            if (i + 1) % self.args.burst == 0:
+                time.sleep(self.args.pause)
+
+    @staticmethod
+    def latency(sessions, key='local total'):
+        '''Merged percentiles (in ms) of a metric of the sessions'''
+        samples = []
+        for session in sessions:
+            histogram = session.metrics.histograms.get(key)
+            if histogram:
+                samples.extend(histogram.samples)
+        samples.sort()
+        if not samples:
+            return None
+        last = len(samples) - 1
+        result = {'samples': len(samples)}
+        for p in (50, 90, 99, 100):
+            value = samples[min(last, int(round(p / 100.0 * last)))]
+            result['p%d' % p if p < 100 else 'max'] = round(value * 1000, 3)
+        return result
+
+    def requests(self):
+        return self.server.pads.requests
+
+    # Scenarios
+
+    def typing(self):
+        session, view = self.new_session()
+        requests = self.requests()
+        started = time.time()
+        self.type_bursts(view, self.args.keystrokes)
+        synced = self.wait_synced([session])
+        elapsed = time.time() - started
+        return {
+            'keystrokes': self.args.keystrokes,
+            'seconds': elapsed,
+            'keystrokes_per_second': self.args.keystrokes / elapsed,
+            'requests': self.requests() - requests,
+            'latency_ms': self.latency([session]),
+            'synced': synced,
+        }
+
+    def paste(self):
+        session, view = self.new_session()
+        rand = random.Random(1)
+        chunk = (TEXT * (self.args.paste_size // len(TEXT) + 1))[
+            :self.args.paste_size]
+        requests = self.requests()
+        started = time.time()
+        for _ in range(self.args.pastes):
+            pos = rand.randint(0, len(view.text))
+            run_on_main(view.paste, chunk, pos)
+        synced = self.wait_synced([session])
+        elapsed = time.time() - started
+        size = self.args.paste_size * self.args.pastes
+        return {
+            'pastes': self.args.pastes,
+            'paste_size': self.args.paste_size,
+            'seconds': elapsed,
+            'bytes_per_second': size / elapsed,
+            'requests': self.requests() - requests,
+            'crs': len(self.server.pads.pads[session.pad].log),
+            'latency_ms': self.latency([session]),
+            'synced': synced,
+        }
+
+    def join(self):
+        T = self.together
+        # Fill a pad with a long history, straight on the server
+        pad = Pad()
+        rand = random.Random(2)
+        for i in range(self.args.join_crs):
+            length = len(pad.text)
+            if length and rand.random() < 0.2:
+                pos = rand.randint(0, length - 1)
+                cr = T.ChangeRequest(author='bench', cr_n=i - 1, pos=pos,
+                                     delta=1, op=T.ChangeRequest.DEL_EDIT)
+            else:
+                cr = T.ChangeRequest(author='bench', cr_n=i - 1,
+                                     pos=rand.randint(0, length), delta=1,
+                                     op=T.ChangeRequest.ADD_EDIT,
+                                     value=TEXT[i % len(TEXT)])
+            cr.apply_over(pad.text)
+            pad.log.append(cr)
+        self.server.pads.pads['bench-join'] = pad
+
+        requests = self.requests()
+        started = time.time()
+        session, view = self.new_session(join=True, pad='bench-join')
+        elapsed = time.time() - started
+        return {
+            'crs': self.args.join_crs,
+            'text_size': len(pad.text),
+            'seconds': elapsed,
+            'crs_per_second': self.args.join_crs / elapsed,
+            'requests': self.requests() - requests,
+            'synced': view.text == pad.text.flatten(),
+        }
+
+    def concurrent(self):
+        pairs = [self.new_session() for _ in range(self.args.sessions)]
+        requests = self.requests()
+        started = time.time()
+        threads = [threading.Thread(target=self.type_bursts,
+                                    args=(view, self.args.keystrokes))
+                   for _, view in pairs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        sessions = [session for session, _ in pairs]
+        synced = self.wait_synced(sessions)
+        elapsed = time.time() - started
+        keystrokes = self.args.keystrokes * self.args.sessions
+        return {
+            'sessions': self.args.sessions,
+            'keystrokes': keystrokes,
+            'seconds': elapsed,
+            'keystrokes_per_second': keystrokes / elapsed,
+            'requests': self.requests() - requests,
+            'latency_ms': self.latency(sessions),
+            'synced': synced,
+        }
+
+    def run(self, scenario):
+        '''Runs a scenario, measuring its memory and thread use too'''
+        if self.args.memory and tracemalloc:
+            tracemalloc.start()
+        result = getattr(self, scenario)()
+        if self.args.memory and tracemalloc:
+            result['peak_traced_kb'] = tracemalloc.get_traced_memory()[1] \
+                // 1024
+            tracemalloc.stop()
+        if resource:
+            # Of the whole process so far (stand-in server included)
+            result['max_rss_kb'] = \
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Alive once the scenario is over (all sessions so far)
+        result['threads'] = threading.active_count()
+        return result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=fake_sublime.ROOT,
+            stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, results):
+    '''Prints the change of every numeric result against a baseline'''
+    for scenario in sorted(results['scenarios']):
+        old = baseline['scenarios'].get(scenario)
+        if not old:
+            continue
+        print(scenario)
+        new = results['scenarios'][scenario]
+        for key in sorted(new):
+            values = [(key, old.get(key), new[key])]
+            if isinstance(new[key], dict):
+                values = [(key + '.' + k, (old.get(key) or {}).get(k), v)
+                          for k, v in sorted(new[key].items())]
+            for name, before, after in values:
+                if isinstance(after, bool) or \
+                        not isinstance(after, (int, float)) or not before:
+                    continue
+                print('  %-32s %12.3f -> %12.3f  (%+.1f%%)' %
+                      (name, before, after, (after - before) * 100.0 / before))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('scenarios', nargs='*', default=SCENARIOS,
+                        help='scenarios to run: ' + ', '.join(SCENARIOS))
+    parser.add_argument('-o', '--output', help='write the results there')
+    parser.add_argument('--compare', metavar='RESULTS',
+                        help='compare with earlier results')
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='NAME=VALUE', help='override a setting')
+    parser.add_argument('--keystrokes', type=int, default=2000,
+                        help='keystrokes per typing session')
+    parser.add_argument('--burst', type=int, default=20,
+                        help='keystrokes typed without pause')
+    parser.add_argument('--pause', type=float, default=0.05,
+                        help='seconds between bursts')
+    parser.add_argument('--pastes', type=int, default=20)
+    parser.add_argument('--paste-size', type=int, default=50000)
+    parser.add_argument('--join-crs', type=int, default=100000,
+                        help='length of the history of the joined pad')
+    parser.add_argument('--sessions', type=int, default=8,
+                        help='pads typed into concurrently')
+    parser.add_argument('--memory', action='store_true',
+                        help='trace the peak memory of every scenario '
+                        '(slows it down)')
+    parser.add_argument('--timeout', type=float, default=300,
+                        help='seconds to wait for a scenario to sync')
+    args = parser.parse_args()
+
+    # The plugin logs to stdout
+    stdout, sys.stdout = sys.stdout, sys.stderr
+    bench = Benchmark(args)
+    results = {
+        'revision': git_revision(),
+        'python': sys.version.split()[0],
+        'settings': bench.settings,
+        'scenarios': {},
+    }
+    for scenario in args.scenarios:
+        if scenario not in SCENARIOS:
+            parser.error('unknown scenario ' + scenario)
+        sys.stderr.write('Running ' + scenario + '...\n')
+        results['scenarios'][scenario] = bench.run(scenario)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    sys.stdout = stdout
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+    sys.stdout.flush()
+    # The consumer threads of the sessions never end
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
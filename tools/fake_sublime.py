@@ -0,0 +1,257 @@
+'''
+Minimal stand-in for the Sublime Text API, to run the plugin headless (see
+tools/benchmark.py).
+
+install() registers fake `sublime` and `sublime_plugin` modules; callbacks
+scheduled with sublime.set_timeout run in order on an emulated main thread.
+load_plugin() then imports the plugin as Sublime Text would.
+'''
+
+__license__ = 'MIT http://www.opensource.org/licenses/mit-license.php'
+
+
+import json
+import os
+import re
+import sys
+import threading
+import time
+import traceback
+import types
+
+if sys.version_info < (3,):
+    import Queue as queue
+else:
+    import queue
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+_main_queue = queue.Queue()
+
+
+def _main_loop():
+    while True:
+        func = _main_queue.get()
+        try:
+            func()
+        except Exception:
+            traceback.print_exc()
+
+
+def set_timeout(func, ms):
+    if ms:
+        timer = threading.Timer(ms / 1000.0, _main_queue.put, (func,))
+        timer.daemon = True
+        timer.start()
+    else:
+        _main_queue.put(func)
+
+
+def run_on_main(func, *args):
+    '''Runs func on the main thread, waits for it and returns its result'''
+    done = threading.Event()
+    result = {}
+
+    def run():
+        try:
+            result['value'] = func(*args)
+        finally:
+            done.set()
+    _main_queue.put(run)
+    done.wait()
+    return result.get('value')
+
+
+class Settings(dict):
+    def get(self, key, default=None):
+        return dict.get(self, key, default)
+
+    def set(self, key, value):
+        self[key] = value
+
+
+def read_settings(path):
+    '''Reads a .sublime-settings file (JSON with // comments)'''
+    with open(path) as f:
+        text = f.read()
+    return json.loads(re.sub(r'^\s*//.*$', '', text, flags=re.M))
+
+
+class Region(object):
+    def __init__(self, a, b=None):
+        self.a = a
+        self.b = a if b is None else b
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+    def size(self):
+        return self.end() - self.begin()
+
+
+class View(object):
+    '''
+    A text buffer with the bits of the View API the plugin uses. Edits made
+    through the API (by the plugin) are named after the begin_edit command;
+    user edits are simulated with type() and paste(), which also notify the
+    event listeners like the editor does.
+    '''
+    _next_id = 1
+
+    def __init__(self, text=''):
+        self._id = View._next_id
+        View._next_id += 1
+        self.text = text
+        self.selection = [Region(len(text))]
+        self._history = ('', {})
+        self._settings = Settings()
+
+    def id(self):
+        return self._id
+
+    def size(self):
+        return len(self.text)
+
+    def substr(self, region):
+        return self.text[region.begin():region.end()]
+
+    def sel(self):
+        return self.selection
+
+    def command_history(self, index, modifying_only=False):
+        return self._history[0], self._history[1], 1
+
+    def begin_edit(self, command='', *args):
+        self._history = (command, {})
+        return object()
+
+    def end_edit(self, edit):
+        pass
+
+    def insert(self, edit, pos, text):
+        self.text = self.text[:pos] + text + self.text[pos:]
+        return len(text)
+
+    def erase(self, edit, region):
+        self.text = self.text[:region.begin()] + self.text[region.end():]
+
+    def replace(self, edit, region, text):
+        self.text = self.text[:region.begin()] + text + \
+            self.text[region.end():]
+
+    def settings(self):
+        return self._settings
+
+    def set_status(self, key, value):
+        pass
+
+    def erase_status(self, key):
+        pass
+
+    def is_loading(self):
+        return False
+
+    def window(self):
+        return None
+
+    # User edits (call on the main thread)
+
+    def type(self, char, pos=None):
+        '''Types a character at pos (default: at the cursor)'''
+        pos = self.selection[0].begin() if pos is None else pos
+        self.text = self.text[:pos] + char + self.text[pos:]
+        self.selection = [Region(pos + 1)]
+        self._history = ('insert', {'characters': char})
+        _notify('on_modified', self)
+
+    def paste(self, text, pos=None):
+        '''Pastes text at pos (default: at the cursor)'''
+        pos = self.selection[0].begin() if pos is None else pos
+        self.text = self.text[:pos] + text + self.text[pos:]
+        self.selection = [Region(pos + len(text))]
+        self._history = ('paste', {})
+        _notify('on_modified', self)
+
+
+_listeners = []
+
+
+def _notify(event, view):
+    for listener in _listeners:
+        handler = getattr(listener, event, None)
+        if handler:
+            handler(view)
+
+
+class EventListener(object):
+    pass
+
+
+class _Command(object):
+    def __init__(self, *args):
+        pass
+
+
+def install(settings=None):
+    '''
+    Registers the fake sublime and sublime_plugin modules, with the given
+    plugin settings
+    '''
+    sublime = types.ModuleType('sublime')
+    sublime.Region = Region
+    sublime.View = View
+    sublime.set_timeout = set_timeout
+    sublime.load_settings = lambda name: sublime.settings
+    sublime.settings = Settings(settings or {})
+    sublime.status_message = lambda message: None
+    sublime.error_message = lambda message: sys.stderr.write(
+        'error_message: ' + message + '\n')
+    sublime.packages_path = lambda: os.path.join(ROOT, '..')
+    sublime_plugin = types.ModuleType('sublime_plugin')
+    sublime_plugin.EventListener = EventListener
+    sublime_plugin.WindowCommand = _Command
+    sublime_plugin.TextCommand = _Command
+    sublime_plugin.ApplicationCommand = _Command
+    sys.modules['sublime'] = sublime
+    sys.modules['sublime_plugin'] = sublime_plugin
+
+    thread = threading.Thread(target=_main_loop, name='MainThread-fake')
+    thread.daemon = True
+    thread.start()
+    return sublime
+
+
+def load_plugin(root=ROOT):
+    '''
+    Imports the plugin (after install()) and registers its event listeners.
+    Returns the `together` module.
+    '''
+    if sys.version_info < (3,):
+        sys.path.insert(0, root)
+        import together
+    else:
+        import importlib
+        package = types.ModuleType('Together')
+        package.__path__ = [root]
+        sys.modules['Together'] = package
+        together = importlib.import_module('Together.together')
+    for name in dir(together):
+        obj = getattr(together, name)
+        if isinstance(obj, type) and issubclass(obj, EventListener) and \
+                obj is not EventListener:
+            _listeners.append(obj())
+    return together
+
+
+def wait_until(condition, timeout, interval=0.01):
+    '''Polls condition() until it is true; returns False on timeout'''
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(interval)
+    return True
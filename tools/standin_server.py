@@ -0,0 +1,468 @@
+'''
+Stand-in TogetherServer, for local development and benchmarks.
+
+Keeps the pads in memory and speaks the protocol of the real server (see
+EncodingHandler.resp_ttoc): pad creation and lookup, commits (single and
+batched) with operational transformation against the CRs a client missed,
+update requests (per pad and batched), both CR list wire formats, pad
+snapshots with history compaction, block checksums (and the blocks) of pads
+and gzip/deflate compressed bodies.
+
+Besides HTTP, it speaks the stream protocol of lib/stream_transport.py,
+pushing the CRs committed to a pad to the connections subscribed to it.
+
+Run it with:
+    python tools/standin_server.py [port [stream_port]]
+or start a StandinServer (and a StandinStreamServer) in-process.
+'''
+
+__license__ = 'MIT http://www.opensource.org/licenses/mit-license.php'
+
+
+import os
+import struct
+import sys
+import threading
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'lib'))
+
+from changerequests import EncodingHandler, to_base36, transform
+from rope import Rope
+
+st_version = 2 if sys.version_info < (3,) else 3
+
+if st_version == 3:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import StreamRequestHandler, TCPServer, ThreadingMixIn
+    from urllib.parse import parse_qs, unquote, urlsplit
+elif st_version == 2:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import StreamRequestHandler, TCPServer, ThreadingMixIn
+    from urllib import unquote
+    from urlparse import parse_qs, urlsplit
+
+
+code = EncodingHandler.resp_ttoc
+
+
+class Pad(object):
+    '''A pad: its text, the log of committed CRs and the latest snapshot'''
+
+    def __init__(self):
+        self.text = Rope()
+        self.log = []  # Committed CRs; log[i] is CR number base + i
+        self.base = 0
+        self.snapshot = None  # (cr_n, text)
+
+    def last(self):
+        '''Number of the last committed CR'''
+        return self.base + len(self.log) - 1
+
+    def since(self, cr_n):
+        '''CRs committed after cr_n (None if compacted away)'''
+        if cr_n + 1 < self.base:
+            return None
+        return self.log[cr_n + 1 - self.base:]
+
+    def commit(self, crs):
+        '''
+        Commits CRs made (one on top of the other) over CR number
+        crs[0].cr_n. Returns the CRs committed meanwhile by others, which the
+        new ones were transformed against, or None if they were compacted.
+        '''
+        missed = self.since(crs[0].cr_n)
+        if missed is None:
+            return None
+        if missed:
+            _, crs = transform(missed, crs)
+        for cr in crs:
+            cr.apply_over(self.text)
+            self.log.append(cr)
+        return missed
+
+    def compact(self, cr_n):
+        '''Drops the CRs up to cr_n from the log'''
+        if cr_n >= self.base:
+            self.log = self.log[cr_n + 1 - self.base:]
+            self.base = cr_n + 1
+
+
+class StandinPads(object):
+    '''
+    Protocol logic of the stand-in server, independent of the transport.
+
+    @formats:
+        CR list wire formats the server accepts (pass (1,) to emulate a
+        legacy server)
+    @compact:
+        Whether to drop the history covered by uploaded snapshots
+    '''
+
+    def __init__(self, formats=EncodingHandler.SUPPORTED_FORMATS,
+                 compact=True):
+        self.formats = formats
+        self.compact = compact
+        self.pads = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        # Called (with the lock held) with the name of a pad, the pad and the
+        # number of its last CR before some were committed
+        self.on_commit = None
+
+    def handle(self, method, resource, data, headers):
+        '''
+        Handles one request. `headers` has lower-case names. Returns the
+        response headers and body.
+        '''
+        with self.lock:
+            self.requests += 1
+            if resource == '':
+                if method == 'POST':
+                    return self._updates(data, headers)
+                return self._pads_manager(method, data, headers)
+            if resource.endswith('/snapshot'):
+                pad = self.pads.get(resource[:-len('/snapshot')])
+                if pad is None:
+                    return {'code': code['no']}, ''
+                return self._snapshot(pad, method, data, headers)
+            if resource.endswith('/checksums') or \
+                    resource.endswith('/blocks'):
+                name, _, kind = resource.rpartition('/')
+                pad = self.pads.get(name)
+                if pad is None:
+                    return {'code': code['generic_error']}, ''
+                return self._blocks(pad, kind, data, headers)
+            pad = self.pads.get(resource)
+            if pad is None:
+                return {'code': code['generic_error']}, ''
+            last = pad.last()
+            result = self._pad(pad, method, data, headers)
+            if pad.last() != last and self.on_commit:
+                self.on_commit(resource, pad, last)
+            return result
+
+    def _pads_manager(self, method, name, headers):
+        if method == 'PUT':
+            if name in self.pads:
+                return {'code': code['pad_already_exists']}, ''
+            self.pads[name] = Pad()
+            return {'code': code['ok'],
+                    'wire_format': str(self._wire_format(headers))}, ''
+        return {'code': code['yes'] if name in self.pads else code['no']}, ''
+
+    def _updates(self, data, headers):
+        '''
+        Batched update check: for each (pad, cr_n) asked for, in the fields
+        of the body, the pads that changed since
+        '''
+        try:
+            fields = EncodingHandler.decode_fields(data)
+            asked = [(fields[i], int(fields[i + 1]))
+                     for i in range(0, len(fields) - 1, 2)]
+        except ValueError:
+            return {'code': code['nan']}, ''
+        fmt = self._wire_format(headers)
+        results = []
+        for index, (name, cr_n) in enumerate(asked):
+            pad = self.pads.get(name)
+            if pad is None:
+                result = [code['generic_error'], -1, '']
+            else:
+                missed = pad.since(cr_n)
+                if missed is None:
+                    result = [code['history_compacted'], -1, '']
+                elif not missed:
+                    continue
+                else:
+                    result = [code['update_needed'], pad.last(),
+                              EncodingHandler.encode_crs(missed, fmt)]
+            results += [str(index)] + [str(r) for r in result]
+        return {'code': code['updates'], 'wire_format': str(fmt)}, \
+            EncodingHandler.encode_fields(results)
+
+    def _wire_format(self, headers):
+        '''Best format both sides support'''
+        accepted = headers.get('accept-wire-format', '1').split(',')
+        common = [f for f in self.formats if str(f) in accepted]
+        return max(common) if common else EncodingHandler.LEGACY_FORMAT
+
+    def _pad(self, pad, method, data, headers):
+        fmt = self._wire_format(headers)
+        resp = {'code': code['ok'], 'wire_format': str(fmt)}
+        if method == 'GET':
+            try:
+                missed = pad.since(int(data))
+            except ValueError:
+                return {'code': code['nan']}, ''
+        else:
+            crs = EncodingHandler.decode_crs(data)
+            if not crs:
+                return {'code': code['generic_error']}, ''
+            missed = pad.commit(crs)
+            resp['accepted'] = str(len(crs))
+        if missed is None:
+            return {'code': code['history_compacted']}, ''
+        if not missed:
+            return resp, ''
+        resp['code'] = code['update_needed']
+        resp['new_cr_n'] = str(pad.last())
+        return resp, EncodingHandler.encode_crs(missed, fmt)
+
+    def _snapshot(self, pad, method, data, headers):
+        if method == 'GET':
+            try:
+                cr_n = int(data)
+            except ValueError:
+                cr_n = -1
+            if pad.snapshot is None or pad.snapshot[0] <= cr_n:
+                return {'code': code['no']}, ''
+            return {'code': code['ok'], 'cr_n': str(pad.snapshot[0])}, \
+                pad.snapshot[1]
+        try:
+            cr_n = int(headers.get('snapshot-cr-n', ''))
+        except ValueError:
+            return {'code': code['nan']}, ''
+        if cr_n > pad.last() or \
+                (cr_n == pad.last() and data != pad.text.flatten()):
+            # Not a state this pad went through
+            return {'code': code['generic_error']}, ''
+        if pad.snapshot is None or pad.snapshot[0] < cr_n:
+            pad.snapshot = (cr_n, data)
+            if self.compact:
+                pad.compact(cr_n)
+        return {'code': code['ok']}, ''
+
+    def _blocks(self, pad, kind, data, headers):
+        '''
+        The Adler-32 sums of the blocks of the pad (checksums), or the text
+        of some of them (blocks), as of the cr_n asked for: it must be the
+        last one
+        '''
+        try:
+            size = int(headers.get('block-size', ''))
+            if kind == 'checksums':
+                cr_n, indexes = int(data), None
+            else:
+                fields = EncodingHandler.decode_fields(data)
+                cr_n = int(fields[0])
+                indexes = [int(f, 36) for f in fields[1:]]
+        except (ValueError, IndexError):
+            return {'code': code['nan']}, ''
+        if size <= 0:
+            return {'code': code['nan']}, ''
+        if cr_n != pad.last():
+            return {'code': code['no']}, ''
+        text = pad.text.flatten()
+        if indexes is not None:
+            return {'code': code['ok']}, EncodingHandler.encode_fields(
+                [text[i * size:(i + 1) * size] for i in indexes])
+        sums = [zlib.adler32(text[i:i + size].encode('UTF-8')) & 0xffffffff
+                for i in range(0, len(text), size)]
+        return {'code': code['ok'], 'length': str(len(text))}, \
+            EncodingHandler.encode_fields([to_base36(s) for s in sums])
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # Responses smaller than this are not compressed
+    COMPRESS_MIN_SIZE = 1024
+
+    def _serve(self, method):
+        url = urlsplit(self.path)
+        resource = unquote(url.path.lstrip('/'))
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        encoding = (self.headers.get('Content-Encoding') or '').lower()
+        if encoding == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            body = zlib.decompress(body)
+        elif encoding:
+            self.send_response(415)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = body.decode('UTF-8')
+        if method == 'GET':
+            body = parse_qs(url.query).get('data', [''])[0]
+        headers = dict((k.lower(), v) for k, v in self.headers.items())
+
+        resp_headers, data = self.server.pads.handle(method, resource, body,
+                                                     headers)
+        data = data.encode('UTF-8')
+        self.send_response(200)
+        for name, value in resp_headers.items():
+            self.send_header(name, str(value))
+        self.send_header('Accept-Encoding', 'gzip, deflate')
+        accepted = (self.headers.get('Accept-Encoding') or '').lower()
+        if 'gzip' in accepted and len(data) >= _Handler.COMPRESS_MIN_SIZE:
+            compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+            data = compressor.compress(data) + compressor.flush()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._serve('GET')
+
+    def do_PUT(self):
+        self._serve('PUT')
+
+    def do_POST(self):
+        self._serve('POST')
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class _HTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _StreamHandler(StreamRequestHandler):
+    '''One stream connection: answers its requests, in order'''
+
+    def setup(self):
+        StreamRequestHandler.setup(self)
+        self.write_lock = threading.Lock()
+
+    def send_fields(self, fields):
+        frame = EncodingHandler.encode_fields(fields).encode('UTF-8')
+        with self.write_lock:
+            self.wfile.write(struct.pack('>I', len(frame)) + frame)
+            self.wfile.flush()
+
+    def handle(self):
+        server = self.server
+        try:
+            while True:
+                head = self.rfile.read(4)
+                if len(head) < 4:
+                    break
+                size = struct.unpack('>I', head)[0]
+                frame = self.rfile.read(size)
+                if len(frame) < size:
+                    break
+                fields = EncodingHandler.decode_fields(frame.decode('UTF-8'))
+                _, request_id, method, resource, data = fields[:5]
+                headers = dict((name.lower(), value) for name, value in
+                               zip(fields[5::2], fields[6::2]))
+                if method == 'SUB':
+                    resp_headers, body = server.subscribe(self, resource,
+                                                          headers)
+                else:
+                    resp_headers, body = server.pads.handle(
+                        method, resource, data, headers)
+                resp = ['resp', request_id, body]
+                for name, value in resp_headers.items():
+                    resp += [name, str(value)]
+                self.send_fields(resp)
+        except (IOError, OSError, ValueError):
+            pass
+        server.unsubscribe(self)
+
+
+class _StreamServer(ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, pads):
+        TCPServer.__init__(self, address, _StreamHandler)
+        self.pads = pads
+        self.subscribers = {}  # Pad name: {handler: wire format}
+        pads.on_commit = self.push
+
+    def subscribe(self, handler, name, headers):
+        with self.pads.lock:
+            if name not in self.pads.pads:
+                return {'code': code['no']}, ''
+            fmt = self.pads._wire_format(headers)
+            self.subscribers.setdefault(name, {})[handler] = fmt
+        return {'code': code['ok'], 'wire_format': str(fmt)}, ''
+
+    def unsubscribe(self, handler):
+        with self.pads.lock:
+            for handlers in self.subscribers.values():
+                handlers.pop(handler, None)
+
+    def push(self, name, pad, last):
+        '''Pushes the CRs committed to a pad after `last` (lock held)'''
+        for handler, fmt in list(self.subscribers.get(name, {}).items()):
+            crs = EncodingHandler.encode_crs(pad.since(last), fmt)
+            try:
+                handler.send_fields(['push', name, str(last),
+                                     str(pad.last()), str(fmt), crs])
+            except (IOError, OSError):
+                self.subscribers[name].pop(handler, None)
+
+
+class StandinStreamServer(object):
+    '''
+    The stream endpoint of the stand-in server, sharing the pads of a
+    StandinServer (or its own), running on a background thread
+    '''
+
+    def __init__(self, pads=None, host='127.0.0.1', port=0):
+        self.pads = pads or StandinPads()
+        self.server = _StreamServer((host, port), self.pads)
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'tcp://%s:%d' % (host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name='StandinStreamServer')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class StandinServer(object):
+    '''The stand-in HTTP server, running on a background thread'''
+
+    def __init__(self, host='127.0.0.1', port=0, verbose=False, **options):
+        '''Options (formats, compact) go to StandinPads'''
+        self.pads = StandinPads(**options)
+        self.httpd = _HTTPServer((host, port), _Handler)
+        self.httpd.pads = self.pads
+        self.httpd.verbose = verbose
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       name='StandinServer')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    stream_port = int(sys.argv[2]) if len(sys.argv) > 2 else port + 1
+    server = StandinServer(port=port, verbose=True)
+    stream = StandinStreamServer(server.pads, port=stream_port).start()
+    print('Stand-in TogetherServer listening on ' + server.url + ' and ' +
+          stream.url)
+    server.httpd.serve_forever()
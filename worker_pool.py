@@ -0,0 +1,80 @@
+'''
+Fixed-size pool of worker threads that hand local edits over to sessions.
+
+Every session is bound to one worker, so the change requests of a session are
+handled in the order they were submitted, while the number of threads stays
+the same no matter how fast the user types.
+'''
+
+__license__ = 'MIT http://www.opensource.org/licenses/mit-license.php'
+__author__ = "Iulius Curt <iulius.curt@gmail.com>, http://iuliux.ro"
+
+
+import sys
+import traceback
+from threading import Lock, Thread
+
+if sys.version_info < (3,):
+    import Queue as queue
+else:
+    import queue
+
+
+class SyncWorkerPool:
+    '''Pool of SyncWorkers shared by all sessions'''
+
+    def __init__(self, size, handler):
+        '''
+        @size:
+            Number of worker threads
+        @handler:
+            Callable(session, crs) run by a worker for every submitted list
+            of CRs
+        '''
+        self._lock = Lock()
+        self._pending = 0
+        self._next_worker = 0
+        self.workers = [SyncWorker(self, i, handler) for i in range(size)]
+        for worker in self.workers:
+            worker.start()
+
+    def assign(self):
+        '''Returns the index of the worker a new session should stick to'''
+        with self._lock:
+            index = self._next_worker
+            self._next_worker = (index + 1) % len(self.workers)
+        return index
+
+    def submit(self, session, crs):
+        '''Queues the CRs of one edit for the worker bound to the session'''
+        with self._lock:
+            self._pending += 1
+        self.workers[session.worker_index].tasks.put((session, crs))
+
+    def _done(self):
+        with self._lock:
+            self._pending -= 1
+
+    def is_alive(self):
+        '''True while there are submitted CRs not yet handled'''
+        return self._pending > 0
+
+
+class SyncWorker(Thread):
+    def __init__(self, pool, index, handler):
+        super(SyncWorker, self).__init__(name='SyncWorker-' + str(index))
+        self.daemon = True
+        self.pool = pool
+        self.handler = handler
+        self.tasks = queue.Queue()
+
+    def run(self):
+        while True:
+            session, crs = self.tasks.get()
+            try:
+                self.handler(session, crs)
+            except Exception:
+                # Keep the worker alive for the other sessions
+                traceback.print_exc()
+            finally:
+                self.pool._done()